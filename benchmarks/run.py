@@ -0,0 +1,408 @@
+"""
+Benchmarks for the import mocking and reactive patching in charms.unit_test.
+
+Each benchmark runs in a fresh interpreter, since patching is process-wide,
+and everything runs offline against synthetic charm trees generated in a
+temporary directory. Results are written as JSON, for tracking regressions
+and comparing the optional fast paths against the defaults:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --only import_charm --only mock_kv --scale 0.1
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BENCHMARKS = {}
+
+
+def benchmark(name, variants=("default",)):
+    """
+    Register a benchmark.
+
+    The function is called with the variant name, the scale factor, and a
+    temporary directory, and should do any setup and then return a callable
+    which runs the part to be measured. It may also return a dict of extra
+    info to be included in the results.
+    """
+
+    def _register(func):
+        BENCHMARKS[name] = (func, variants)
+        return func
+
+    return _register
+
+
+def _scaled(value, scale):
+    return max(1, int(value * scale))
+
+
+def make_charm(root, layers, libs_per_layer, reactive_modules, missing_layers):
+    """
+    Generate a synthetic built charm with many layer libraries, and reactive
+    modules which import a mix of those and of layers which aren't present
+    (and so have to be auto-patched).
+    """
+    lib = root / "lib" / "charms" / "layer"
+    lib.mkdir(parents=True)
+    real = []
+    for layer in range(layers):
+        for num in range(libs_per_layer):
+            name = "layer{}_lib{}".format(layer, num)
+            (lib / (name + ".py")).write_text("VALUE = {!r}\n".format(name))
+            real.append(name)
+    (root / "reactive").mkdir()
+    (root / "reactive" / "__init__.py").write_text("")
+    for num in range(reactive_modules):
+        lines = [
+            "from charms.reactive import when, when_not, set_flag",
+            "from charmhelpers.core import hookenv, unitdata",
+        ]
+        for offset in range(10):
+            lines.append(
+                "import charms.layer.{}".format(real[(num * 10 + offset) % len(real)])
+            )
+        for offset in range(missing_layers):
+            lines.append("import charms.layer.missing{}".format(offset))
+        lines += [
+            "",
+            "@when('flag{0}')".format(num),
+            "@when_not('flag{0}.done')".format(num),
+            "def handler{0}():".format(num),
+            "    hookenv.log('handler{0}')".format(num),
+            "    set_flag('flag{0}.done')".format(num),
+        ]
+        (root / "reactive" / "module{}.py".format(num)).write_text("\n".join(lines))
+    return real
+
+
+@benchmark("patch_reactive", variants=("default", "compact"))
+def bench_patch_reactive(variant, scale, tmp):
+    from charms import unit_test
+
+    def run():
+        unit_test.patch_reactive(compact=variant == "compact")
+
+    return run
+
+
+@benchmark("import_charm", variants=("default", "compact"))
+def bench_import_charm(variant, scale, tmp):
+    from charms import unit_test
+
+    modules = _scaled(200, scale)
+    make_charm(
+        tmp, layers=60, libs_per_layer=2, reactive_modules=modules, missing_layers=5
+    )
+    sys.path[0:0] = [str(tmp), str(tmp / "lib")]
+    unit_test.patch_reactive(compact=variant == "compact")
+
+    def run():
+        for num in range(modules):
+            __import__("reactive.module{}".format(num))
+
+    return run, {"modules": modules}
+
+
+@benchmark("scan_handlers", variants=("uncached", "cached"))
+def bench_scan_handlers(variant, scale, tmp):
+    from charms import unit_test
+
+    modules = _scaled(200, scale)
+    make_charm(
+        tmp, layers=60, libs_per_layer=2, reactive_modules=modules, missing_layers=5
+    )
+    cache_dir = tmp / "cache" if variant == "cached" else False
+    unit_test.scan_handlers([tmp], cache_dir=cache_dir)
+
+    def run():
+        unit_test._scan_memo.clear()
+        graph = unit_test.scan_handlers([tmp], cache_dir=cache_dir)
+        assert len(graph.handlers) == modules
+
+    return run, {"modules": modules}
+
+
+@benchmark("find_real", variants=("cached", "uncached"))
+def bench_find_real(variant, scale, tmp):
+    from charms import unit_test
+
+    real = make_charm(
+        tmp, layers=60, libs_per_layer=2, reactive_modules=0, missing_layers=0
+    )
+    sys.path[0:0] = [str(tmp / "lib")]
+    unit_test.patch_reactive()
+    names = ["charms.layer." + name for name in real] + [
+        "charms.layer.missing{}".format(num) for num in range(len(real))
+    ]
+    rounds = _scaled(20, scale)
+
+    def run():
+        for _ in range(rounds):
+            if variant == "uncached":
+                unit_test.MockFinder.cache_clear()
+            for name in names:
+                unit_test.MockFinder.find_real(name)
+
+    return run, {"lookups": rounds * len(names)}
+
+
+@benchmark("auto_import_getattr", variants=("default", "layer_index"))
+def bench_auto_import_getattr(variant, scale, tmp):
+    from charms import unit_test
+
+    real = make_charm(
+        tmp, layers=60, libs_per_layer=2, reactive_modules=0, missing_layers=0
+    )
+    sys.path[0:0] = [str(tmp / "lib")]
+    if variant == "layer_index":
+        unit_test.layer_index.add(tmp)
+    unit_test.patch_reactive()
+    import charms.layer
+
+    names = real + ["missing{}".format(num) for num in range(len(real))]
+
+    def run():
+        for name in names:
+            getattr(charms.layer, name)
+
+    return run, {"attributes": len(names)}
+
+
+@benchmark("mock_calls", variants=("default", "compact", "ring", "count"))
+def bench_mock_calls(variant, scale, tmp):
+    from charms import unit_test
+
+    unit_test.patch_reactive(
+        compact=variant != "default",
+        record_calls={"ring": 1000, "count": "count"}.get(variant, "full"),
+    )
+    from charmhelpers.core import hookenv
+    from charms.reactive import is_flag_set, set_flag
+
+    calls = _scaled(100000, scale)
+
+    def run():
+        for num in range(calls):
+            hookenv.log("message")
+            set_flag("flag")
+            is_flag_set("flag")
+
+    return run, {"calls": calls * 3}
+
+
+@benchmark("kv", variants=("memory", "sqlite"))
+def bench_kv(variant, scale, tmp):
+    from charms import unit_test
+
+    kv = unit_test.MockKV() if variant == "memory" else unit_test.SQLiteKV()
+    keys = _scaled(20000, scale)
+    prefixes = _scaled(500, scale)
+
+    def run():
+        for num in range(keys):
+            kv.set("prefix{}.key{}".format(num % prefixes, num), {"value": num})
+        for num in range(prefixes):
+            kv.getrange("prefix{}.".format(num), strip=True)
+        for num in range(0, prefixes, 2):
+            kv.unsetrange(prefix="prefix{}.".format(num))
+
+    return run, {"keys": keys, "prefix_queries": prefixes}
+
+
+@benchmark("endpoint", variants=("default", "from_relations"))
+def bench_endpoint(variant, scale, tmp):
+    from itertools import chain
+    from unittest.mock import MagicMock
+
+    from charms import unit_test
+
+    relations = _scaled(100, scale)
+    units = 100
+
+    def run():
+        if variant == "from_relations":
+            endpoint = unit_test.MockEndpoint.from_relations(
+                "db",
+                dict.fromkeys(range(relations), units),
+                received=lambda rel_id, unit: {"unit": unit},
+            )
+        else:
+            # The same units and data, built by hand on the default relations,
+            # as a test would have to without from_relations().
+            endpoint = unit_test.MockEndpoint("db", list(range(relations)))
+            for relation in endpoint.relations:
+                names = [
+                    "remote-{}/{}".format(relation.relation_id, num)
+                    for num in range(units)
+                ]
+                relation.joined_units = unit_test._UnitList(
+                    MagicMock(unit_name=name, received={"unit": name}, received_raw={})
+                    for name in names
+                )
+            endpoint.all_joined_units = unit_test._UnitList(
+                chain.from_iterable(r.joined_units for r in endpoint.relations)
+            )
+        for unit in endpoint.all_joined_units:
+            unit.received
+
+    return run, {"relations": relations, "units": relations * units}
+
+
+@benchmark("dispatch")
+def bench_dispatch(variant, scale, tmp):
+    from charms import unit_test
+
+    unit_test.patch_reactive(dispatch=True)
+    from charms.reactive import set_flag, when, when_not
+
+    handlers = _scaled(500, scale)
+    for num in range(handlers):
+
+        def handler(num=num):
+            set_flag("flag{}".format(num + 1))
+
+        handler.__qualname__ = "handler{}".format(num)
+        when("flag{}".format(num))(when_not("flag{}".format(num + 1))(handler))
+    set_flag("flag0")
+
+    def run():
+        stats = unit_test.dispatcher.dispatch()
+        assert len(stats.invoked) == handlers
+
+    return run, {"handlers": handlers}
+
+
+@benchmark("extra_modules", variants=("patch_module", "manifest"))
+def bench_extra_modules(variant, scale, tmp):
+    from charms import unit_test
+
+    modules = _scaled(200, scale)
+    manifest = {
+        "extra.module{}".format(num): {
+            "func{}".format(attr): {"return_value": attr} for attr in range(20)
+        }
+        for num in range(modules)
+    }
+    path = tmp / "manifest.json"
+    path.write_text(json.dumps(manifest))
+    # Populate the cache, as a previous session would have.
+    unit_test._load_manifest(str(path), str(tmp / "cache"))
+
+    def run():
+        if variant == "manifest":
+            unit_test.patch_manifest(path, cache_dir=str(tmp / "cache"))
+            return
+        # Compact, as patch_manifest() is by default, so that only how the
+        # modules are declared differs.
+        for module_name, attrs in manifest.items():
+            module = unit_test.patch_module(module_name, compact=True)
+            for attr, settings in attrs.items():
+                getattr(module, attr).return_value = settings["return_value"]
+
+    return run, {"modules": modules, "attributes": modules * 20}
+
+
+def run_one(name, variant, scale, memory):
+    """
+    Run a single benchmark in this process, and return its result.
+    """
+    sys.path.insert(0, str(ROOT))
+    func, _ = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        setup = func(variant, scale, Path(tmp))
+        run, info = setup if isinstance(setup, tuple) else (setup, {})
+        if memory:
+            tracemalloc.start()
+            run()
+            info["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            run()
+            info["seconds"] = time.perf_counter() - start
+    return info
+
+
+def run_isolated(name, variant, scale, memory):
+    cmd = [
+        sys.executable,
+        __file__,
+        "--run-one",
+        name,
+        variant,
+        "--scale",
+        str(scale),
+    ]
+    if memory:
+        cmd.append("--memory")
+    output = subprocess.check_output(cmd, cwd=str(ROOT))
+    return json.loads(output.decode("utf8").splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS))
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", "-o", help="file to write (default: stdout)")
+    parser.add_argument("--run-one", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(*args.run_one, args.scale, args.memory)))
+        return
+
+    results = []
+    for name in args.only or sorted(BENCHMARKS):
+        for variant in BENCHMARKS[name][1]:
+            runs = [
+                run_isolated(name, variant, args.scale, False)
+                for _ in range(args.repeat)
+            ]
+            times = [r.pop("seconds") for r in runs]
+            result = dict(runs[0], name=name, variant=variant)
+            result.update(
+                seconds_min=min(times),
+                seconds_median=statistics.median(times),
+            )
+            if not args.no_memory:
+                memory = run_isolated(name, variant, args.scale, True)
+                result["peak_traced_bytes"] = memory["peak_traced_bytes"]
+            print(
+                "{name} [{variant}]: {seconds_min:.4f}s".format(**result),
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("PYTHONHASHSEED", "0")
+    main()
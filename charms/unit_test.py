@@ -1,14 +1,26 @@
+import datetime
+import hashlib
+import json
 import os
 import sys
+import threading
+import traceback
 import importlib.util
+import warnings
+import weakref
+from bisect import bisect_left
+from collections import deque, namedtuple
+from collections.abc import Mapping, MutableMapping, Sequence
 from contextlib import contextmanager
+from fnmatch import fnmatch
 from importlib.machinery import ModuleSpec
-from itertools import accumulate, chain
-from unittest.mock import DEFAULT, MagicMock, patch
+from itertools import chain
+from time import perf_counter, sleep, time
+from types import ModuleType
+from unittest.mock import DEFAULT, MagicMock, NonCallableMock, call, patch
 
 import pytest
 
-
 try:
     ModuleNotFoundError
 except NameError:
@@ -36,7 +48,259 @@ def _debug_pront(msg, *args, color=None, **kwargs):
 
 _debug = _debug_noop  # overridden during testing by the --debug-tests option
 
-flags = set()
+FlagTransition = namedtuple("FlagTransition", "flag set cause")
+
+
+class _NoLock:
+    # Stands in for the lock of a FlagSet which isn't threadsafe.
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_LOCK = _NoLock()
+
+
+class FlagSet(set):
+    """
+    The set of currently set flags.
+
+    As well as being a set, this keeps a sorted index of the flags, so that
+    `sorted()` doesn't have to sort them all again on every call. New flags
+    are appended to the index and it is only re-sorted when next needed, as
+    with `MockKV`.
+
+    Each flag being set or cleared is also recorded in any active
+    `journaled()` lists, as a `FlagTransition(flag, set, cause)`, where the
+    `cause` is whatever `cause` was at the time in that thread (the `Handler`
+    being run, when the `dispatcher` runs one).
+
+    If `threadsafe` is true, changes are made under a lock, so that handlers
+    which set or clear flags from several threads can't lose updates or
+    corrupt the index. Checking whether a flag is set doesn't need the lock.
+    """
+
+    def __init__(self, iterable=(), threadsafe=False):
+        super().__init__()
+        self._names = []
+        self._names_sorted = True
+        self._journals = []
+        self._lock = _NO_LOCK
+        self._local = threading.local()
+        self.threadsafe = threadsafe
+        self.update(iterable)
+
+    @property
+    def threadsafe(self):
+        return self._lock is not _NO_LOCK
+
+    @threadsafe.setter
+    def threadsafe(self, threadsafe):
+        if threadsafe != self.threadsafe:
+            self._lock = threading.RLock() if threadsafe else _NO_LOCK
+
+    @property
+    def cause(self):
+        return getattr(self._local, "cause", None)
+
+    @cause.setter
+    def cause(self, cause):
+        self._local.cause = cause
+
+    def __reduce__(self):
+        # Ensure copies get their own index.
+        return (type(self), (list(set.__iter__(self)), self.threadsafe))
+
+    def _record(self, flag, is_set):
+        transition = FlagTransition(flag, is_set, self.cause)
+        for journal in self._journals:
+            journal.append(transition)
+
+    def _sorted_names(self):
+        if not self._names_sorted:
+            self._names.sort()
+            self._names_sorted = True
+        return self._names
+
+    def _set(self, flag):
+        if set.__contains__(self, flag):
+            return
+        set.add(self, flag)
+        names = self._names
+        if self._names_sorted and names and flag < names[-1]:
+            self._names_sorted = False
+        names.append(flag)
+        if self._journals:
+            self._record(flag, True)
+
+    def _unset(self, flag):
+        if not set.__contains__(self, flag):
+            return False
+        set.discard(self, flag)
+        names = self._sorted_names()
+        del names[bisect_left(names, flag)]
+        if self._journals:
+            self._record(flag, False)
+        return True
+
+    def add(self, flag):
+        # Flags are set and cleared one at a time far more often than not, so
+        # these skip even entering the no-op lock.
+        if self._lock is _NO_LOCK:
+            self._set(flag)
+            return
+        with self._lock:
+            self._set(flag)
+
+    def discard(self, flag):
+        if self._lock is _NO_LOCK:
+            self._unset(flag)
+            return
+        with self._lock:
+            self._unset(flag)
+
+    def remove(self, flag):
+        with self._lock:
+            if not self._unset(flag):
+                raise KeyError(flag)
+
+    def pop(self):
+        with self._lock:
+            if not self._names:
+                raise KeyError("pop from an empty set")
+            flag = self._sorted_names()[-1]
+            self._unset(flag)
+            return flag
+
+    def clear(self):
+        with self._lock:
+            if self._journals:
+                for flag in self._sorted_names():
+                    self._record(flag, False)
+            set.clear(self)
+            self._names.clear()
+            self._names_sorted = True
+
+    def update(self, *iterables):
+        with self._lock:
+            for iterable in iterables:
+                for flag in iterable:
+                    self._set(flag)
+
+    def difference_update(self, *iterables):
+        with self._lock:
+            for iterable in iterables:
+                for flag in iterable:
+                    self._unset(flag)
+
+    def intersection_update(self, *iterables):
+        with self._lock:
+            keep = set.intersection(self, *iterables)
+            self.difference_update([flag for flag in self._names if flag not in keep])
+
+    def symmetric_difference_update(self, iterable):
+        with self._lock:
+            for flag in set(iterable):
+                if not self._unset(flag):
+                    self._set(flag)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def set_many(self, flags):
+        """
+        Set all of the given flags.
+        """
+        self.update(flags)
+
+    def clear_many(self, flags):
+        """
+        Clear all of the given flags.
+        """
+        self.difference_update(flags)
+
+    def all_set(self, flags):
+        """
+        Whether all of the given flags are set.
+        """
+        return all(set.__contains__(self, flag) for flag in flags)
+
+    def any_set(self, flags):
+        """
+        Whether any of the given flags are set.
+        """
+        return any(set.__contains__(self, flag) for flag in flags)
+
+    def sorted(self):
+        """
+        Return a sorted list of the flags, as `get_flags()` does.
+        """
+        with self._lock:
+            return list(self._sorted_names())
+
+    def unset(self, *flags):
+        """
+        Return a sorted list of which of the given flags are not set, as
+        `get_unset_flags()` does.
+        """
+        return sorted(flag for flag in set(flags) if not set.__contains__(self, flag))
+
+    @contextmanager
+    def journaled(self):
+        """
+        Context manager which records each flag transition within it, in
+        order, in the list it returns.
+        """
+        journal = []
+        with self._lock:
+            self._journals = self._journals + [journal]
+        try:
+            yield journal
+        finally:
+            with self._lock:
+                # Not list.remove(), which compares by equality.
+                self._journals = [j for j in self._journals if j is not journal]
+
+
+flags = FlagSet()
+
+_MISSING = object()
+
+# Registry of the mock modules which MockLoader has put into sys.modules, so
+# that they can be found without scanning all of sys.modules. Entries can go
+# stale if sys.modules is modified directly (e.g., reset by a fixture), so
+# always check that sys.modules still holds the same object.
+_patched_modules = weakref.WeakValueDictionary()
+
+# Journals of the previous values of sys.modules entries replaced or removed
+# by the patching machinery, one for each active PatchedStateSnapshot.
+_modules_journals = []
+
+# All MockKV instances, so that PatchedStateSnapshot can track changes to them.
+_kv_stores = weakref.WeakValueDictionary()
+
+# Bumped whenever MockLoader or patch_module adds or removes a patched module,
+# so that cached import resolutions which depended on the old set of patched
+# modules are discarded.
+_patch_generation = 0
 
 
 def identity(x, *args, **kwargs):
@@ -44,8 +308,406 @@ def identity(x, *args, **kwargs):
 
 
 def module_ancestors(module_name):
-    tree = list(accumulate(module_name.split("."), lambda a, b: ".".join([a, b])))
-    return tree[:-1]
+    return list(_ancestors(module_name))
+
+
+# Interned ancestor names for each module name seen, which are looked up for
+# every import that goes through MockFinder.
+_ancestors_cache = {}
+
+
+def _ancestors(module_name):
+    try:
+        return _ancestors_cache[module_name]
+    except KeyError:
+        pass
+    parent, sep, _ = module_name.rpartition(".")
+    ancestors = _ancestors(parent) + (sys.intern(parent),) if sep else ()
+    _ancestors_cache[sys.intern(module_name)] = ancestors
+    return ancestors
+
+
+# Specs for mocked modules, which carry no state of their own, so one can be
+# shared by every import of the same name.
+_mock_specs = {}
+
+
+def _mock_spec(fullname):
+    spec = _mock_specs.get(fullname)
+    if spec is None:
+        spec = _mock_specs[fullname] = ModuleSpec(fullname, MockLoader)
+    return spec
+
+
+class ImportRecord:
+    """
+    How a module name was resolved, aggregated over every time it was.
+    """
+
+    __slots__ = (
+        "name",
+        "outcome",
+        "decided_by",
+        "count",
+        "seconds",
+        "find_spec_calls",
+        "cache_hits",
+        "contexts",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.outcome = None
+        self.decided_by = None
+        self.count = 0
+        self.seconds = 0.0
+        self.find_spec_calls = 0
+        self.cache_hits = 0
+        self.contexts = set()
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "outcome": self.outcome,
+            "decided_by": self.decided_by,
+            "count": self.count,
+            "seconds": self.seconds,
+            "find_spec_calls": self.find_spec_calls,
+            "cache_hits": self.cache_hits,
+            "contexts": sorted(self.contexts),
+        }
+
+
+class ImportTrace:
+    """
+    Structured instrumentation of import resolution by `MockFinder` and
+    `AutoImportMockPackage`.
+
+    While `enabled`, each module name resolved is recorded, along with
+    whether it resolved to a "real" or "mocked" module or is "missing", which
+    code path decided that, how long it took, and how many `find_spec()`
+    calls were made to other finders. Time is also attributed to the current
+    `context`, which the pytest plugin sets to the test module being
+    collected or run.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.context = None
+        self.records = {}
+        self.contexts = {}
+        self._depth = 0
+        # Running totals, always maintained since they're cheap.
+        self.find_spec_calls = 0
+        self.cache_hits = 0
+
+    def clear(self):
+        self.records.clear()
+        self.contexts.clear()
+
+    @contextmanager
+    def timed(self, name):
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = ImportRecord(name)
+        calls, hits = self.find_spec_calls, self.cache_hits
+        self._depth += 1
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = perf_counter() - start
+            self._depth -= 1
+            record.count += 1
+            record.seconds += seconds
+            record.find_spec_calls += self.find_spec_calls - calls
+            record.cache_hits += self.cache_hits - hits
+            if self.context is not None:
+                record.contexts.add(self.context)
+            # Nested resolutions, e.g., an auto-import importing the real
+            # module, are already counted by the outer one.
+            if not self._depth:
+                context = self.contexts.get(self.context)
+                if context is None:
+                    context = self.contexts[self.context] = [0, 0.0]
+                context[0] += 1
+                context[1] += seconds
+
+    def unused_mocks(self):
+        """
+        Return the names of currently patched modules which haven't been used
+        at all, i.e., which have no attributes or calls.
+        """
+        unused = []
+        for name, module in _iter_patched_modules():
+            if isinstance(module, MockModule):
+                used = module.call_count or any(
+                    not key.startswith("__") for key in vars(module)
+                )
+            else:
+                used = module._mock_children or module.mock_calls
+            if not used:
+                unused.append(name)
+        return sorted(unused)
+
+    def as_dict(self):
+        return {
+            "modules": [
+                record.as_dict()
+                for record in sorted(
+                    self.records.values(), key=lambda r: r.seconds, reverse=True
+                )
+            ],
+            "contexts": [
+                {"context": context, "count": count, "seconds": seconds}
+                for context, (count, seconds) in sorted(
+                    self.contexts.items(), key=lambda item: item[1][1], reverse=True
+                )
+            ],
+            "unused_mocks": self.unused_mocks(),
+            "find_real_cache": MockFinder.cache_info()._asdict(),
+        }
+
+    def dump(self, path):
+        """
+        Write the trace to the given path as JSON.
+        """
+        with open(path, "w") as fp:
+            json.dump(self.as_dict(), fp, indent=2)
+
+    def report_lines(self, limit=10):
+        """
+        Return a human-readable summary of the trace.
+        """
+        outcomes = {}
+        for record in self.records.values():
+            outcomes[record.outcome] = outcomes.get(record.outcome, 0) + 1
+        total = sum(seconds for _, seconds in self.contexts.values())
+        lines = [
+            "{} module names resolved in {:.3f}s ({})".format(
+                len(self.records),
+                total,
+                ", ".join(
+                    "{} {}".format(count, outcome)
+                    for outcome, count in sorted(outcomes.items())
+                ),
+            ),
+            "find_real cache: {}".format(MockFinder.cache_info()),
+            "",
+            "Slowest contexts:",
+        ]
+        data = self.as_dict()
+        for context in data["contexts"][:limit]:
+            lines.append("  {seconds:.4f}s {count:>6} {context}".format(**context))
+        lines += ["", "Slowest module names:"]
+        for record in data["modules"][:limit]:
+            lines.append(
+                "  {seconds:.4f}s {count:>6} {name} ({outcome}, {decided_by}, "
+                "{find_spec_calls} find_spec calls)".format(**record)
+            )
+        if data["unused_mocks"]:
+            lines += ["", "Unused mocks:"]
+            lines += ["  " + name for name in data["unused_mocks"]]
+        return lines
+
+
+import_trace = ImportTrace()
+
+
+class LayerIndex:
+    """
+    An index of the layer libraries which are available as real
+    `charms.layer` modules, so that deciding whether to import or mock one is
+    a dict lookup rather than a search of the filesystem.
+
+    The index covers the `charms/layer` directories found on `sys.path`, as
+    well as the `lib/charms/layer` directories of each charm or layer source
+    directory added with `add()`, and those of the layers they include in
+    their `layer.yaml`, which are looked for in the `search_path` (by default,
+    `$CHARM_LAYERS_DIR` and `$LAYER_PATH`). It is only used once a directory
+    has been added.
+    """
+
+    def __init__(self, search_path=None):
+        if search_path is None:
+            search_path = [
+                path
+                for var in ("CHARM_LAYERS_DIR", "LAYER_PATH")
+                for path in os.environ.get(var, "").split(os.pathsep)
+                if path
+            ]
+        self.search_path = list(search_path)
+        self.roots = []
+        self.scans = 0
+        self._dirs = {}
+        self._layer_yamls = {}
+        self._modules = {}
+        self._sys_path = None
+
+    @property
+    def enabled(self):
+        return bool(self.roots)
+
+    def add(self, root):
+        """
+        Add a charm or layer source directory to the index.
+        """
+        root = os.path.abspath(str(root))
+        if root not in self.roots:
+            self.roots.append(root)
+            self._sys_path = None
+
+    def clear(self):
+        """
+        Remove all directories from the index, and disable it.
+        """
+        self.roots = []
+        self._dirs.clear()
+        self._layer_yamls.clear()
+        self._modules = {}
+        self._sys_path = None
+
+    def refresh(self):
+        """
+        Bring the index up to date with the filesystem.
+
+        Only directories (or `layer.yaml` files) which have been modified
+        since they were last scanned are scanned again. This happens lazily,
+        on the next lookup, and is also triggered by
+        `importlib.invalidate_caches()`.
+        """
+        self._sys_path = None
+
+    def covers(self, fullname):
+        """
+        Whether the index decides if the given module is real or mocked.
+        """
+        return (
+            bool(self.roots)
+            and fullname.rpartition(".")[0] == "charms.layer"
+            and _is_patched(sys.modules.get("charms.layer"))
+        )
+
+    def names(self):
+        """
+        Return the sorted names of the indexed layer libraries.
+        """
+        self._update()
+        return sorted(self._modules)
+
+    def find_spec(self, fullname):
+        """
+        Return a ModuleSpec for the given `charms.layer` library, or None.
+        """
+        self._update()
+        entry = self._modules.get(fullname.rpartition(".")[2])
+        if entry is None:
+            return None
+        path, is_package = entry
+        return importlib.util.spec_from_file_location(
+            fullname,
+            path,
+            submodule_search_locations=[os.path.dirname(path)] if is_package else None,
+        )
+
+    def _update(self):
+        if self._sys_path == tuple(sys.path):
+            return
+        self._sys_path = tuple(sys.path)
+        # Modules on sys.path would be found first by a normal import.
+        lib_dirs = [os.path.join(path or ".", "charms", "layer") for path in sys.path]
+        lib_dirs.extend(
+            os.path.join(root, "lib", "charms", "layer") for root in self._layers()
+        )
+        modules = {}
+        for lib_dir in lib_dirs:
+            for name, entry in self._scan(lib_dir).items():
+                modules.setdefault(name, entry)
+        self._modules = modules
+
+    def _layers(self):
+        # The added directories, each followed by the layers it includes,
+        # depth first, so that higher layers take precedence as they would in
+        # a built charm.
+        layers = []
+        pending = list(reversed(self.roots))
+        while pending:
+            layer = pending.pop()
+            if layer in layers:
+                continue
+            layers.append(layer)
+            pending.extend(reversed(self._includes(layer)))
+        return layers
+
+    def _includes(self, layer):
+        path = os.path.join(layer, "layer.yaml")
+        mtime = _mtime(path)
+        cached = self._layer_yamls.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        includes = []
+        if mtime is not None:
+            try:
+                # Optional dependency, only needed for layer.yaml files.
+                import yaml
+            except ImportError:
+                warnings.warn(
+                    "Ignoring the layers included by {}, since reading layer.yaml "
+                    "requires PyYAML (install charms.unit_test[yaml])".format(path)
+                )
+                self._layer_yamls[path] = (mtime, includes)
+                return includes
+
+            with open(path) as fp:
+                options = yaml.safe_load(fp) or {}
+            for include in options.get("includes") or []:
+                kind, _, name = include.partition(":")
+                if kind != "layer":
+                    # Interfaces don't provide charms.layer libraries.
+                    continue
+                for base in self.search_path:
+                    found = [
+                        candidate
+                        for candidate in (name, "layer-" + name)
+                        if os.path.isdir(os.path.join(base, candidate))
+                    ]
+                    if found:
+                        includes.append(os.path.abspath(os.path.join(base, found[0])))
+                        break
+        self._layer_yamls[path] = (mtime, includes)
+        return includes
+
+    def _scan(self, lib_dir):
+        mtime = _mtime(lib_dir)
+        cached = self._dirs.get(lib_dir)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        entries = {}
+        if mtime is not None:
+            self.scans += 1
+            for filename in os.listdir(lib_dir):
+                path = os.path.join(lib_dir, filename)
+                if filename.endswith(".py") and filename != "__init__.py":
+                    entries[filename[:-3]] = (path, False)
+                elif os.path.isfile(os.path.join(path, "__init__.py")):
+                    entries[filename] = (os.path.join(path, "__init__.py"), True)
+        self._dirs[lib_dir] = (mtime, entries)
+        return entries
+
+
+def _time_ns():
+    # time.time_ns() is only available from python 3.7
+    return int(time() * 1e9)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+layer_index = LayerIndex()
 
 
 class AutoImportMockPackage(MagicMock):
@@ -61,8 +723,20 @@ class AutoImportMockPackage(MagicMock):
         if attr.startswith("_"):
             return super().__getattr__(attr)
         module_name = self.__name__ + "." + attr
+        if not import_trace.enabled:
+            return self._auto_import(attr, module_name)
+        with import_trace.timed(module_name) as record:
+            result = self._auto_import(attr, module_name)
+            record.outcome = "mocked" if _is_patched(result) else "real"
+            record.decided_by = "auto_import"
+        return result
+
+    def _auto_import(self, attr, module_name):
         _debug("Attempting to auto-load {}", module_name, color="cyan")
-        real_spec = MockFinder.find_real(module_name)
+        if layer_index.covers(module_name):
+            real_spec = layer_index.find_spec(module_name)
+        else:
+            real_spec = MockFinder.find_real(module_name)
         if real_spec:
             module = importlib.import_module(module_name)
             setattr(self, attr, module)
@@ -73,15 +747,317 @@ class AutoImportMockPackage(MagicMock):
             return super().__getattr__(attr)
 
 
+def _valid_record_calls(record_calls):
+    if isinstance(record_calls, int) and not isinstance(record_calls, bool):
+        return record_calls > 0
+    return record_calls in MockModule.RECORD_CALLS
+
+
+def _call_key(recorded):
+    _, args, kwargs = recorded
+    return args, tuple(sorted(kwargs.items()))
+
+
+def _is_exception(obj):
+    return isinstance(obj, BaseException) or (
+        isinstance(obj, type) and issubclass(obj, BaseException)
+    )
+
+
+class MockModule(ModuleType):
+    """
+    A compact alternative to MagicMock for patched modules.
+
+    Attributes are created lazily, on first access, as further MockModule
+    instances, so that any function or submodule can be used or imported,
+    and each instance can be called, configured with a `return_value` or
+    `side_effect`, and asserted on, like a very limited MagicMock.
+
+    How much call information is kept is controlled by `record_calls`:
+
+      * `"full"` records each call in `call_args_list`, like MagicMock
+      * an int, N, only keeps the last N calls in `call_args_list`
+      * `"count"` only keeps `call_count`
+      * `"none"` doesn't record anything at all
+
+    Whether it has been called with given args can be checked with
+    `called_with()`, which uses an index of the recorded calls.
+    """
+
+    __slots__ = (
+        "_record_calls",
+        "_return_value",
+        "_side_effect",
+        "_call_index",
+        "call_count",
+        "call_args_list",
+    )
+
+    RECORD_CALLS = ("full", "count", "none")
+
+    def __init__(self, name, record_calls="full"):
+        if not _valid_record_calls(record_calls):
+            raise ValueError("Invalid record_calls: {!r}".format(record_calls))
+        super().__init__(name)
+        self._record_calls = record_calls
+        self._return_value = DEFAULT
+        self._side_effect = None
+        self.call_count = 0
+        self._reset_calls()
+
+    def _reset_calls(self):
+        if isinstance(self._record_calls, int):
+            self.call_args_list = deque(maxlen=self._record_calls)
+        else:
+            self.call_args_list = []
+        # Built on the first called_with() and maintained from then on, so
+        # that calls don't pay for it unless it is used.
+        self._call_index = None
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") and attr.endswith("__"):
+            raise AttributeError(attr)
+        child = MockModule(self.__name__ + "." + attr, self._record_calls)
+        setattr(self, attr, child)
+        return child
+
+    def __call__(self, *args, **kwargs):
+        if self._record_calls != "none":
+            self.call_count += 1
+            if self._record_calls != "count":
+                self._record_call(call(*args, **kwargs))
+        effect = self._side_effect
+        if effect is not None:
+            if _is_exception(effect):
+                raise effect
+            if callable(effect):
+                result = effect(*args, **kwargs)
+            else:
+                result = next(effect)
+                if _is_exception(result):
+                    raise result
+            if result is not DEFAULT:
+                return result
+        return self.return_value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # patch_module() attaches its unpatch function to the instance, but
+        # context managers are only looked up on the type.
+        unpatch = self.__dict__.get("__exit__")
+        if unpatch is not None:
+            unpatch(self, *exc_info)
+
+    def _record_call(self, recorded):
+        calls = self.call_args_list
+        if self._call_index is not None:
+            if len(calls) == getattr(calls, "maxlen", None):
+                self._index_call(calls[0], -1)
+            self._index_call(recorded, 1)
+        calls.append(recorded)
+
+    def _index_call(self, recorded, delta):
+        try:
+            key = _call_key(recorded)
+            count = self._call_index.get(key, 0) + delta
+        except TypeError:
+            # Unhashable args can only be found by scanning the calls.
+            return
+        if count:
+            self._call_index[key] = count
+        else:
+            del self._call_index[key]
+
+    def called_with(self, *args, **kwargs):
+        """
+        Return whether any of the recorded calls were made with the given
+        args, using an index of the calls rather than scanning them all.
+        """
+        self._require_calls("called_with")
+        expected = call(*args, **kwargs)
+        if self._call_index is None:
+            self._call_index = {}
+            for recorded in self.call_args_list:
+                self._index_call(recorded, 1)
+        try:
+            return _call_key(expected) in self._call_index
+        except TypeError:
+            return expected in self.call_args_list
+
+    @property
+    def return_value(self):
+        if self._return_value is DEFAULT:
+            self._return_value = MockModule(self.__name__ + "()", self._record_calls)
+        return self._return_value
+
+    @return_value.setter
+    def return_value(self, value):
+        self._return_value = value
+
+    @property
+    def side_effect(self):
+        return self._side_effect
+
+    @side_effect.setter
+    def side_effect(self, value):
+        if value is not None and not callable(value):
+            if not isinstance(value, BaseException):
+                value = iter(value)
+        self._side_effect = value
+
+    @property
+    def called(self):
+        return self.call_count > 0
+
+    @property
+    def call_args(self):
+        self._require_calls("call_args")
+        return self.call_args_list[-1] if self.call_args_list else None
+
+    def _require_calls(self, what):
+        if self._record_calls in ("count", "none"):
+            raise RuntimeError(
+                "Can't use {} on {} which doesn't record calls "
+                "(record_calls={!r})".format(what, self.__name__, self._record_calls)
+            )
+
+    def _require_count(self, what):
+        if self._record_calls == "none":
+            raise RuntimeError(
+                "Can't use {} on {} which doesn't record calls "
+                "(record_calls='none')".format(what, self.__name__)
+            )
+
+    def assert_called(self):
+        self._require_count("assert_called")
+        if not self.call_count:
+            raise AssertionError("Expected {} to have been called.".format(self))
+
+    def assert_called_once(self):
+        self._require_count("assert_called_once")
+        if self.call_count != 1:
+            raise AssertionError(
+                "Expected {} to have been called once. Called {} times.".format(
+                    self, self.call_count
+                )
+            )
+
+    def assert_not_called(self):
+        self._require_count("assert_not_called")
+        if self.call_count:
+            raise AssertionError(
+                "Expected {} to not have been called. Called {} times.".format(
+                    self, self.call_count
+                )
+            )
+
+    def assert_called_with(self, *args, **kwargs):
+        self._require_calls("assert_called_with")
+        expected = call(*args, **kwargs)
+        if self.call_args != expected:
+            raise AssertionError(
+                "Expected call: {}\nActual call: {}".format(expected, self.call_args)
+            )
+
+    def assert_called_once_with(self, *args, **kwargs):
+        self.assert_called_once()
+        self.assert_called_with(*args, **kwargs)
+
+    def assert_any_call(self, *args, **kwargs):
+        self._require_calls("assert_any_call")
+        expected = call(*args, **kwargs)
+        # Matchers such as ANY can only be found by scanning the calls.
+        if (
+            not self.called_with(*args, **kwargs)
+            and expected not in self.call_args_list
+        ):
+            raise AssertionError("{} call not found".format(expected))
+
+    def reset_mock(self):
+        self.call_count = 0
+        self._reset_calls()
+        if isinstance(self._return_value, MockModule):
+            self._return_value.reset_mock()
+        prefix = self.__name__ + "."
+        for value in list(vars(self).values()):
+            if isinstance(value, MockModule) and value.__name__.startswith(prefix):
+                value.reset_mock()
+
+
+def _is_patched(module):
+    return isinstance(module, (MagicMock, MockModule))
+
+
+class _ModulesJournal(dict):
+    # The previous sys.modules entries of patched modules, along with a
+    # shallow copy of sys.modules as it was when journaling started, and the
+    # last name in it as an anchor.
+    def __init__(self):
+        super().__init__()
+        self.modules = dict(sys.modules)
+        self.last = next(iter(_reversed_keys(sys.modules)))
+        self.anchor = sys.modules[self.last]
+
+    def _recent(self):
+        # New modules, including re-imported ones, are added to the end of
+        # sys.modules, so while the anchor is still in place only the names
+        # after it have to be looked at. Otherwise, all of them are.
+        anchored = sys.modules.get(self.last, _MISSING) is self.anchor
+        for name in _reversed_keys(sys.modules):
+            if anchored and name == self.last:
+                return
+            yield name
+
+    def added(self):
+        return [name for name in self._recent() if name not in self.modules]
+
+    def replaced(self):
+        # Modules which were removed and then imported again.
+        return [
+            name
+            for name in self._recent()
+            if self.modules.get(name, sys.modules[name]) is not sys.modules[name]
+        ]
+
+
+def _discard_modules_journal(journal):
+    # Journals are dicts, so list.remove() could discard an equal one.
+    _modules_journals[:] = [j for j in _modules_journals if j is not journal]
+
+
+def _record_module(name):
+    for journal in _modules_journals:
+        if name not in journal:
+            module = sys.modules.get(name, _MISSING)
+            if name not in journal.modules:
+                # It wasn't there when journaling started.
+                module = _MISSING
+            journal[name] = module
+
+
+def _reversed_keys(mapping):
+    try:
+        return reversed(mapping)
+    except TypeError:
+        # dicts are only reversible from python 3.8
+        return reversed(list(mapping))
+
+
+def _iter_patched_modules():
+    for name, mod in list(_patched_modules.items()):
+        if sys.modules.get(name) is mod:
+            yield name, mod
+
+
 @contextmanager
 def _hide_patched_modules():
     # NB: can't use unittest.mock.patch.dict because it doesn't restore
     # attribute attachment.
-    patches = {}
-    for name, mod in sys.modules.items():
-        if isinstance(mod, MagicMock):
-            patches[name] = mod
+    patches = dict(_iter_patched_modules())
     for name in patches.keys():
+        _record_module(name)
         del sys.modules[name]
     try:
         yield
@@ -93,54 +1069,195 @@ def _hide_patched_modules():
                 setattr(sys.modules[parent], attr, mod)
 
 
+def _search_locations(spec):
+    locations = spec.submodule_search_locations
+    if locations is None:
+        return None
+    # Namespace package paths recalculate themselves from their parent in
+    # sys.modules, which may be patched or not imported at all, so take a copy
+    # of the path as the finder computed it instead.
+    return list(getattr(locations, "_path", locations))
+
+
+FindRealCacheInfo = namedtuple("FindRealCacheInfo", "hits misses currsize")
+
+
 class MockFinder:
+    # Cache of find_real() results, both positive (a ModuleSpec) and negative
+    # (None), keyed by module name. The whole cache is only valid for a given
+    # import state; see _import_state().
+    _real_cache = {}
+    _real_cache_state = None
+    _real_cache_hits = 0
+    _real_cache_misses = 0
+
+    @staticmethod
+    def _import_state():
+        # The finders themselves, rather than their ids, which could be reused
+        # by replacements. Only the path entry finders for sys.path are
+        # included, as those for package directories are added by lookups
+        # as they go; replacing one of those needs invalidate_caches().
+        importer_cache = sys.path_importer_cache
+        return (
+            tuple(sys.path),
+            tuple(sys.meta_path),
+            tuple(importer_cache.get(entry) for entry in sys.path),
+            _patch_generation,
+        )
+
     @classmethod
     def find_real(cls, fullname):
-        # Defer to things actually on disk. To do so, though, we have to
-        # temporarily remove any patched modules from sys.modules, or they will
-        # prevent the normal discovery method from working. We also have to
-        # temporarily remove this finder from sys.meta_path to prevent infinite
-        # recursion. This handles the case where one of the ancestors is a
-        # patched module, but the user is trying to import a real module. A
-        # common example of this is having charms.layer patched but wanting to
-        # import the charm's own lib code, from, e.g., charms.layer.my_charm.
-        with _hide_patched_modules():
-            with patch(
-                "sys.meta_path",
-                [
-                    finder
-                    for finder in sys.meta_path
-                    if not isinstance(finder, MockFinder)
-                ],
-            ):
-                try:
-                    file_spec = importlib.util.find_spec(fullname)
-                    if file_spec:
-                        _debug("Found real module {}", fullname, color="green")
-                        return file_spec
-                except ModuleNotFoundError:
-                    pass
+        state = cls._import_state()
+        if state != cls._real_cache_state:
+            cls._real_cache.clear()
+            cls._real_cache_state = state
+        spec = cls._real_cache.get(fullname, _MISSING)
+        if spec is not _MISSING:
+            cls._real_cache_hits += 1
+            import_trace.cache_hits += 1
+            return spec
+        cls._real_cache_misses += 1
+        spec = cls._find_real_uncached(fullname)
+        cls._real_cache[fullname] = spec
+        # The lookup itself can add the finders for sys.path entries to
+        # sys.path_importer_cache; that doesn't invalidate anything we've
+        # cached, so don't let it clear the cache.
+        cls._real_cache_state = cls._import_state()
+        return spec
 
-    def find_spec(self, fullname, path, target=None):
+    @classmethod
+    def invalidate_caches(cls):
         """
-        Find a ModuleSpec for the given module / package name.
-
-        This can be called for one of two cases:
-
-          * Nothing in this module tree has been loaded, in which case we'll be
-            called for the top-level package name. In this case, we need to
-            patch the entire module tree, but that is handled by MockLoader.
+        Discard all cached find_real() results, and refresh the layer_index.
 
-          * An ancestor has been loaded but the finder for that ancestor either
-            is the MockFinder or it's one of the standard finders which can't
-            find the requested module.
+        This is called by `importlib.invalidate_caches()`, so tests which
+        create modules on disk at runtime should call that as usual.
         """
-        _debug("Searching for {}", fullname, color="cyan")
-        file_spec = self.find_real(fullname)
-        if file_spec:
-            return file_spec
+        cls._real_cache.clear()
+        cls._real_cache_state = None
+        layer_index.refresh()
 
-        # If nothing can be found on disk, then we're either being called as
+    @classmethod
+    def cache_info(cls):
+        """
+        Return the hit / miss statistics for the find_real() cache.
+        """
+        return FindRealCacheInfo(
+            cls._real_cache_hits, cls._real_cache_misses, len(cls._real_cache)
+        )
+
+    @classmethod
+    def cache_clear(cls):
+        """
+        Discard all cached find_real() results and reset the statistics.
+        """
+        cls.invalidate_caches()
+        cls._real_cache_hits = 0
+        cls._real_cache_misses = 0
+
+    @classmethod
+    def _find_real_uncached(cls, fullname):
+        # Defer to things actually on disk. This handles the case where one of
+        # the ancestors is a patched module, but the user is trying to import
+        # a real module. A common example of this is having charms.layer
+        # patched but wanting to import the charm's own lib code, from, e.g.,
+        # charms.layer.my_charm. We also have to skip this finder when
+        # searching to prevent infinite recursion, including any other copy of
+        # it, such as when pytest collects this module itself as a test file.
+        finders = [
+            finder
+            for finder in sys.meta_path
+            if hasattr(finder, "find_spec") and not hasattr(finder, "find_real")
+        ]
+        try:
+            file_spec = cls._walk_real(fullname, finders)
+        except KeyError:
+            # The standard PathFinder can't search inside a namespace package
+            # unless its parent has actually been imported.
+            file_spec = cls._find_real_hidden(fullname, finders)
+        if file_spec:
+            _debug("Found real module {}", fullname, color="green")
+        return file_spec
+
+    @staticmethod
+    def _walk_real(fullname, finders):
+        # Patched modules in sys.modules would prevent importlib.util.find_spec
+        # from working, so walk down the package tree ourselves instead: real
+        # packages which are already imported provide their own search path,
+        # while patched or not-yet-imported packages are looked up using the
+        # finders. Nothing is imported and sys.modules is left untouched.
+        path = None
+        for name in _ancestors(fullname) + (fullname,):
+            module = sys.modules.get(name)
+            if module is not None and not _is_patched(module):
+                spec = getattr(module, "__spec__", None)
+                search_path = getattr(module, "__path__", None)
+            else:
+                for finder in finders:
+                    import_trace.find_spec_calls += 1
+                    spec = finder.find_spec(name, path)
+                    if spec is not None:
+                        break
+                else:
+                    spec = None
+                search_path = spec and _search_locations(spec)
+            if spec is None:
+                return None
+            if name != fullname:
+                if search_path is None:
+                    # not a package, so it can't have submodules
+                    return None
+                path = search_path
+        return spec
+
+    @staticmethod
+    def _find_real_hidden(fullname, finders):
+        # To use the normal discovery method, we have to temporarily remove
+        # any patched modules from sys.modules, as well as this finder from
+        # sys.meta_path.
+        with _hide_patched_modules():
+            with patch("sys.meta_path", finders):
+                import_trace.find_spec_calls += 1
+                try:
+                    return importlib.util.find_spec(fullname)
+                except ModuleNotFoundError:
+                    return None
+
+    def find_spec(self, fullname, path, target=None):
+        """
+        Find a ModuleSpec for the given module / package name.
+
+        This can be called for one of two cases:
+
+          * Nothing in this module tree has been loaded, in which case we'll be
+            called for the top-level package name. In this case, we need to
+            patch the entire module tree, but that is handled by MockLoader.
+
+          * An ancestor has been loaded but the finder for that ancestor either
+            is the MockFinder or it's one of the standard finders which can't
+            find the requested module.
+        """
+        if not import_trace.enabled:
+            return self._find_spec(fullname)[0]
+        with import_trace.timed(fullname) as record:
+            spec, record.outcome, record.decided_by = self._find_spec(fullname)
+        return spec
+
+    def _find_spec(self, fullname):
+        # Returns the spec, along with whether it resolved to a "real" or
+        # "mocked" module (or is "missing"), and what decided that.
+        _debug("Searching for {}", fullname, color="cyan")
+        if layer_index.covers(fullname):
+            file_spec = layer_index.find_spec(fullname)
+            if file_spec:
+                return file_spec, "real", "layer_index"
+            # Otherwise, charms.layer is patched, so it will be mocked below.
+        else:
+            file_spec = self.find_real(fullname)
+            if file_spec:
+                return file_spec, "real", "find_real"
+
+        # If nothing can be found on disk, then we're either being called as
         # a last option for something that really should fail, or because an
         # ancestor was patched and the user is expecting to be able to import
         # a submodule. In the former case, we should just fail as well. In the
@@ -149,23 +1266,24 @@ class MockFinder:
         # a layer they depend on; since we don't want to have to explicitly
         # patch every possible layer, this allows us to auto-patch layers as
         # they're used.
-        for module_name in reversed(module_ancestors(fullname)):
+        for module_name in reversed(_ancestors(fullname)):
             existing_module = sys.modules.get(module_name)
             if not existing_module:
                 continue
-            if isinstance(existing_module, MagicMock):
+            if _is_patched(existing_module):
                 _debug(
                     "Found patched ancestor of {} at {}",
                     fullname,
                     module_name,
                     color="green",
                 )
-                return ModuleSpec(fullname, MockLoader)
+                return _mock_spec(fullname), "mocked", "patched_ancestor"
             # If we encounter a real module, we don't want to auto-mock
             # anything below it, even if an earlier ancestor is mocked.
-            break
+            _debug("No match found for {}", fullname, color="red")
+            return None, "missing", "real_ancestor"
         _debug("No match found for {}", fullname, color="red")
-        return None
+        return None, "missing", "no_patched_ancestor"
 
 
 class MockLoader:
@@ -186,6 +1304,9 @@ class MockLoader:
                         replacement = MagicMock.__getattribute__(parent, attr)
                     except AttributeError:
                         replacement = MagicMock.__getattr__(parent, attr)
+                elif isinstance(parent, MockModule):
+                    # Same as above, but MockModule creates children on access.
+                    replacement = getattr(parent, attr)
                 else:
                     replacement = MagicMock(name=fullname)
                     setattr(parent, attr, replacement)
@@ -198,27 +1319,53 @@ class MockLoader:
         if not hasattr(replacement, "__path__"):
             replacement.__name__ = fullname
             replacement.__path__ = []
-        if not hasattr(replacement, "__spec__"):
-            replacement.__spec__ = ModuleSpec(fullname, cls)
+        if getattr(replacement, "__spec__", None) is None:
+            if cls is MockLoader:
+                replacement.__spec__ = _mock_spec(fullname)
+            else:
+                replacement.__spec__ = ModuleSpec(fullname, cls)
+        global _patch_generation
+        _patch_generation += 1
+        _record_module(fullname)
         sys.modules[fullname] = replacement
+        _patched_modules[fullname] = replacement
         _debug("Patched {}", fullname, color="green")
         return replacement
 
 
-def patch_module(fullname, replacement=None):
+def patch_module(fullname, replacement=None, compact=False, record_calls="full"):
     """
     Patch a module (and potentially all of its parent packages).
+
+    If `compact` is true, a `MockModule` is used rather than a `MagicMock`
+    for the module and any parent packages which need to be patched.
+
+    The `record_calls` param sets how much the module and its children record
+    when called (see `MockModule`). A `MagicMock` always records every call,
+    so anything other than `"full"` requires `compact`.
     """
+    if not _valid_record_calls(record_calls):
+        raise ValueError("Invalid record_calls: {!r}".format(record_calls))
+    if record_calls != "full" and not compact:
+        raise ValueError("record_calls={!r} requires compact=True".format(record_calls))
     patched = []
 
     def _unpatch(*_):
+        global _patch_generation
+        _patch_generation += 1
         for module_name in patched:
+            _record_module(module_name)
             del sys.modules[module_name]
+            _patched_modules.pop(module_name, None)
 
-    for ancestor in module_ancestors(fullname):
+    for ancestor in _ancestors(fullname):
         if ancestor not in sys.modules:
-            MockLoader.load_module(ancestor)
+            MockLoader.load_module(
+                ancestor, MockModule(ancestor, record_calls) if compact else None
+            )
             patched.append(ancestor)
+    if compact and replacement is None:
+        replacement = MockModule(fullname, record_calls)
     patched.append(fullname)
     replacement = MockLoader.load_module(fullname, replacement)
     replacement.__enter__ = lambda s: replacement
@@ -247,6 +1394,150 @@ def patch_fixture(patch_target, new=DEFAULT, patch_opts=None, fixture_opts=None)
     return _fixture
 
 
+# Bumped whenever the format of the compiled manifests changes, so that stale
+# cache files are ignored.
+_MANIFEST_VERSION = 1
+_MANIFEST_SETTINGS = ("return_value", "side_effect", "value")
+
+
+def _cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "charms.unit_test")
+
+
+def _parse_manifest(data, path):
+    if path.endswith((".yaml", ".yml")):
+        # Optional dependency, only needed for YAML manifests.
+        import yaml
+
+        return yaml.safe_load(data)
+    return json.loads(data.decode("utf8"))
+
+
+def _compile_manifest(manifest):
+    """
+    Validate a manifest and flatten it into a sorted tuple of
+    `(module_name, ((attr, settings), ...))` entries.
+    """
+    if manifest is None:
+        return ()
+    if not isinstance(manifest, Mapping):
+        raise ValueError("Invalid manifest: expected a mapping of module names")
+    plan = []
+    for module_name, attrs in sorted(manifest.items()):
+        attrs = attrs or {}
+        if not isinstance(attrs, Mapping):
+            raise ValueError("Invalid manifest entry for {}".format(module_name))
+        entries = []
+        for attr, settings in sorted(attrs.items()):
+            settings = settings or {}
+            invalid = not isinstance(settings, Mapping) or (
+                set(settings) - set(_MANIFEST_SETTINGS)
+            )
+            if invalid:
+                raise ValueError(
+                    "Invalid manifest entry for {}.{}: expected a mapping of "
+                    "{}".format(module_name, attr, ", ".join(_MANIFEST_SETTINGS))
+                )
+            entries.append((attr, dict(settings)))
+        plan.append((module_name, tuple(entries)))
+    return tuple(plan)
+
+
+def _load_manifest(path, cache_dir):
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if cache_dir is False:
+        return _compile_manifest(_parse_manifest(data, path))
+    digest = hashlib.sha256(data)
+    digest.update("{}{}".format(_MANIFEST_VERSION, os.path.splitext(path)[1]).encode())
+    cache_path = os.path.join(
+        cache_dir or _cache_dir(),
+        "manifest-{}.pickle".format(digest.hexdigest()),
+    )
+    import pickle
+
+    try:
+        with open(cache_path, "rb") as fp:
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    plan = _compile_manifest(_parse_manifest(data, path))
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write then rename, so that concurrent sessions (such as
+        # pytest-xdist workers) never see a partial file.
+        tmp_path = "{}.{}".format(cache_path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(plan, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Not being able to cache it is not fatal.
+        pass
+    return plan
+
+
+def _resolve_reference(reference):
+    module_name, _, attrs = reference.partition(":")
+    obj = importlib.import_module(module_name)
+    for attr in attrs.split(".") if attrs else ():
+        obj = getattr(obj, attr)
+    return obj
+
+
+def patch_manifest(manifest, compact=True, cache_dir=None):
+    """
+    Patch the modules declared in a manifest, and configure their attributes.
+
+    The `manifest` is either a mapping, or the path to a JSON or YAML file
+    containing one, of module names to mappings of attribute names to their
+    settings, which can include a `return_value`, a `side_effect`, or a plain
+    `value`. A `side_effect` can be a list of values to return in turn, or a
+    `"module:attr"` reference to a callable or exception class.
+
+    Manifest files are compiled once and cached in `cache_dir` (by default,
+    under `$XDG_CACHE_HOME`), keyed by a hash of their contents, or not
+    cached at all if `cache_dir` is `False`.
+
+    Modules which aren't already patched are patched using `MockModule`,
+    unless `compact` is false. Returns a dict of the patched modules.
+    """
+    if isinstance(manifest, Mapping):
+        plan = _compile_manifest(manifest)
+    else:
+        plan = _load_manifest(str(manifest), cache_dir)
+    modules = {}
+    for module_name, entries in plan:
+        module = sys.modules.get(module_name)
+        if not _is_patched(module):
+            parent = sys.modules.get(module_name.rpartition(".")[0])
+            # Children of patched modules should come from the parent, in
+            # case they have already been referenced through it.
+            module = patch_module(
+                module_name, compact=compact and not _is_patched(parent)
+            )
+        for attr, settings in entries:
+            owner = module
+            *path, name = attr.split(".")
+            for part in path:
+                owner = getattr(owner, part)
+            if "value" in settings:
+                setattr(owner, name, settings["value"])
+                continue
+            target = getattr(owner, name)
+            if "return_value" in settings:
+                target.return_value = settings["return_value"]
+            side_effect = settings.get("side_effect")
+            if isinstance(side_effect, str):
+                side_effect = _resolve_reference(side_effect)
+            if side_effect is not None:
+                target.side_effect = side_effect
+        modules[module_name] = module
+    return modules
+
+
 class _UnitList(list):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -254,11 +1545,269 @@ class _UnitList(list):
         self.received_raw = self[0].received_raw if self else {}
 
 
+class RelationDataStats:
+    """
+    Counters for the JSON encoding and decoding of a `MockRelation`'s data.
+    """
+
+    __slots__ = (
+        "encodes",
+        "bytes_encoded",
+        "unchanged",
+        "bytes_unchanged",
+        "decodes",
+        "bytes_decoded",
+    )
+
+    def __init__(self):
+        self.encodes = 0
+        self.bytes_encoded = 0
+        self.unchanged = 0
+        self.bytes_unchanged = 0
+        self.decodes = 0
+        self.bytes_decoded = 0
+
+    def __repr__(self):
+        return "RelationDataStats({})".format(
+            ", ".join(
+                "{}={}".format(name, getattr(self, name)) for name in self.__slots__
+            )
+        )
+
+
+class JSONDataView(MutableMapping):
+    """
+    A view of raw relation data as JSON-decoded values, as the `to_publish`
+    and `received` data of a real `Endpoint` relation are.
+
+    Values are encoded as they are set, in the same way as the real thing,
+    and only decoded when read, with the decoded value cached for each key
+    until the raw value changes. The work done is counted in `stats`.
+    """
+
+    def __init__(self, raw, stats, writeable=True):
+        self.raw = raw
+        self.stats = stats
+        self.writeable = writeable
+        self._cache = {}
+
+    def __repr__(self):
+        return "<JSONDataView {!r}>".format(self.raw)
+
+    def __getitem__(self, key):
+        raw = self.raw[key]
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == raw:
+            return cached[1]
+        if not raw:
+            # As with the real view, including for empty strings.
+            return None
+        self.stats.decodes += 1
+        self.stats.bytes_decoded += len(raw)
+        value = _decode_value(raw)
+        self._cache[key] = (raw, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if not self.writeable:
+            raise ValueError("Remote data is read-only.")
+        encoded = json.dumps(value, sort_keys=True)
+        self.stats.encodes += 1
+        self.stats.bytes_encoded += len(encoded)
+        if self.raw.get(key) == encoded:
+            self.stats.unchanged += 1
+            self.stats.bytes_unchanged += len(encoded)
+            return
+        self.raw[key] = encoded
+        self._cache.pop(key, None)
+
+    def __delitem__(self, key):
+        if not self.writeable:
+            raise ValueError("Remote data is read-only.")
+        del self.raw[key]
+        self._cache.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+
+def _decode_value(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        # The real view also passes through data which isn't JSON.
+        return raw
+
+
+def _encode_data(data):
+    return {key: json.dumps(value, sort_keys=True) for key, value in data.items()}
+
+
+class MockUnit:
+    """
+    A compact remote unit on a `MockRelation`, with its own received data.
+    """
+
+    __slots__ = ("unit_name", "relation", "received", "received_raw")
+
+    def __init__(self, unit_name, relation=None, received=None, received_raw=None):
+        self.unit_name = unit_name
+        self.relation = relation
+        self.received_raw = {} if received_raw is None else received_raw
+        stats = getattr(relation, "data_stats", None)
+        if stats is not None:
+            if received:
+                self.received_raw.update(_encode_data(received))
+            self.received = JSONDataView(self.received_raw, stats, writeable=False)
+        else:
+            self.received = {} if received is None else received
+
+    def __repr__(self):
+        return "<MockUnit {}>".format(self.unit_name)
+
+
+class MockRelation:
+    """
+    A compact relation for a `MockEndpoint`, whose units are only created
+    when `joined_units` is first accessed.
+
+    If given, `received` and `received_raw` are called with the relation ID
+    and unit name to generate the initial data for each unit.
+
+    If `json_data` is true, `to_publish` and each unit's `received` are
+    `JSONDataView`s of the raw data, and `data_stats` counts the encoding and
+    decoding done through them.
+    """
+
+    __slots__ = (
+        "relation_id",
+        "application_name",
+        "to_publish",
+        "to_publish_raw",
+        "to_publish_app",
+        "to_publish_app_raw",
+        "received_app",
+        "received_app_raw",
+        "data_stats",
+        "_unit_count",
+        "_received",
+        "_received_raw",
+        "_units",
+    )
+
+    def __init__(
+        self,
+        relation_id,
+        units=1,
+        received=None,
+        received_raw=None,
+        application_name=None,
+        json_data=False,
+    ):
+        self.relation_id = relation_id
+        self.application_name = application_name or "remote-{}".format(
+            str(relation_id).rsplit(":", 1)[-1]
+        )
+        self.to_publish_raw = {}
+        self.to_publish_app_raw = {}
+        self.received_app_raw = {}
+        if json_data:
+            stats = self.data_stats = RelationDataStats()
+            self.to_publish = JSONDataView(self.to_publish_raw, stats)
+            self.to_publish_app = JSONDataView(self.to_publish_app_raw, stats)
+            self.received_app = JSONDataView(
+                self.received_app_raw, stats, writeable=False
+            )
+        else:
+            self.data_stats = None
+            self.to_publish = {}
+            self.to_publish_app = {}
+            self.received_app = {}
+        self._unit_count = units
+        self._received = received
+        self._received_raw = received_raw
+        self._units = None
+
+    def __repr__(self):
+        return "<MockRelation {}>".format(self.relation_id)
+
+    def _unit_len(self):
+        return self._unit_count if self._units is None else len(self._units)
+
+    @property
+    def joined_units(self):
+        if self._units is None:
+            self._units = _UnitList(self._make_unit(i) for i in range(self._unit_count))
+        return self._units
+
+    @property
+    def units(self):
+        return self.joined_units
+
+    def _make_unit(self, index):
+        unit_name = "{}/{}".format(self.application_name, index)
+        received = received_raw = None
+        if self._received is not None:
+            received = self._received(self.relation_id, unit_name)
+        if self._received_raw is not None:
+            received_raw = self._received_raw(self.relation_id, unit_name)
+        return MockUnit(unit_name, self, received, received_raw)
+
+
+class _JoinedUnitsView(Sequence):
+    """
+    A read-only view of all of the units across a list of relations, which
+    doesn't build or copy anything up front.
+    """
+
+    def __init__(self, relations):
+        self._relations = relations
+
+    def __len__(self):
+        return sum(relation._unit_len() for relation in self._relations)
+
+    def __iter__(self):
+        return chain.from_iterable(r.joined_units for r in self._relations)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for relation in self._relations:
+                count = relation._unit_len()
+                if index < count:
+                    return relation.joined_units[index]
+                index -= count
+        raise IndexError("unit index out of range")
+
+    def _first(self):
+        for relation in self._relations:
+            if relation._unit_len():
+                return relation.joined_units[0]
+        return None
+
+    @property
+    def received(self):
+        first = self._first()
+        return first.received if first else {}
+
+    @property
+    def received_raw(self):
+        first = self._first()
+        return first.received_raw if first else {}
+
+
 class MockEndpoint(MagicMock):
     def __init__(self, endpoint_name, relation_ids=None):
         super().__init__()
         self.is_joined = False
         self._endpoint_name = endpoint_name
+        self._json_data = False
         self.relations = []
         if relation_ids:
             self.relations = [
@@ -266,6 +1815,10 @@ class MockEndpoint(MagicMock):
                     relation_id=rel_id,
                     to_publish={},
                     to_publish_raw={},
+                    to_publish_app={},
+                    to_publish_app_raw={},
+                    received_app={},
+                    received_app_raw={},
                     joined_units=_UnitList([MagicMock(received={}, received_raw={})]),
                 )
                 for rel_id in relation_ids
@@ -274,6 +1827,39 @@ class MockEndpoint(MagicMock):
             chain.from_iterable(r.joined_units for r in self.relations)
         )
 
+    @classmethod
+    def from_relations(
+        cls,
+        endpoint_name,
+        relations,
+        received=None,
+        received_raw=None,
+        json_data=False,
+    ):
+        """
+        Create an endpoint using the compact `MockRelation` and `MockUnit`.
+
+        The `relations` can either be a list of relation IDs, each of which
+        will have a single unit, or a dict mapping relation IDs to the number
+        of units for each. If given, `received` and `received_raw` are called
+        with the relation ID and unit name to generate the data for each unit.
+        Units are only created when they are first accessed, and
+        `all_joined_units` is a view across all of the relations.
+
+        If `json_data` is true, the relations keep their data as JSON, as
+        with `MockRelation`.
+        """
+        if not isinstance(relations, Mapping):
+            relations = dict.fromkeys(relations, 1)
+        endpoint = cls(endpoint_name)
+        endpoint._json_data = json_data
+        endpoint.relations = [
+            MockRelation(rel_id, units, received, received_raw, json_data=json_data)
+            for rel_id, units in relations.items()
+        ]
+        endpoint.all_joined_units = _JoinedUnitsView(endpoint.relations)
+        return endpoint
+
     @property
     def endpoint_name(self):
         return self._endpoint_name
@@ -285,74 +1871,2928 @@ class MockEndpoint(MagicMock):
         return MagicMock(**kwargs)
 
 
+Delta = namedtuple("Delta", "previous current")
+
+
+def _delta(previous, mapping):
+    delta = {}
+    for key in mapping.keys() | previous.keys():
+        if key not in previous:
+            delta[key] = Delta(None, mapping[key])
+        elif key not in mapping:
+            delta[key] = Delta(previous[key], None)
+        elif mapping[key] != previous[key]:
+            delta[key] = Delta(previous[key], mapping[key])
+    return delta
+
+
 class MockKV(dict):
+    """
+    In-memory replacement for `charmhelpers.core.unitdata.Storage`.
+
+    Keys are kept in a sorted index as well, so that prefix queries such as
+    `getrange()` and `unsetrange()` only have to look at the matching keys.
+    New keys are appended to the index and it is only re-sorted when next
+    needed, so that loading lots of keys doesn't have to keep it sorted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._keys = sorted(dict.keys(self))
+        self._keys_sorted = True
+        self.revision = None
+        self._last_revision = 0
+        self._hook_journal = None
+        # Previous values of changed keys, one for each active snapshot or
+        # hook scope.
+        self._journals = []
+        # Logs of the reads and writes, one for each active stress test.
+        self._stress_logs = []
+        _kv_stores[id(self)] = self
+
+    def __reduce__(self):
+        # Ensure copies get their own index.
+        return (type(self), (dict(self),))
+
+    def _record(self, key):
+        for journal in self._journals:
+            if key not in journal:
+                journal[key] = dict.get(self, key, _MISSING)
+
+    def _undo(self, journal):
+        for key, value in journal.items():
+            # Any other active journals need to see this as a change, too.
+            self._record(key)
+            if value is _MISSING:
+                self._remove(key)
+            else:
+                self._store(key, value)
+        journal.clear()
+
+    def _detach(self, journal):
+        # Journals are dicts, so list.remove() could detach an equal one.
+        self._journals = [j for j in self._journals if j is not journal]
+
+    def _rollback(self, journal):
+        self._detach(journal)
+        self._undo(journal)
+
+    def _changed_keys(self, journal):
+        return [
+            key
+            for key, value in journal.items()
+            if dict.get(self, key, _MISSING) != value
+        ]
+
+    def _sorted_keys(self):
+        if not self._keys_sorted:
+            self._keys.sort()
+            self._keys_sorted = True
+        return self._keys
+
+    def _store(self, key, value):
+        if not dict.__contains__(self, key):
+            keys = self._keys
+            if self._keys_sorted and keys and key < keys[-1]:
+                self._keys_sorted = False
+            keys.append(key)
+        dict.__setitem__(self, key, value)
+        for log in self._stress_logs:
+            log.write(key, value)
+
+    def _remove(self, key):
+        if dict.__contains__(self, key):
+            keys = self._sorted_keys()
+            del keys[bisect_left(keys, key)]
+            dict.__delitem__(self, key)
+            for log in self._stress_logs:
+                log.write(key, _MISSING)
+
+    def _prefix_range(self, prefix):
+        keys = self._sorted_keys()
+        start = bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        return start, end
+
+    def __setitem__(self, key, value):
+        if self._journals:
+            self._record(key)
+        self._store(key, value)
+
+    def __delitem__(self, key):
+        if not dict.__contains__(self, key):
+            raise KeyError(key)
+        if self._journals:
+            self._record(key)
+        self._remove(key)
+
+    def pop(self, key, *default):
+        if not dict.__contains__(self, key):
+            return super().pop(key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self._keys:
+            raise KeyError("popitem(): dictionary is empty")
+        key = self._sorted_keys()[-1]
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, mapping=(), prefix="", **kwargs):
+        for key, value in chain(dict(mapping).items(), kwargs.items()):
+            self[prefix + key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        for key in list(self._keys):
+            del self[key]
+
+    def get(self, key, default=None, record=False):
+        for log in self._stress_logs:
+            log.read(key)
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        if record:
+            return Record(value)
+        return value
+
     def set(self, key, value):
         self[key] = value
+        return value
 
     def getrange(self, key_prefix, strip=False):
-        results = {}
+        start, end = self._prefix_range(key_prefix)
         strip_len = len(key_prefix) if strip else 0
-        for key, value in self.items():
-            if key.startswith(key_prefix):
-                results[key[strip_len:]] = value
-        return results
+        return {
+            key[strip_len:]: dict.__getitem__(self, key)
+            for key in self._keys[start:end]
+        }
 
     def unset(self, key):
         self.pop(key, None)
 
     def unsetrange(self, keys=None, prefix=""):
         if keys is None:
-            for key in [key for key in self.keys() if key.startswith(prefix)]:
-                del self[key]
+            start, end = self._prefix_range(prefix)
+            for key in self._keys[start:end]:
+                if self._journals:
+                    self._record(key)
+                dict.__delitem__(self, key)
+                for log in self._stress_logs:
+                    log.write(key, _MISSING)
+            del self._keys[start:end]
         else:
             for key in keys:
                 self.pop(prefix + key, None)
 
+    def delta(self, mapping, prefix):
+        """
+        Return a dict of `Delta(previous, current)` for each key in `mapping`
+        which differs from what is stored under `prefix`, including keys
+        which have been added or removed.
+        """
+        return _delta(self.getrange(prefix, strip=True), mapping)
+
+    @contextmanager
+    def hook_scope(self, name=""):
+        """
+        Scope changes to a hook, as `Storage.hook_scope()` does.
+
+        Changes made within the scope are discarded if it exits with an error.
+        """
+        assert not self.revision
+        self._last_revision += 1
+        self.revision = self._last_revision
+        self._hook_journal = {}
+        self._journals.append(self._hook_journal)
+        try:
+            yield self.revision
+        except Exception:
+            self._rollback(self._hook_journal)
+            raise
+        else:
+            self._detach(self._hook_journal)
+        finally:
+            self.revision = None
+            self._hook_journal = None
+
+    def flush(self, save=True):
+        """
+        Within a `hook_scope()`, either keep (the default) or discard changes
+        made since the scope started or was last flushed. Otherwise, does
+        nothing, since there is nothing to write.
+        """
+        if self._hook_journal is None:
+            return
+        if save:
+            self._hook_journal.clear()
+        else:
+            self._undo(self._hook_journal)
+
+    def close(self):
+        pass
 
-def patch_reactive():
+
+class ThreadSafeKV(MockKV):
     """
-    Setup the standard patches that any reactive charm will require.
+    A `MockKV` which can be used from several threads at once.
+
+    Changes, and queries which use the sorted index, are made under a lock
+    for each store, so that concurrent writes can't be lost or corrupt the
+    index. Reading a single key doesn't need the lock.
     """
-    patch_module("charms.templating")
 
-    charms_layer = AutoImportMockPackage(name="charms.layer")
-    charms_layer.import_layer_libs = MagicMock(name="import_layer_libs")
-    patch_module("charms.layer", charms_layer)
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        super().__init__(*args, **kwargs)
 
-    ch = patch_module("charmhelpers")
-    ch.core.hookenv.atexit = identity
-    ch.core.hookenv.charm_dir.return_value = "charm_dir"
-    ch.core.host.restart_on_change.return_value = identity
-    ch.core.unitdata.kv.return_value = MockKV()
-
-    reactive = patch_module("charms.reactive")
-    reactive.when.return_value = identity
-    reactive.when_all.return_value = identity
-    reactive.when_any.return_value = identity
-    reactive.when_not.return_value = identity
-    reactive.when_not_all.return_value = identity
-    reactive.when_none.return_value = identity
-    reactive.hook.return_value = identity
-    reactive.set_flag.side_effect = flags.add
-    reactive.clear_flag.side_effect = flags.discard
-    reactive.set_state.side_effect = flags.add
-    reactive.remove_state.side_effect = flags.discard
-    reactive.toggle_flag.side_effect = lambda f, s: (
-        flags.add(f) if s else flags.discard(f)
-    )
-    reactive.is_flag_set.side_effect = lambda f: f in flags
-    reactive.is_state.side_effect = lambda f: f in flags
-    reactive.get_flags.side_effect = lambda: sorted(flags)
-    reactive.get_unset_flags.side_effect = lambda *f: sorted(set(f) - flags)
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
 
-    reactive.Endpoint = MockEndpoint
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
 
-    os.environ["JUJU_MODEL_UUID"] = "test-1234"
-    os.environ["JUJU_UNIT_NAME"] = "test/0"
-    os.environ["JUJU_MACHINE_ID"] = "0"
-    os.environ["JUJU_AVAILABILITY_ZONE"] = ""
+    def pop(self, key, *default):
+        with self._lock:
+            return super().pop(key, *default)
 
-    return reactive
+    def popitem(self):
+        with self._lock:
+            return super().popitem()
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            return super().setdefault(key, default)
+
+    def update(self, mapping=(), prefix="", **kwargs):
+        with self._lock:
+            super().update(mapping, prefix, **kwargs)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+    def getrange(self, key_prefix, strip=False):
+        with self._lock:
+            return super().getrange(key_prefix, strip)
+
+    def unsetrange(self, keys=None, prefix=""):
+        with self._lock:
+            super().unsetrange(keys, prefix)
+
+    def flush(self, save=True):
+        with self._lock:
+            super().flush(save)
+
+    def _rollback(self, journal):
+        with self._lock:
+            super()._rollback(journal)
+
+
+class KVStats:
+    """
+    Counters for the work done by a `SQLiteKV` store.
+    """
+
+    __slots__ = ("queries", "bytes_serialized", "bytes_deserialized")
+
+    def __init__(self):
+        self.queries = 0
+        self.bytes_serialized = 0
+        self.bytes_deserialized = 0
+
+    def __repr__(self):
+        return "KVStats(queries={}, bytes_serialized={}, bytes_deserialized={})".format(
+            self.queries, self.bytes_serialized, self.bytes_deserialized
+        )
+
+
+class SQLiteKV:
+    """
+    SQLite-backed replacement for `charmhelpers.core.unitdata.Storage`.
+
+    This uses the same schema, queries, and JSON encoding as the real thing,
+    so that tests pay (and can measure, via `stats`) the same serialization
+    and query costs which the charm would in production. By default, the
+    database is kept in memory, but a `path` (e.g., on a tmpfs) can be given.
+    """
+
+    def __init__(self, path=":memory:"):
+        import sqlite3
+
+        self.db_path = path
+        self.conn = sqlite3.connect(path)
+        self.cursor = self.conn.cursor()
+        self.revision = None
+        self.stats = KVStats()
+        self._closed = False
+        # Previous serialized values of changed keys, one for each active
+        # PatchedStateSnapshot.
+        self._journals = []
+        self._init()
+        _kv_stores[id(self)] = self
+
+    def _init(self):
+        self.cursor.execute(
+            "create table if not exists kv " "(key text, data text, primary key (key))"
+        )
+        self.cursor.execute(
+            "create table if not exists kv_revisions "
+            "(key text, revision integer, data text, primary key (key, revision))"
+        )
+        self.cursor.execute(
+            "create table if not exists hooks "
+            "(version integer primary key autoincrement, hook text, date text)"
+        )
+        self.conn.commit()
+
+    def _execute(self, query, params=()):
+        self.stats.queries += 1
+        return self.cursor.execute(query, params)
+
+    def _serialize(self, value):
+        serialized = json.dumps(value)
+        self.stats.bytes_serialized += len(serialized)
+        return serialized
+
+    def _deserialize(self, serialized):
+        self.stats.bytes_deserialized += len(serialized)
+        return json.loads(serialized)
+
+    def _record(self, keys):
+        # Not counted in the stats, since the real Storage wouldn't do this.
+        for key in keys:
+            row = self.cursor.execute(
+                "select data from kv where key=?", [key]
+            ).fetchone()
+            for journal in self._journals:
+                if key not in journal:
+                    journal[key] = row[0] if row else _MISSING
+
+    def _detach(self, journal):
+        # Journals are dicts, so list.remove() could detach an equal one.
+        self._journals = [j for j in self._journals if j is not journal]
+
+    def _rollback(self, journal):
+        self._detach(journal)
+        if self._journals:
+            self._record(journal.keys())
+        for key, data in journal.items():
+            if data is _MISSING:
+                self.cursor.execute("delete from kv where key=?", [key])
+            else:
+                self.cursor.execute(
+                    "insert or replace into kv (key, data) values (?, ?)", (key, data)
+                )
+
+    def _changed_keys(self, journal):
+        changed = []
+        for key, data in journal.items():
+            row = self.cursor.execute(
+                "select data from kv where key=?", [key]
+            ).fetchone()
+            if (row[0] if row else _MISSING) != data:
+                changed.append(key)
+        return changed
+
+    def _save_revision(self, key, serialized):
+        if not self.revision:
+            return
+        exists = self._execute(
+            "select 1 from kv_revisions where key=? and revision=?",
+            [key, self.revision],
+        ).fetchone()
+        if not exists:
+            self._execute(
+                "insert into kv_revisions (revision, key, data) values (?, ?, ?)",
+                (self.revision, key, serialized),
+            )
+        else:
+            self._execute(
+                "update kv_revisions set data = ? where key = ? and revision = ?",
+                [serialized, key, self.revision],
+            )
+
+    def get(self, key, default=None, record=False):
+        result = self._execute("select data from kv where key=?", [key]).fetchone()
+        if not result:
+            return default
+        if record:
+            return Record(self._deserialize(result[0]))
+        return self._deserialize(result[0])
+
+    def getrange(self, key_prefix, strip=False):
+        result = self._execute(
+            "select key, data from kv where key like ?", ["{}%".format(key_prefix)]
+        ).fetchall()
+        strip_len = len(key_prefix) if strip else 0
+        return {key[strip_len:]: self._deserialize(data) for key, data in result}
+
+    def update(self, mapping, prefix=""):
+        for key, value in mapping.items():
+            self.set(prefix + key, value)
+
+    def set(self, key, value):
+        serialized = self._serialize(value)
+        exists = self._execute("select data from kv where key=?", [key]).fetchone()
+        # Skip mutations to the same value
+        if exists and exists[0] == serialized:
+            return value
+        if self._journals:
+            self._record([key])
+        if not exists:
+            self._execute("insert into kv (key, data) values (?, ?)", (key, serialized))
+        else:
+            self._execute("update kv set data = ? where key = ?", [serialized, key])
+        self._save_revision(key, serialized)
+        return value
+
+    def unset(self, key):
+        if self._journals:
+            self._record([key])
+        self._execute("delete from kv where key=?", [key])
+        if self.revision and self.cursor.rowcount:
+            self._execute(
+                "insert into kv_revisions values (?, ?, ?)",
+                [key, self.revision, self._serialize("DELETED")],
+            )
+
+    def unsetrange(self, keys=None, prefix=""):
+        if keys is not None:
+            keys = [prefix + key for key in keys]
+            if self._journals:
+                self._record(keys)
+            self._execute(
+                "delete from kv where key in ({})".format(",".join("?" * len(keys))),
+                keys,
+            )
+        else:
+            if self._journals:
+                self._record(
+                    key
+                    for (key,) in self.cursor.execute(
+                        "select key from kv where key like ?", ["{}%".format(prefix)]
+                    ).fetchall()
+                )
+            self._execute("delete from kv where key like ?", ["{}%".format(prefix)])
+        if self.revision and self.cursor.rowcount:
+            self._execute(
+                "insert into kv_revisions values (?, ?, ?)",
+                ["{}%".format(prefix), self.revision, self._serialize("DELETED")],
+            )
+
+    def delta(self, mapping, prefix):
+        """
+        Return a dict of `Delta(previous, current)` for each key in `mapping`
+        which differs from what is stored under `prefix`, including keys
+        which have been added or removed.
+        """
+        return _delta(self.getrange(prefix, strip=True), mapping)
+
+    @contextmanager
+    def hook_scope(self, name=""):
+        """
+        Scope changes to a hook, as `Storage.hook_scope()` does.
+
+        The hook is recorded as a new revision, under which the history of
+        changed keys is kept, and changes are committed when the scope exits,
+        or rolled back if it exits with an error.
+        """
+        assert not self.revision
+        self._execute(
+            "insert into hooks (hook, date) values (?, ?)",
+            (
+                name or sys.argv[0],
+                datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            ),
+        )
+        self.revision = self.cursor.lastrowid
+        try:
+            yield self.revision
+            self.revision = None
+        except Exception:
+            self.flush(False)
+            self.revision = None
+            raise
+        else:
+            self.flush()
+
+    def gethistory(self, key, deserialize=False):
+        result = self._execute(
+            "select kv_revisions.revision, kv_revisions.key, kv_revisions.data, "
+            "hooks.hook, hooks.date from kv_revisions, hooks "
+            "where kv_revisions.key=? and kv_revisions.revision=hooks.version",
+            [key],
+        ).fetchall()
+        if deserialize:
+            result = [
+                row[:2] + (self._deserialize(row[2]),) + row[3:] for row in result
+            ]
+        return result
+
+    def flush(self, save=True):
+        if save:
+            self.conn.commit()
+        elif self._closed:
+            return
+        else:
+            self.conn.rollback()
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush(False)
+        self.cursor.close()
+        self.conn.close()
+        self._closed = True
+
+    def reset_stats(self):
+        self.stats = KVStats()
+
+
+class Record(dict):
+    """
+    A dict with attribute access, as returned by `get(..., record=True)`.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+class MockConfig(MockKV):
+    """
+    In-memory replacement for `charmhelpers.core.hookenv.Config`.
+
+    As with the real thing, `changed()` and `previous()` compare against the
+    values as they were when `save()` was last called, and every key counts
+    as changed until then.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.implicit_save = True
+        self._prev_dict = None
+
+    def previous(self, key):
+        if self._prev_dict:
+            return self._prev_dict.get(key)
+        return None
+
+    def changed(self, key):
+        if self._prev_dict is None:
+            return True
+        return self.previous(key) != self.get(key)
+
+    def save(self):
+        self._prev_dict = dict(self)
+
+    def load_previous(self, path=None):
+        pass
+
+
+class HookEnvData:
+    """
+    In-memory data for the `hookenv` functions which access the config,
+    leadership, and relation data.
+
+    The `config` is a `MockConfig` and the `leader_settings` are a `MockKV`,
+    so both are covered by `PatchedStateSnapshot`. Relation data is read from
+    and written to the relations of the endpoints added with
+    `add_endpoint()`, so that it is consistent with what handlers see
+    through the endpoints themselves. Without `json_data`, though, writes
+    made directly to a relation's `to_publish` are not seen by
+    `relation_get()`, which reads `to_publish_raw`.
+    """
+
+    def __init__(self):
+        self.config = MockConfig()
+        self.leader_settings = MockKV()
+        self.is_leader = False
+        self.endpoints = {}
+        self._relations = {}
+        self._relation_count = 0
+        self._units = {}
+
+    def install(self, hookenv):
+        """
+        Replace the functions on the given (patched) `hookenv` module with
+        ones which use this data.
+        """
+        hookenv.config.side_effect = self.config_get
+        hookenv.is_leader.side_effect = lambda: self.is_leader
+        for name in (
+            "leader_get",
+            "leader_set",
+            "relation_get",
+            "relation_set",
+            "relation_ids",
+            "related_units",
+        ):
+            getattr(hookenv, name).side_effect = getattr(self, name)
+
+    def reset(self):
+        """
+        Clear all of the data and forget all of the endpoints.
+        """
+        self.config.clear()
+        self.config._prev_dict = None
+        self.leader_settings.clear()
+        self.is_leader = False
+        self.endpoints.clear()
+        self._relations.clear()
+        self._units.clear()
+
+    def add_endpoint(self, endpoint):
+        """
+        Make the relations of the given `MockEndpoint` available through the
+        relation functions.
+        """
+        self.endpoints[endpoint.endpoint_name] = endpoint
+        self._relation_count = None
+
+    def config_get(self, scope=None):
+        return self.config if scope is None else self.config.get(scope)
+
+    def leader_get(self, attribute=None):
+        if attribute is None:
+            return dict(self.leader_settings)
+        return self.leader_settings.get(attribute)
+
+    def leader_set(self, settings=None, **kwargs):
+        _set_settings(self.leader_settings, settings, kwargs)
+
+    def relation_ids(self, reltype=None):
+        reltype = reltype or os.environ.get("JUJU_RELATION")
+        endpoint = self.endpoints.get(reltype)
+        if endpoint is None:
+            return []
+        return [relation.relation_id for relation in endpoint.relations]
+
+    def related_units(self, relid=None):
+        relation = self._relation(relid)
+        if relation is None:
+            return []
+        return [unit.unit_name for unit in relation.joined_units]
+
+    def relation_get(self, attribute=None, unit=None, rid=None, app=None):
+        relation = self._relation(rid)
+        if relation is None:
+            return None
+        unit = unit or os.environ.get("JUJU_REMOTE_UNIT")
+        local_unit = os.environ.get("JUJU_UNIT_NAME")
+        if app is not None:
+            # Each relation only has the one remote application.
+            if app == (local_unit or "").split("/")[0]:
+                data = relation.to_publish_app_raw
+            else:
+                data = relation.received_app_raw
+        elif unit == local_unit:
+            data = relation.to_publish_raw
+        else:
+            remote_unit = self._unit(relation, unit)
+            if remote_unit is None:
+                return None
+            data = remote_unit.received_raw
+        return dict(data) if attribute is None else data.get(attribute)
+
+    def relation_set(
+        self, relation_id=None, relation_settings=None, app=False, **kwargs
+    ):
+        relation = self._relation(relation_id)
+        if relation is None:
+            raise KeyError("Unknown relation: {}".format(relation_id))
+        if app:
+            raw, data = relation.to_publish_app_raw, relation.to_publish_app
+        else:
+            raw, data = relation.to_publish_raw, relation.to_publish
+        _set_settings(raw, relation_settings, kwargs)
+        if not isinstance(data, JSONDataView):
+            # Without json_data, the decoded data is a separate dict, which is
+            # kept in step, as a real relation's view of the raw data would be.
+            for key in dict(relation_settings or {}, **kwargs):
+                if key in raw:
+                    data[key] = _decode_value(raw[key])
+                else:
+                    data.pop(key, None)
+
+    def _relation(self, rid):
+        rid = rid or os.environ.get("JUJU_RELATION_ID")
+        # Relations may have been added or removed directly on the endpoints,
+        # in which case the index needs to be rebuilt.
+        count = sum(len(endpoint.relations) for endpoint in self.endpoints.values())
+        if count != self._relation_count:
+            self._relation_count = count
+            self._relations = {
+                relation.relation_id: relation
+                for endpoint in self.endpoints.values()
+                for relation in endpoint.relations
+            }
+            self._units.clear()
+        return self._relations.get(rid)
+
+    def _unit(self, relation, unit_name):
+        units = relation.joined_units
+        cached = self._units.get(relation.relation_id)
+        if cached is None or cached[0] is not units or cached[1] != len(units):
+            cached = (units, len(units), {unit.unit_name: unit for unit in units})
+            self._units[relation.relation_id] = cached
+        return cached[2].get(unit_name)
+
+
+def _set_settings(data, settings, kwargs):
+    # As with the real hook tools, values are stored as strings and setting
+    # a value to None or "" removes it.
+    for key, value in dict(settings or {}, **kwargs).items():
+        if value is None or value == "":
+            data.pop(key, None)
+        else:
+            data[key] = str(value)
+
+
+hookenv_data = HookEnvData()
+
+
+# Tests for each kind of flag predicate, given the flags it names and the set
+# of currently set flags.
+_PREDICATES = {
+    "when": lambda names, current: all(name in current for name in names),
+    "when_all": lambda names, current: all(name in current for name in names),
+    "when_any": lambda names, current: any(name in current for name in names),
+    "when_not": lambda names, current: not any(name in current for name in names),
+    "when_none": lambda names, current: not any(name in current for name in names),
+    "when_not_all": lambda names, current: not all(name in current for name in names),
+}
+
+DispatchStats = namedtuple("DispatchStats", "iterations invoked")
+ExploreReport = namedtuple(
+    "ExploreReport", "states transitions crashes violations truncated"
+)
+Crash = namedtuple("Crash", "flags handler error")
+Violation = namedtuple("Violation", "flags invariant message")
+StressReport = namedtuple(
+    "StressReport", "runs workers seconds throughput errors races"
+)
+
+# The Dispatcher being explored, for the worker processes to find the handlers.
+_exploring = None
+
+
+class Handler:
+    """
+    A reactive handler registered with a `Dispatcher`, along with the
+    predicates from all of the decorators applied to it.
+    """
+
+    __slots__ = ("func", "predicates", "hooks", "flags", "order", "last_run")
+
+    def __init__(self, func, order):
+        self.func = func
+        self.predicates = []
+        self.hooks = []
+        self.flags = set()
+        self.order = order
+        self.last_run = None
+
+    def __repr__(self):
+        return "<Handler {}:{}>".format(self.func.__module__, self.func.__qualname__)
+
+    def test(self, current_flags, hook_name=None):
+        if self.hooks:
+            if hook_name is None:
+                return False
+            if not any(fnmatch(hook_name, pattern) for pattern in self.hooks):
+                return False
+        return all(
+            _PREDICATES[kind](names, current_flags) for kind, names in self.predicates
+        )
+
+
+class Dispatcher:
+    """
+    Simulates the reactive dispatch loop, using the in-memory `flags`.
+
+    When installed by `patch_reactive(dispatch=True)`, the `@when*()` and
+    `@hook()` decorators register handlers here (while still leaving the
+    functions themselves unchanged, so they can also be called directly).
+    Handlers are indexed by the flags they depend on, so that after each
+    handler runs, only the handlers depending on the flags it changed are
+    tested again.
+    """
+
+    def __init__(self, max_iterations=100):
+        self.max_iterations = max_iterations
+        self.handlers = {}
+        self._index = {}
+        self._flag_changed = {}
+        self._clock = 0
+        self._timings = None
+        self._next_order = 0
+
+    def decorator(self, kind):
+        """
+        Return a replacement for the given reactive decorator (e.g., `"when"`
+        or `"hook"`) which registers handlers with this dispatcher.
+        """
+
+        def _decorator(*args):
+            def _register(func):
+                self.register(func, kind, args)
+                return func
+
+            return _register
+
+        return _decorator
+
+    def register(self, func, kind, args):
+        """
+        Register a handler function with a predicate of the given kind.
+        """
+        parts = func.__qualname__.split(".")
+        if len(parts) > 1 and parts[-2] != "<locals>":
+            # Endpoint methods need an instance, so can't be dispatched.
+            return
+        key = (func.__module__, func.__qualname__)
+        handler = self.handlers.get(key)
+        if handler is None:
+            handler = self.handlers[key] = Handler(func, self._next_order)
+            self._next_order += 1
+        elif handler.func is not func:
+            # The module was reloaded, so replace the old handler in its place.
+            self._unindex(handler)
+            handler = self.handlers[key] = Handler(func, handler.order)
+        if kind == "hook":
+            handler.hooks.extend(args)
+        else:
+            handler.predicates.append((kind, args))
+            for name in args:
+                if name not in handler.flags:
+                    handler.flags.add(name)
+                    self._index.setdefault(name, []).append(handler)
+
+    def _unindex(self, handler):
+        for name in handler.flags:
+            self._index[name].remove(handler)
+
+    def reset(self):
+        """
+        Forget all registered handlers.
+        """
+        self.handlers.clear()
+        self._index.clear()
+        self._next_order = 0
+
+    def forget_module(self, module_name):
+        """
+        Forget the handlers registered by the given module.
+        """
+        for key, handler in list(self.handlers.items()):
+            if key[0] == module_name:
+                self._unindex(handler)
+                del self.handlers[key]
+
+    def _changed(self, journal):
+        # Only the flags which ended up different from before their first
+        # transition have changed, rather than every flag in the journal.
+        first = {}
+        for transition in journal:
+            first.setdefault(transition.flag, transition.set)
+        changed = {
+            flag
+            for flag, is_set in first.items()
+            if set.__contains__(flags, flag) == is_set
+        }
+        if changed:
+            self._clock += 1
+            for name in changed:
+                self._flag_changed[name] = self._clock
+        return changed
+
+    def _eligible(self, handler):
+        if handler.last_run is None:
+            return True
+        # Handlers only run again if a flag they depend on has changed since.
+        return any(
+            self._flag_changed.get(name, 0) > handler.last_run for name in handler.flags
+        )
+
+    def dispatch(self, hook_name=None, timings=None):
+        """
+        Run the handlers whose predicates are satisfied by the current
+        `flags`, repeating until no more handlers are ready to run.
+
+        If `hook_name` is given, `@hook()` handlers matching it are run
+        first, as they would be in a real hook invocation.
+
+        If `timings` is given, it should be a dict, which is updated with a
+        `[calls, seconds]` list for each handler function which is run.
+
+        Returns a `DispatchStats(iterations, invoked)` tuple, where `invoked`
+        is the list of handler functions in the order they were run.
+        """
+        self._timings = timings
+        self._flag_changed.clear()
+        self._clock = 0
+        handlers = sorted(self.handlers.values(), key=lambda h: h.order)
+        for handler in handlers:
+            handler.last_run = None
+        invoked = []
+        if hook_name is not None:
+            for handler in handlers:
+                if handler.hooks and handler.test(flags, hook_name):
+                    self._invoke(handler, invoked)
+        candidates = [handler for handler in handlers if not handler.hooks]
+        iterations = 0
+        while candidates:
+            iterations += 1
+            if iterations > self.max_iterations:
+                raise RuntimeError(
+                    "Dispatch did not settle after {} iterations; last "
+                    "candidates: {}".format(self.max_iterations, candidates)
+                )
+            changed = set()
+            for handler in candidates:
+                if self._eligible(handler) and handler.test(flags):
+                    changed |= self._invoke(handler, invoked)
+            # Only the handlers depending on changed flags need to be tested
+            # again.
+            retest = set()
+            for name in changed:
+                retest.update(self._index.get(name, ()))
+            candidates = sorted(
+                (handler for handler in retest if not handler.hooks),
+                key=lambda h: h.order,
+            )
+        return DispatchStats(iterations, invoked)
+
+    def explore(
+        self, initial=((),), invariants=(), max_states=10000, prune=True, workers=None
+    ):
+        """
+        Explore the flag states reachable from the `initial` states by running
+        the handlers whose predicates each state satisfies, checking each new
+        state against the `invariants`.
+
+        Each handler is run from each state it is eligible in, to find the
+        states it leads to. States which only differ in flags which none of
+        the handlers' predicates depend on are considered equivalent, unless
+        `prune` is false, and exploration stops after `max_states` distinct
+        states. Each step of the search is run across a process pool of
+        `workers` processes (by default, one per CPU), where forking is
+        supported, or in this process if `workers` is 0.
+
+        Each handler is run within a `PatchedStateSnapshot`, so that any
+        other state it changes, such as unitdata or `hookenv_data`, doesn't
+        carry over to other steps or to the caller.
+
+        An invariant is a callable which is given the flags as a frozenset
+        and which either returns a false value or raises an `AssertionError`
+        if they are invalid.
+
+        Returns an `ExploreReport(states, transitions, crashes, violations,
+        truncated)`, where `crashes` is a list of `Crash(flags, handler,
+        error)` for each handler which raised an exception, and `violations`
+        is a list of `Violation(flags, invariant, message)`.
+        """
+        global _exploring
+        handlers = [(k, h) for k, h in self.handlers.items() if not h.hooks]
+        handlers.sort(key=lambda item: item[1].order)
+        relevant = frozenset(chain.from_iterable(h.flags for _, h in handlers))
+        seen = {}
+        states = []
+        crashes = []
+        violations = []
+        transitions = 0
+        truncated = False
+
+        def _add(state):
+            nonlocal truncated
+            key = state & relevant if prune else state
+            if key in seen:
+                return False
+            if len(seen) >= max_states:
+                truncated = True
+                return False
+            seen[key] = state
+            states.append(state)
+            for invariant in invariants:
+                try:
+                    message = None if invariant(state) else "returned False"
+                except AssertionError as e:
+                    message = str(e) or "AssertionError"
+                if message:
+                    name = getattr(invariant, "__name__", repr(invariant))
+                    violations.append(Violation(state, name, message))
+            return True
+
+        frontier = [frozenset(state) for state in initial if _add(frozenset(state))]
+        import concurrent.futures
+        import multiprocessing
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if "fork" not in multiprocessing.get_all_start_methods():
+            workers = 0
+        previous_flags = set(flags)
+        _exploring = self
+        executor = None
+        try:
+            if workers:
+                # The mp_context argument is only accepted from python 3.7,
+                # but before then, fork is the default where it's supported.
+                options = {}
+                if sys.version_info >= (3, 7):
+                    options["mp_context"] = multiprocessing.get_context("fork")
+                executor = concurrent.futures.ProcessPoolExecutor(workers, **options)
+            while frontier and not truncated:
+                tasks = [
+                    (key, state)
+                    for state in frontier
+                    for key, handler in handlers
+                    if handler.test(state)
+                ]
+                if executor:
+                    chunksize = max(1, len(tasks) // (workers * 4))
+                    results = executor.map(_explore_step, tasks, chunksize=chunksize)
+                else:
+                    results = map(_explore_step, tasks)
+                frontier = []
+                for state, key, result, error in results:
+                    transitions += 1
+                    if error is not None:
+                        crashes.append(Crash(state, self.handlers[key], error))
+                    elif _add(result):
+                        frontier.append(result)
+        finally:
+            if executor:
+                executor.shutdown()
+            _exploring = None
+            flags.clear()
+            flags.update(previous_flags)
+        return ExploreReport(states, transitions, crashes, violations, truncated)
+
+    def stress(self, handlers=None, iterations=100, workers=8, switch_interval=1e-6):
+        """
+        Run handlers concurrently, to find races between them or with the
+        patched reactive state.
+
+        Each of `workers` threads runs each of the given `handlers` (handler
+        functions, or by default, all of the registered handlers), regardless
+        of their predicates, `iterations` times. Meanwhile, `flags` is made
+        threadsafe, and the interpreter's thread switch interval is lowered,
+        so that threads are interleaved
+        much more often than usual.
+
+        Afterwards, the `flags` are checked against the transitions made to
+        them, and each `MockKV` store against the writes made to it, to find
+        updates which were lost or not seen, or indexes which were corrupted.
+
+        Returns a `StressReport(runs, workers, seconds, throughput, errors,
+        races)`, where `throughput` is the handler runs per second, `errors`
+        is a list of `(func, traceback)` for each exception raised, and
+        `races` is a list of descriptions of the problems found.
+        """
+        import concurrent.futures
+
+        if handlers is None:
+            handlers = sorted(self.handlers.values(), key=lambda h: h.order)
+            handlers = [handler.func for handler in handlers]
+        by_func = {handler.func: handler for handler in self.handlers.values()}
+        stores = [
+            store for store in list(_kv_stores.values()) if isinstance(store, MockKV)
+        ]
+        logs = [_StressLog() for _ in stores]
+        for store, log in zip(stores, logs):
+            store._stress_logs = store._stress_logs + [log]
+        initial = set(flags)
+        errors = []
+        barrier = threading.Barrier(workers)
+
+        def _worker():
+            barrier.wait()
+            for _ in range(iterations):
+                for func in handlers:
+                    flags.cause = by_func.get(func, func)
+                    for log in logs:
+                        log.begin()
+                    try:
+                        func()
+                    except Exception:
+                        errors.append((func, traceback.format_exc()))
+            flags.cause = None
+
+        previous_threadsafe, flags.threadsafe = flags.threadsafe, True
+        previous_interval = sys.getswitchinterval()
+        sys.setswitchinterval(switch_interval)
+        try:
+            with flags.journaled() as journal:
+                with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                    start = perf_counter()
+                    for future in [executor.submit(_worker) for _ in range(workers)]:
+                        future.result()
+                    seconds = perf_counter() - start
+        finally:
+            sys.setswitchinterval(previous_interval)
+            flags.threadsafe = previous_threadsafe
+            for store, log in zip(stores, logs):
+                store._stress_logs = [
+                    other for other in store._stress_logs if other is not log
+                ]
+        races = _flag_races(initial, journal)
+        for store, log in zip(stores, logs):
+            races.extend(_kv_races(store, log))
+        runs = workers * iterations * len(handlers)
+        return StressReport(
+            runs, workers, seconds, runs / seconds if seconds else 0.0, errors, races
+        )
+
+    def _invoke(self, handler, invoked):
+        self._clock += 1
+        handler.last_run = self._clock
+        invoked.append(handler.func)
+        cause, flags.cause = flags.cause, handler
+        try:
+            with flags.journaled() as journal:
+                if self._timings is None:
+                    handler.func()
+                else:
+                    start = perf_counter()
+                    try:
+                        handler.func()
+                    finally:
+                        timing = self._timings.setdefault(handler.func, [0, 0.0])
+                        timing[0] += 1
+                        timing[1] += perf_counter() - start
+        finally:
+            flags.cause = cause
+        return self._changed(journal)
+
+
+def _explore_step(task):
+    # Runs a single handler from the given flag state, possibly in a worker
+    # process, and returns the resulting state or the error it raised.
+    # Everything else the handler changes, such as unitdata, is restored
+    # afterwards, so that every step starts from the same state.
+    key, state = task
+    with PatchedStateSnapshot():
+        flags.clear()
+        flags.update(state)
+        try:
+            _exploring.handlers[key].func()
+        except Exception:
+            return state, key, None, traceback.format_exc()
+        return state, key, frozenset(flags), None
+
+
+def _flag_races(initial, journal):
+    # Replays the transitions to find flags whose final state doesn't match.
+    expected = set(initial)
+    for transition in journal:
+        if transition.set:
+            expected.add(transition.flag)
+        else:
+            expected.discard(transition.flag)
+    actual = set(set.__iter__(flags))
+    races = [
+        "lost flag update: {} was last {} but is {}".format(
+            flag,
+            "set" if flag in expected else "cleared",
+            "set" if flag in actual else "not set",
+        )
+        for flag in sorted(expected ^ actual)
+    ]
+    if len(flags._names) != len(actual) or set(flags._names) != actual:
+        races.append("flag index out of sync with flags")
+    return races
+
+
+class _StressLog:
+    # The writes made to a MockKV during a stress test, and the keys written
+    # by a handler which another handler had written to since it read them.
+
+    def __init__(self):
+        self.writes = []
+        self.versions = {}
+        self.lost = []
+        self._local = threading.local()
+        # The workers share the log, so it must not race itself.
+        self._lock = threading.Lock()
+
+    def begin(self):
+        self._local.reads = {}
+
+    def read(self, key):
+        reads = getattr(self._local, "reads", None)
+        if reads is not None:
+            with self._lock:
+                reads[key] = self.versions.get(key, 0)
+
+    def write(self, key, value):
+        reads = getattr(self._local, "reads", None)
+        with self._lock:
+            version = self.versions.get(key, 0)
+            if reads is not None:
+                if reads.get(key, version) != version:
+                    self.lost.append(key)
+                reads[key] = version + 1
+            self.versions[key] = version + 1
+            self.writes.append((key, value))
+
+
+def _kv_races(store, log):
+    # Finds keys whose final value isn't the last one written to them, and
+    # writes which were based on reads of a value which had since changed.
+    name = type(store).__name__
+    last = {}
+    for key, value in log.writes:
+        last[key] = value
+    races = [
+        "{} write of {!r} based on a stale read ({} times)".format(
+            name, key, log.lost.count(key)
+        )
+        for key in sorted(set(log.lost))
+    ]
+    for key, value in sorted(last.items()):
+        current = dict.get(store, key, _MISSING)
+        if current is not value and current != value:
+            races.append(
+                "{} {} of {!r} not seen".format(
+                    name, "delete" if value is _MISSING else "write", key
+                )
+            )
+    keys = set(dict.keys(store))
+    if len(store._keys) != len(keys) or set(store._keys) != keys:
+        races.append("{} index out of sync with keys".format(name))
+    return races
+
+
+dispatcher = Dispatcher()
+
+
+_SCAN_VERSION = 2
+
+# The functions, as called by a handler, which set and clear flags.
+_FLAG_SETTERS = {"set_flag", "set_state"}
+_FLAG_CLEARERS = {"clear_flag", "remove_state"}
+
+# Flags which are set by the reactive framework and base layers, rather than
+# by handlers, so which aren't expected to be set by any scanned handler.
+FRAMEWORK_FLAGS = ("config.*", "endpoint.*", "leadership.*", "*{endpoint_name}*")
+
+StaticHandler = namedtuple(
+    "StaticHandler", "module name path line predicates hooks sets clears"
+)
+
+
+def _call_name(node):
+    import ast
+
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+def _flag_arg(node):
+    # A flag name given as a literal, or through Endpoint.expand_name().
+    import ast
+
+    if isinstance(node, ast.Call) and _call_name(node) == "expand_name" and node.args:
+        node = node.args[0]
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if sys.version_info < (3, 8) and isinstance(node, ast.Str):
+        # Literals are only parsed as ast.Constant from python 3.8
+        return node.s
+    return None
+
+
+def _literal_args(call):
+    import ast
+
+    args = []
+    for arg in call.args:
+        if isinstance(arg, (ast.List, ast.Tuple)):
+            args.extend(_flag_arg(elt) for elt in arg.elts)
+        else:
+            args.append(_flag_arg(arg))
+    return tuple(arg for arg in args if arg is not None)
+
+
+_FlagCalls = namedtuple("_FlagCalls", "sets clears calls")
+
+
+def _flag_calls(statements):
+    # The flags set and cleared by the calls in the statements, in the order
+    # ast.NodeVisitor would visit them, and the other functions called.
+    import ast
+
+    flag_calls = _FlagCalls([], [], set())
+    pending = list(reversed(statements))
+    while pending:
+        node = pending.pop()
+        pending.extend(reversed(list(ast.iter_child_nodes(node))))
+        if not isinstance(node, ast.Call):
+            continue
+        name = _call_name(node)
+        flag = _flag_arg(node.args[0]) if node.args else None
+        if flag is not None and name in _FLAG_SETTERS:
+            flag_calls.sets.append(flag)
+        elif flag is not None and name in _FLAG_CLEARERS:
+            flag_calls.clears.append(flag)
+        elif flag is not None and name == "toggle_flag":
+            flag_calls.sets.append(flag)
+            flag_calls.clears.append(flag)
+        elif isinstance(node.func, ast.Name):
+            flag_calls.calls.add(name)
+    return flag_calls
+
+
+def _def_line(node, lines):
+    # Before python 3.8, a decorated function's lineno is its first decorator's.
+    if sys.version_info >= (3, 8) or not node.decorator_list:
+        return node.lineno
+    for lineno in range(node.decorator_list[-1].lineno, len(lines) + 1):
+        if lines[lineno - 1].lstrip().startswith((b"def ", b"async def ")):
+            return lineno
+    return node.lineno
+
+
+def _scan_source(source, path):
+    """
+    Return `(name, line, predicates, hooks, sets, clears)` for each
+    module-level function in the source which is decorated as a handler.
+
+    Flags set or cleared by other functions in the same module which a
+    handler calls are included in its `sets` and `clears`.
+    """
+    import ast
+
+    tree = ast.parse(source, path)
+    functions = {}
+    decorated = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        functions[node.name] = _flag_calls(node.body)
+        predicates = []
+        hooks = []
+        for decorator in node.decorator_list:
+            if not isinstance(decorator, ast.Call):
+                continue
+            kind = _call_name(decorator)
+            if kind == "hook":
+                hooks.extend(_literal_args(decorator))
+            elif kind in _PREDICATES:
+                predicates.append((kind, _literal_args(decorator)))
+        if predicates or hooks:
+            decorated.append((node, tuple(predicates), tuple(hooks)))
+    lines = source.splitlines()
+    handlers = []
+    for node, predicates, hooks in decorated:
+        sets, clears = [], []
+        seen = set()
+        pending = [node.name]
+        while pending:
+            name = pending.pop()
+            if name in seen or name not in functions:
+                continue
+            seen.add(name)
+            sets.extend(functions[name].sets)
+            clears.extend(functions[name].clears)
+            pending.extend(sorted(functions[name].calls))
+        handlers.append(
+            (
+                node.name,
+                _def_line(node, lines),
+                predicates,
+                hooks,
+                tuple(dict.fromkeys(sets)),
+                tuple(dict.fromkeys(clears)),
+            )
+        )
+    return tuple(handlers)
+
+
+def _scan_file(path, cache_dir, memo):
+    with open(path, "rb") as fp:
+        data = fp.read()
+    digest = hashlib.sha256(data)
+    digest.update(str(_SCAN_VERSION).encode())
+    key = digest.hexdigest()
+    if key in memo:
+        return memo[key]
+    import pickle
+
+    cache_path = None
+    if cache_dir is not False:
+        cache_path = os.path.join(
+            cache_dir or _cache_dir(), "handlers-{}.pickle".format(key)
+        )
+        try:
+            with open(cache_path, "rb") as fp:
+                memo[key] = pickle.load(fp)
+                return memo[key]
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+    handlers = memo[key] = _scan_source(data, path)
+    if cache_path is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = "{}.{}".format(cache_path, os.getpid())
+            with open(tmp_path, "wb") as fp:
+                pickle.dump(handlers, fp, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return handlers
+
+
+def _handler_files(root):
+    # The reactive modules, and the charms.layer libraries, of a charm or
+    # layer source directory, with their module names.
+    reactive_dir = os.path.join(root, "reactive")
+    if os.path.isdir(reactive_dir):
+        for filename in sorted(os.listdir(reactive_dir)):
+            if filename.endswith(".py") and filename != "__init__.py":
+                yield "reactive." + filename[:-3], os.path.join(reactive_dir, filename)
+    lib_dir = os.path.join(root, "lib", "charms", "layer")
+    for dirpath, dirnames, filenames in os.walk(lib_dir):
+        dirnames.sort()
+        package = os.path.relpath(dirpath, os.path.join(root, "lib"))
+        package = package.replace(os.sep, ".")
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            if filename == "__init__.py":
+                name = package
+            else:
+                name = package + "." + filename[:-3]
+            yield name, os.path.join(dirpath, filename)
+
+
+# Compiled results of scanning files, by content hash, for this process.
+_scan_memo = {}
+
+
+def scan_handlers(roots=None, cache_dir=None):
+    """
+    Statically scan the reactive handlers of the given charm or layer source
+    directories, without importing anything, and return a `HandlerGraph`.
+
+    The `reactive/` modules and `lib/charms/layer` libraries of each root are
+    parsed, and each module-level function decorated with `@when*()` or
+    `@hook()` is recorded as a `StaticHandler`, along with the flags its
+    decorators name (only those given as literal strings) and the flags set
+    or cleared by the `set_flag()`, `clear_flag()`, etc. calls it makes,
+    directly or through other functions in the same module.
+
+    By default, the roots are the directories in the `layer_index`, along
+    with the layers they include. The results for each file are cached by a
+    hash of its contents, both in memory and in `cache_dir` (by default,
+    under `$XDG_CACHE_HOME`), unless `cache_dir` is `False`.
+    """
+    if roots is None:
+        roots = layer_index._layers()
+    handlers = []
+    for root in roots:
+        for module_name, path in _handler_files(os.path.abspath(str(root))):
+            for entry in _scan_file(path, cache_dir, _scan_memo):
+                handlers.append(StaticHandler(module_name, entry[0], path, *entry[1:]))
+    return HandlerGraph(handlers)
+
+
+class HandlerGraph:
+    """
+    The flag dependencies between statically scanned handlers.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.setters = {}
+        self.clearers = {}
+        self.readers = {}
+        for handler in self.handlers:
+            for flag in handler.sets:
+                self.setters.setdefault(flag, []).append(handler)
+            for flag in handler.clears:
+                self.clearers.setdefault(flag, []).append(handler)
+            for _, names in handler.predicates:
+                for flag in names:
+                    self.readers.setdefault(flag, []).append(handler)
+
+    def edges(self):
+        """
+        Return `(handler, flag, handler)` for each handler which sets or
+        clears a flag which another handler's predicates depend on.
+        """
+        edges = []
+        for flag, readers in sorted(self.readers.items()):
+            writers = self.setters.get(flag, []) + self.clearers.get(flag, [])
+            for writer in dict.fromkeys(writers):
+                for reader in readers:
+                    if reader is not writer:
+                        edges.append((writer, flag, reader))
+        return edges
+
+    def _external(self, flag, external):
+        return any(fnmatch(flag, pattern) for pattern in external)
+
+    def unset_flags(self, external=FRAMEWORK_FLAGS):
+        """
+        Return the sorted flags which handlers depend on but which none of
+        them set, other than those matching the `external` patterns.
+        """
+        return sorted(
+            flag
+            for flag in self.readers
+            if flag not in self.setters and not self._external(flag, external)
+        )
+
+    def dead_handlers(self, external=FRAMEWORK_FLAGS):
+        """
+        Return the handlers which can never run, because they require a
+        flag which nothing sets (see `unset_flags()`).
+        """
+        unset = set(self.unset_flags(external))
+        dead = []
+        for handler in self.handlers:
+            for kind, names in handler.predicates:
+                if kind in ("when", "when_all") and unset.intersection(names):
+                    dead.append(handler)
+                    break
+                if kind == "when_any" and names and unset.issuperset(names):
+                    dead.append(handler)
+                    break
+        return dead
+
+    def report_lines(self, external=FRAMEWORK_FLAGS):
+        """
+        Return a human-readable summary of the graph.
+        """
+        lines = [
+            "{} handlers, {} flags, {} dependencies".format(
+                len(self.handlers),
+                len(set(self.readers) | set(self.setters) | set(self.clearers)),
+                len(self.edges()),
+            )
+        ]
+        dead = self.dead_handlers(external)
+        if dead:
+            lines += ["", "Dead handlers:"]
+            lines += [
+                "  {}:{} ({}:{})".format(h.module, h.name, h.path, h.line) for h in dead
+            ]
+        unset = self.unset_flags(external)
+        if unset:
+            lines += ["", "Flags which are never set:"]
+            lines += ["  " + flag for flag in unset]
+        unread = sorted(set(self.setters) - set(self.readers))
+        if unread:
+            lines += ["", "Flags which no handler depends on:"]
+            lines += ["  " + flag for flag in unread]
+        return lines
+
+
+def patch_reactive(
+    compact=False,
+    unitdata="memory",
+    dispatch=False,
+    manifest=None,
+    record_calls="full",
+    hookenv="mock",
+):
+    """
+    Setup the standard patches that any reactive charm will require.
+
+    If `compact` is true, `charms.reactive`, `charmhelpers`, and
+    `charms.templating` are patched using `MockModule` rather than `MagicMock`.
+
+    The `unitdata` param selects what `charmhelpers.core.unitdata.kv()`
+    returns: either a `MockKV` (`"memory"`, the default), a `ThreadSafeKV`
+    (`"threadsafe"`, which also makes `flags` threadsafe), or an in-memory
+    `SQLiteKV` (`"sqlite"`).
+
+    If `dispatch` is true, the `@when*()` and `@hook()` decorators register
+    handlers with the `dispatcher`, so that `dispatcher.dispatch()` can run
+    them as the reactive framework would.
+
+    If a `manifest` is given, the modules it declares are also patched, as
+    with `patch_manifest()`.
+
+    The `record_calls` param sets how much the patched modules record when
+    called, as with `patch_module()`, and so also requires `compact`.
+
+    If `hookenv` is `"memory"`, the `hookenv` config, leadership, and
+    relation functions use the in-memory `hookenv_data`, rather than just
+    being mocks.
+    """
+    kv_backends = {"memory": MockKV, "threadsafe": ThreadSafeKV, "sqlite": SQLiteKV}
+    if unitdata not in kv_backends:
+        raise ValueError("Invalid unitdata backend: {!r}".format(unitdata))
+    if hookenv not in ("mock", "memory"):
+        raise ValueError("Invalid hookenv: {!r}".format(hookenv))
+    patch_module("charms.templating", compact=compact, record_calls=record_calls)
+
+    charms_layer = AutoImportMockPackage(name="charms.layer")
+    charms_layer.import_layer_libs = MagicMock(name="import_layer_libs")
+    patch_module("charms.layer", charms_layer)
+
+    ch = patch_module("charmhelpers", compact=compact, record_calls=record_calls)
+    ch.core.hookenv.atexit = identity
+    ch.core.hookenv.charm_dir.return_value = "charm_dir"
+    ch.core.host.restart_on_change.return_value = identity
+    ch.core.unitdata.kv.return_value = kv_backends[unitdata]()
+    if unitdata == "threadsafe":
+        flags.threadsafe = True
+    if hookenv == "memory":
+        hookenv_data.install(ch.core.hookenv)
+
+    reactive = patch_module(
+        "charms.reactive", compact=compact, record_calls=record_calls
+    )
+    for kind in list(_PREDICATES) + ["hook"]:
+        decorator = getattr(reactive, kind)
+        if dispatch:
+            decorator.side_effect = dispatcher.decorator(kind)
+        else:
+            decorator.return_value = identity
+    reactive.set_flag.side_effect = flags.add
+    reactive.clear_flag.side_effect = flags.discard
+    reactive.set_state.side_effect = flags.add
+    reactive.remove_state.side_effect = flags.discard
+    reactive.toggle_flag.side_effect = lambda f, s: (
+        flags.add(f) if s else flags.discard(f)
+    )
+    reactive.is_flag_set.side_effect = lambda f: f in flags
+    reactive.is_state.side_effect = lambda f: f in flags
+    reactive.get_flags.side_effect = flags.sorted
+    reactive.get_unset_flags.side_effect = flags.unset
+
+    reactive.Endpoint = MockEndpoint
+
+    os.environ["JUJU_MODEL_UUID"] = "test-1234"
+    os.environ["JUJU_UNIT_NAME"] = "test/0"
+    os.environ["JUJU_MACHINE_ID"] = "0"
+    os.environ["JUJU_AVAILABILITY_ZONE"] = ""
+
+    if manifest is not None:
+        patch_manifest(manifest)
+
+    return reactive
+
+
+ReplayResult = namedtuple("ReplayResult", "index hook invoked seconds error")
+
+
+class HookReplay:
+    """
+    Replays a recorded sequence of hook events against the patched charm.
+
+    The `events` can be the path to a JSON-lines file, or any iterable of
+    events, either as dicts or as lines of JSON. Each event has a `hook`
+    name, and can also have:
+
+      * `config`: config values which have changed
+      * `leader`: whether the unit is the leader
+      * `leadership`: leadership settings which have changed
+      * `relations`: a dict of endpoint names to dicts of relation IDs to
+        either `null`, if the relation is broken, or a dict with the `units`
+        whose data has changed, each of which maps to either `null`, if that
+        unit has departed, or its new (decoded) relation data, and optionally
+        the remote `app` name
+      * `flags`: a dict with lists of flags to `set` and `clear` before the
+        hook, for changes made outside of the charm's handlers
+
+    The relation data is applied to the `endpoints` given, which are created
+    as needed using `MockEndpoint.from_relations()`, along with the flags
+    which the reactive framework would manage for them.
+
+    Iterating over the replay processes one event at a time, running each
+    hook with `dispatcher.dispatch()` within a unitdata `hook_scope()`, and
+    yields a `ReplayResult(index, hook, invoked, seconds, error)` for each.
+    As with a real hook, if a handler raises an exception, its changes to
+    the flags and unitdata are discarded and the `error` is the formatted
+    traceback. Only the per-hook and per-handler `timings` are kept, so that
+    arbitrarily long traces can be replayed in constant memory.
+    """
+
+    def __init__(self, events, endpoints=None, kv=None):
+        self.events = events
+        self.endpoints = dict(endpoints or {})
+        self._kv = kv
+        self.hook_timings = {}
+        self.handler_timings = {}
+        self._units = {}
+
+    def __iter__(self):
+        hookenv_data.install(importlib.import_module("charmhelpers.core.hookenv"))
+        for endpoint in self.endpoints.values():
+            hookenv_data.add_endpoint(endpoint)
+        kv = self._kv
+        if kv is None:
+            kv = importlib.import_module("charmhelpers.core.unitdata").kv()
+        for index, event in enumerate(self._read()):
+            yield self._replay(index, event, kv)
+
+    def _read(self):
+        events = self.events
+        if isinstance(events, str) or hasattr(events, "__fspath__"):
+            with open(str(events)) as fp:
+                yield from self._parse(fp)
+        else:
+            yield from self._parse(events)
+
+    @staticmethod
+    def _parse(lines):
+        for line in lines:
+            if isinstance(line, Mapping):
+                yield line
+            elif line.strip():
+                yield json.loads(line)
+
+    def _replay(self, index, event, kv):
+        hook = event["hook"]
+        os.environ["JUJU_HOOK_NAME"] = hook
+        self._apply_flags(event.get("flags") or {})
+        self._apply_config(event.get("config") or {})
+        self._apply_leadership(event)
+        for endpoint_name, relations in (event.get("relations") or {}).items():
+            self._apply_relations(endpoint_name, relations)
+        before = frozenset(flags)
+        error = None
+        invoked = []
+        start = perf_counter()
+        try:
+            with kv.hook_scope(hook):
+                invoked = dispatcher.dispatch(hook, self.handler_timings).invoked
+        except Exception:
+            error = traceback.format_exc()
+            flags.clear()
+            flags.update(before)
+        seconds = perf_counter() - start
+        # Layer basic clears the config changed flags at the end of the hook.
+        flags.difference_update(
+            [name for name in flags if name.startswith("config.changed")]
+        )
+        hookenv_data.config.save()
+        timing = self.hook_timings.setdefault(hook, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        return ReplayResult(index, hook, invoked, seconds, error)
+
+    @staticmethod
+    def _apply_flags(changes):
+        flags.update(changes.get("set") or ())
+        flags.difference_update(changes.get("clear") or ())
+
+    def _apply_changes(self, data, changes, prefix):
+        for key, value in changes.items():
+            if data.get(key) == value:
+                continue
+            flags.update((prefix + ".changed", "{}.changed.{}".format(prefix, key)))
+            if value is None:
+                data.pop(key, None)
+                flags.discard("{}.set.{}".format(prefix, key))
+            else:
+                data[key] = value
+                flags.add("{}.set.{}".format(prefix, key))
+
+    def _apply_config(self, changes):
+        self._apply_changes(hookenv_data.config, changes, "config")
+
+    def _apply_leadership(self, event):
+        if "leader" in event:
+            hookenv_data.is_leader = bool(event["leader"])
+            if hookenv_data.is_leader:
+                flags.add("leadership.is_leader")
+            else:
+                flags.discard("leadership.is_leader")
+        self._apply_changes(
+            hookenv_data.leader_settings, event.get("leadership") or {}, "leadership"
+        )
+
+    def _endpoint(self, endpoint_name):
+        endpoint = self.endpoints.get(endpoint_name)
+        if endpoint is None:
+            endpoint = MockEndpoint.from_relations(endpoint_name, {})
+            self.endpoints[endpoint_name] = endpoint
+            hookenv_data.add_endpoint(endpoint)
+        if not isinstance(endpoint.all_joined_units, _JoinedUnitsView):
+            if not endpoint.relations:
+                endpoint.all_joined_units = _JoinedUnitsView(endpoint.relations)
+                return endpoint
+            raise TypeError(
+                "Endpoint {} must be created with MockEndpoint.from_relations() "
+                "to be replayed".format(endpoint_name)
+            )
+        return endpoint
+
+    def _apply_relations(self, endpoint_name, relations):
+        endpoint = self._endpoint(endpoint_name)
+        prefix = "endpoint.{}".format(endpoint_name)
+        by_id = {relation.relation_id: relation for relation in endpoint.relations}
+        for relation_id, changes in relations.items():
+            relation = by_id.get(relation_id)
+            if changes is None:
+                if relation is not None:
+                    endpoint.relations.remove(relation)
+                    for unit in relation.joined_units:
+                        self._units.pop((relation_id, unit.unit_name), None)
+                    flags.add(prefix + ".departed")
+                continue
+            if relation is None:
+                relation = MockRelation(
+                    relation_id,
+                    units=0,
+                    application_name=changes.get("app"),
+                    json_data=endpoint._json_data,
+                )
+                endpoint.relations.append(relation)
+            for unit_name, data in (changes.get("units") or {}).items():
+                self._apply_unit(prefix, relation, unit_name, data)
+        endpoint.is_joined = any(
+            relation._unit_len() for relation in endpoint.relations
+        )
+        if endpoint.is_joined:
+            flags.add(prefix + ".joined")
+        else:
+            flags.discard(prefix + ".joined")
+
+    def _apply_unit(self, prefix, relation, unit_name, data):
+        key = (relation.relation_id, unit_name)
+        unit = self._units.get(key)
+        if unit is None:
+            for unit in relation.joined_units:
+                if unit.unit_name == unit_name:
+                    break
+            else:
+                unit = None
+        if data is None:
+            if unit is not None:
+                relation.joined_units.remove(unit)
+                self._units.pop(key, None)
+                flags.add(prefix + ".departed")
+            return
+        if unit is None:
+            unit = MockUnit(unit_name, relation)
+            relation.joined_units.append(unit)
+        self._units[key] = unit
+        encoded = _encode_data(data)
+        if isinstance(unit.received, JSONDataView):
+            # Compare the raw data, so as not to count decoding it.
+            current, new = unit.received_raw, encoded
+        else:
+            current, new = unit.received, data
+        changed = [
+            name
+            for name in set(current) | set(new)
+            if current.get(name) != new.get(name)
+        ]
+        if changed:
+            flags.add(prefix + ".changed")
+            flags.update("{}.changed.{}".format(prefix, name) for name in changed)
+        unit.received_raw.clear()
+        unit.received_raw.update(encoded)
+        if not isinstance(unit.received, JSONDataView):
+            unit.received.clear()
+            unit.received.update(data)
+
+    def report_lines(self, limit=10):
+        """
+        Return lines summarizing the slowest hooks and handlers, by total time.
+        """
+        lines = ["slowest hooks:"]
+        for hook, (count, seconds) in sorted(
+            self.hook_timings.items(), key=lambda item: -item[1][1]
+        )[:limit]:
+            lines.append("  {:.4f}s {:6d}x {}".format(seconds, count, hook))
+        lines.append("slowest handlers:")
+        for func, (count, seconds) in sorted(
+            self.handler_timings.items(), key=lambda item: -item[1][1]
+        )[:limit]:
+            lines.append(
+                "  {:.4f}s {:6d}x {}:{}".format(
+                    seconds, count, func.__module__, func.__qualname__
+                )
+            )
+        return lines
+
+
+class ModulesSnapshot:
+    """
+    A snapshot of `sys.modules`, which can later be restored in bulk.
+
+    Only a shallow copy of `sys.modules` is taken, and restoring relies on
+    new (or re-imported) modules always being added to the end of it, and on
+    patching and unpatching modules being journaled, so that it only has to
+    look at the modules added since, removing the new ones and putting back
+    the original of any which were imported again, and put back the patched
+    modules which were replaced or removed. Modules which were removed and
+    not imported again are put back, too. If the last module in it is
+    removed, finding the modules added since falls back to comparing all of
+    them.
+
+    Can also be used as a context manager, which restores on exit.
+    """
+
+    def __init__(self):
+        self._journal = _ModulesJournal()
+        _modules_journals.append(self._journal)
+        self._count = len(sys.modules)
+        self._done = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.restore()
+
+    def added(self):
+        """
+        Return the names of the modules added since the snapshot was taken,
+        most recent first.
+        """
+        return self._journal.added()
+
+    def patched(self):
+        """
+        Return the sorted names of the patched modules which have been
+        added, replaced, or removed since the snapshot was taken.
+        """
+        names = {name for name in self.added() if _is_patched(sys.modules[name])}
+        names.update(
+            name
+            for name, module in self._journal.items()
+            if sys.modules.get(name, _MISSING) is not module
+        )
+        return sorted(names)
+
+    def restore(self):
+        """
+        Restore `sys.modules` as it was when the snapshot was taken.
+        """
+        global _patch_generation
+        if self._done:
+            return
+        self._done = True
+        _discard_modules_journal(self._journal)
+        journal = self._journal
+        added = journal.added()
+        replaced = journal.replaced()
+        for name in added:
+            del sys.modules[name]
+        for name in replaced:
+            sys.modules[name] = journal.modules[name]
+        for name, module in journal.items():
+            if module is _MISSING:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+                if _is_patched(module):
+                    _patched_modules[name] = module
+        removed = len(sys.modules) != self._count
+        if removed:
+            # Only then is it worth looking for the modules which were.
+            for name, module in journal.modules.items():
+                sys.modules.setdefault(name, module)
+        if added or replaced or removed or journal:
+            _patch_generation += 1
+
+    def discard(self):
+        """
+        Stop tracking changes, without restoring anything.
+        """
+        if not self._done:
+            self._done = True
+            _discard_modules_journal(self._journal)
+
+
+@pytest.fixture
+def isolate_modules():
+    """
+    Fixture which restores `sys.modules` after the test.
+
+    This is cheaper than `isolate_patched_state` when only the modules need
+    to be isolated.
+    """
+    with ModulesSnapshot() as snapshot:
+        yield snapshot
+
+
+class PatchedStateSnapshot:
+    """
+    A snapshot of the global state which the patches and the code under test
+    modify, which can later be restored.
+
+    This covers the in-memory `flags`, all `MockKV` stores, `hookenv_data`,
+    `os.environ`, and `sys.modules`, and restoring also resets the call
+    history of the patched modules named in `reset_mocks`. Rather than
+    copying everything up front, changes are tracked as they happen, where
+    possible, so that restoring only has to undo what actually changed.
+
+    Can also be used as a context manager, which restores on exit.
+    """
+
+    def __init__(self, reset_mocks=("charms.reactive", "charmhelpers")):
+        self.reset_mocks = reset_mocks
+        self._flags = frozenset(flags)
+        self._environ = dict(os.environ)
+        self._kv_journals = []
+        for kv in list(_kv_stores.values()):
+            journal = {}
+            kv._journals.append(journal)
+            self._kv_journals.append((kv, journal))
+        self._hookenv_data = (
+            hookenv_data.is_leader,
+            dict(hookenv_data.endpoints),
+            hookenv_data.config._prev_dict,
+        )
+        self._modules = ModulesSnapshot()
+        self._restored = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.restore()
+
+    def restore(self):
+        """
+        Restore the state as it was when the snapshot was taken.
+        """
+        if self._restored:
+            return
+        self._restored = True
+        self._modules.restore()
+        for kv, journal in self._kv_journals:
+            kv._rollback(journal)
+        if flags != self._flags:
+            flags.clear()
+            flags.update(self._flags)
+        is_leader, endpoints, hookenv_data.config._prev_dict = self._hookenv_data
+        hookenv_data.is_leader = is_leader
+        if hookenv_data.endpoints != endpoints:
+            hookenv_data.endpoints.clear()
+            hookenv_data.endpoints.update(endpoints)
+            hookenv_data._relation_count = None
+        self._restore_environ()
+        for name in self.reset_mocks:
+            module = sys.modules.get(name)
+            if _is_patched(module):
+                module.reset_mock()
+
+    def discard(self):
+        """
+        Stop tracking changes, without restoring anything.
+        """
+        if self._restored:
+            return
+        self._restored = True
+        self._modules.discard()
+        for kv, journal in self._kv_journals:
+            kv._detach(journal)
+
+    def changes(self):
+        """
+        Return a list of descriptions of what has changed since the snapshot
+        was taken, which is empty if nothing has.
+
+        Real modules which have been imported are not counted as changes,
+        since importing the code under test is expected.
+        """
+        changes = []
+        if flags != self._flags:
+            for label, names in (
+                ("flags set", flags - self._flags),
+                ("flags cleared", self._flags - flags),
+            ):
+                if names:
+                    changes.append("{}: {}".format(label, ", ".join(sorted(names))))
+        environ = self._environ
+        keys = {key for key in os.environ if environ.get(key) != os.environ[key]}
+        keys.update(key for key in environ if key not in os.environ)
+        # Managed by pytest itself.
+        keys.discard("PYTEST_CURRENT_TEST")
+        if keys:
+            changes.append("environment changed: {}".format(", ".join(sorted(keys))))
+        keys = set()
+        for kv, journal in self._kv_journals:
+            keys.update(kv._changed_keys(journal))
+        if keys:
+            changes.append("unitdata changed: {}".format(", ".join(sorted(keys))))
+        names = self._modules.patched()
+        if names:
+            changes.append(
+                "patched modules changed: {}".format(", ".join(sorted(names)))
+            )
+        return changes
+
+    def _restore_environ(self):
+        environ = self._environ
+        for key in [key for key in os.environ if key not in environ]:
+            del os.environ[key]
+        for key, value in environ.items():
+            if os.environ.get(key) != value:
+                os.environ[key] = value
+
+
+@pytest.fixture
+def isolate_patched_state():
+    """
+    Fixture which restores the patched state after the test.
+
+    See `PatchedStateSnapshot` for what this covers.
+    """
+    with PatchedStateSnapshot() as snapshot:
+        yield snapshot
+
+
+def _calls_size(calls):
+    # Estimated from the most recent call, rather than by sizing every call,
+    # so that sampling stays cheap however long the call lists get.
+    if not calls:
+        return sys.getsizeof(calls)
+    last = calls[-1]
+    each = sys.getsizeof(last) + sum(
+        sys.getsizeof(part) for part in tuple.__iter__(last) if part is not None
+    )
+    return sys.getsizeof(calls) + len(calls) * each
+
+
+def _mock_footprint(root, seen):
+    """
+    Estimate the memory held by a mock and the child mocks which haven't
+    already been counted in `seen`.
+    """
+    size = 0
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, MockModule):
+            size += sys.getsizeof(node) + sys.getsizeof(vars(node))
+            if node._record_calls not in ("count", "none"):
+                size += _calls_size(node.call_args_list)
+            prefix = node.__name__ + "."
+            pending.extend(
+                value
+                for value in vars(node).values()
+                if isinstance(value, MockModule) and value.__name__.startswith(prefix)
+            )
+            if isinstance(node._return_value, MockModule):
+                pending.append(node._return_value)
+        else:
+            # MagicMock configures __sizeof__, so sys.getsizeof() can't be used
+            # on it. Each Mock instance gets its own class, so count that too.
+            size += object.__sizeof__(node) + sys.getsizeof(vars(node))
+            size += sys.getsizeof(type(node))
+            size += sys.getsizeof(node._mock_children)
+            for calls in (node.call_args_list, node.mock_calls, node.method_calls):
+                size += _calls_size(calls)
+            pending.extend(
+                child
+                for child in node._mock_children.values()
+                if isinstance(child, NonCallableMock)
+            )
+            if isinstance(node._mock_return_value, NonCallableMock):
+                pending.append(node._mock_return_value)
+    return size
+
+
+def _kv_footprint(store):
+    if isinstance(store, SQLiteKV):
+        if store._closed:
+            return 0
+        # Not counted in the stats, since the real Storage wouldn't do this.
+        pages = store.conn.execute("pragma page_count").fetchone()[0]
+        page_size = store.conn.execute("pragma page_size").fetchone()[0]
+        return pages * page_size
+    size = sys.getsizeof(store) + sys.getsizeof(store._keys)
+    for key, value in dict.items(store):
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+def sample_mock_memory():
+    """
+    Return an estimate of the memory, in bytes, held by each patched module
+    (including its child mocks and their call histories), by `flags`, and by
+    each kind of `MockKV` or `SQLiteKV` store.
+
+    Patched modules are sized deepest first, so that a patched submodule is
+    counted under its own name, rather than its parent's. The flags and
+    stores are under `"<flags>"`, and `"<MockKV>"`, `"<MockConfig>"`, etc.
+    """
+    sample = {}
+    seen = set()
+    patched = sorted(
+        _iter_patched_modules(), key=lambda item: item[0].count("."), reverse=True
+    )
+    for name, module in patched:
+        sample[name] = _mock_footprint(module, seen)
+    sample["<flags>"] = (
+        sys.getsizeof(flags)
+        + sys.getsizeof(flags._names)
+        + sum(sys.getsizeof(flag) for flag in flags)
+    )
+    for store in list(_kv_stores.values()):
+        name = "<{}>".format(type(store).__name__)
+        sample[name] = sample.get(name, 0) + _kv_footprint(store)
+    return sample
+
+
+def _format_size(size):
+    if abs(size) < 1024:
+        return "{}B".format(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if abs(size) < 1024 or unit == "GiB":
+            return "{:.1f}{}".format(size, unit)
+
+
+def _parse_size(value):
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    text = value.strip().lower().rstrip("ib")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+MemoryGrowth = namedtuple("MemoryGrowth", "context total names")
+
+
+class MockMemoryMonitor:
+    """
+    Tracks the growth of the memory held by the patched modules, `flags`, and
+    unitdata stores, as sampled by `sample_mock_memory()`, across a session.
+
+    Each `start()` / `stop()` pair records how much each name grew in
+    between, attributed to the given context (the test, for the pytest
+    plugin). Growth past the `limit` (in bytes) is returned by `stop()`, so
+    that it can be reported.
+    """
+
+    def __init__(self, limit=1024**2):
+        self.enabled = False
+        self.limit = limit
+        self.first = None
+        self.last = None
+        self.growth = []
+        self._before = None
+
+    def clear(self):
+        self.first = self.last = self._before = None
+        self.growth.clear()
+
+    def start(self):
+        self._before = sample_mock_memory()
+        if self.first is None:
+            self.first = self._before
+
+    def stop(self, context=None):
+        """
+        Sample again and record the growth since `start()`. Returns the
+        `MemoryGrowth`, if it exceeds the `limit`, otherwise None.
+        """
+        before, after = self._before, sample_mock_memory()
+        self._before = None
+        self.last = after
+        names = {
+            name: size - before.get(name, 0)
+            for name, size in after.items()
+            if size != before.get(name, 0)
+        }
+        if not names:
+            return None
+        growth = MemoryGrowth(
+            context,
+            sum(names.values()),
+            sorted(names.items(), key=lambda item: item[1], reverse=True),
+        )
+        self.growth.append(growth)
+        if self.limit is not None and growth.total > self.limit:
+            return growth
+        return None
+
+    def session_growth(self):
+        """
+        Return the growth of each name between the first and last samples,
+        largest first.
+        """
+        if self.first is None or self.last is None:
+            return []
+        names = set(self.first) | set(self.last)
+        growth = [
+            (name, self.last.get(name, 0) - self.first.get(name, 0)) for name in names
+        ]
+        return sorted(
+            (item for item in growth if item[1]),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+
+    def report_lines(self, limit=10):
+        """
+        Return a human-readable summary of the growth.
+        """
+        session = self.session_growth()
+        lines = [
+            "{} held by mocks, flags, and unitdata; {} growth over {} samples".format(
+                _format_size(sum((self.last or {}).values())),
+                _format_size(sum(size for _, size in session)),
+                len(self.growth),
+            ),
+            "",
+            "Largest growth by name:",
+        ]
+        for name, size in session[:limit]:
+            lines.append("  {:>10} {}".format(_format_size(size), name))
+        lines += ["", "Largest growth by test:"]
+        for growth in sorted(self.growth, key=lambda g: g.total, reverse=True)[:limit]:
+            lines.append(
+                "  {:>10} {} ({})".format(
+                    _format_size(growth.total),
+                    growth.context,
+                    ", ".join(name for name, size in growth.names[:3] if size > 0),
+                )
+            )
+        return lines
+
+
+mock_memory = MockMemoryMonitor()
+
+
+class ModuleWatcher:
+    """
+    Watches the source files of the real modules loaded from under the given
+    `roots` (e.g., a charm's `reactive/`, `lib/`, and `tests/` directories),
+    so that after an edit, only the modules affected by it need to be
+    unloaded and imported again, rather than restarting the interpreter and
+    re-doing all of the patching.
+
+    Patched modules are never watched, and nor is anything in
+    `site-packages`. Extra files which aren't (yet) loaded as modules, such as
+    test files which failed to import, can be watched with `add()`.
+    """
+
+    def __init__(self, roots):
+        self.roots = [os.path.join(os.path.abspath(str(root)), "") for root in roots]
+        self.files = {}
+        self._mtimes = {}
+        self._last_scan = _time_ns()
+
+    def _watched(self, path):
+        return path.startswith(tuple(self.roots)) and "site-packages" not in path
+
+    def modules(self):
+        """
+        Return a dict of the watched modules' names, by source file path.
+        """
+        modules = {}
+        for name, module in list(sys.modules.items()):
+            if module is None or _is_patched(module):
+                continue
+            path = getattr(module, "__file__", None)
+            if path and path.endswith(".py"):
+                path = os.path.abspath(path)
+                if self._watched(path):
+                    modules[path] = name
+        return modules
+
+    def add(self, path):
+        """
+        Watch an extra file.
+        """
+        path = os.path.abspath(str(path))
+        self.files.setdefault(path, None)
+        self._mtimes.setdefault(path, _mtime(path))
+
+    def scan(self):
+        """
+        Return the paths of the watched files which have changed since the
+        last scan, and start watching any newly loaded modules.
+        """
+        for path, name in self.modules().items():
+            self.files[path] = name
+        changed = []
+        for path in self.files:
+            mtime = _mtime(path)
+            if path in self._mtimes:
+                if self._mtimes[path] != mtime:
+                    changed.append(path)
+            elif mtime is not None and mtime > self._last_scan:
+                # Loaded since the last scan, but edited since then too.
+                changed.append(path)
+            self._mtimes[path] = mtime
+        self._last_scan = _time_ns()
+        return changed
+
+    def wait(self, interval=0.2):
+        """
+        Poll until some watched files change, and return their paths.
+        """
+        while True:
+            changed = self.scan()
+            if changed:
+                return changed
+            sleep(interval)
+
+    def dependents(self, names):
+        """
+        Return the given module names along with the names of all of the
+        watched modules which depend on them, directly or indirectly.
+
+        A module depends on another if it refers to it, or to a function or
+        class from it, in its globals, such as after `import reactive.db` or
+        `from reactive.db import configure`.
+        """
+        modules = self.modules()
+        watched = set(modules.values())
+        used_by = {}
+        for name in watched:
+            for value in list(vars(sys.modules[name]).values()):
+                if isinstance(value, ModuleType):
+                    used = value.__name__
+                else:
+                    used = getattr(value, "__module__", None)
+                if used in watched and used != name:
+                    used_by.setdefault(used, set()).add(name)
+        affected = set(names)
+        pending = list(affected)
+        while pending:
+            for name in used_by.get(pending.pop(), ()):
+                if name not in affected:
+                    affected.add(name)
+                    pending.append(name)
+        return affected
+
+    def unload(self, names):
+        """
+        Remove the given modules from `sys.modules` (and their parent
+        packages), and forget their reactive handlers, so that they are
+        imported afresh by whatever next imports them.
+        """
+        for name in names:
+            module = sys.modules.get(name)
+            if module is None or _is_patched(module):
+                continue
+            _record_module(name)
+            del sys.modules[name]
+            parent, _, attr = name.rpartition(".")
+            if parent in sys.modules:
+                # Also works for mocks, such as charms.layer, where the
+                # module was set as a plain attribute.
+                vars(sys.modules[parent]).pop(attr, None)
+            dispatcher.forget_module(name)
+        # New layer libraries may have been added too.
+        importlib.invalidate_caches()
+
+
+class PatchedStateLeakWarning(UserWarning):
+    """
+    Issued by the `--patched-state=warn` option for a test which leaves the
+    patched state changed.
+    """
+
+
+class MockMemoryWarning(UserWarning):
+    """
+    Issued by the `--mock-memory=warn` option for a test which grows the
+    memory held by the mocks past the `--mock-memory-limit`.
+    """
+
+
+@pytest.fixture(autouse=True)
+def _mock_memory_per_test(request):
+    # Only applies when this module is loaded as a plugin.
+    mode = request.config.getoption("mock_memory", None)
+    if not mode:
+        yield
+        return
+    mock_memory.start()
+    yield
+    growth = mock_memory.stop(request.node.nodeid)
+    if growth is None:
+        return
+    message = "{} grew the memory held by mocks by {} ({})".format(
+        growth.context,
+        _format_size(growth.total),
+        ", ".join(
+            "{} {}".format(name, _format_size(size))
+            for name, size in growth.names[:5]
+            if size > 0
+        ),
+    )
+    if mode == "fail":
+        pytest.fail(message, pytrace=False)
+    warnings.warn(MockMemoryWarning(message))
+
+
+@pytest.fixture(autouse=True)
+def _patched_state_per_test(request, _mock_memory_per_test):
+    # Depends on _mock_memory_per_test so that the growth is measured after
+    # the patched state has been restored.
+    # Only applies when this module is loaded as a plugin.
+    mode = request.config.getoption("patched_state", None)
+    if not mode:
+        yield
+        return
+    snapshot = PatchedStateSnapshot()
+    try:
+        yield
+    finally:
+        if mode == "isolate":
+            snapshot.restore()
+        else:
+            changes = snapshot.changes()
+            snapshot.discard()
+            if changes:
+                warnings.warn(
+                    PatchedStateLeakWarning(
+                        "{} leaked patched state: {}".format(
+                            request.node.nodeid, "; ".join(changes)
+                        )
+                    )
+                )
+
+
+# Set while watch() is running, so that the pytest sessions it runs don't
+# start watching too.
+_watching = False
+
+
+class _WatchPlugin:
+    def __init__(self):
+        self.test_files = set()
+        self.selected = None
+        self.reporter = None
+
+    def pytest_sessionstart(self, session):
+        self.reporter = session.config.pluginmanager.get_plugin("terminalreporter")
+
+    def write_line(self, line):
+        if self.reporter is not None:
+            self.reporter.write_line(line)
+        else:
+            sys.stderr.write(line + "\n")
+
+    def pytest_pycollect_makemodule(self, module_path, parent):
+        self.test_files.add(str(module_path))
+
+    def pytest_ignore_collect(self, collection_path, config):
+        if self.selected is None or collection_path.suffix != ".py":
+            return None
+        return str(collection_path) not in self.selected or None
+
+
+def watch(args, roots, interval=0.2, plugins=()):
+    """
+    Run pytest with the given args, then keep running the affected tests
+    again whenever a watched file under the given `roots` changes, until
+    interrupted.
+
+    Everything stays in the one process, so the patches made by
+    `patch_reactive()` (e.g., in a `conftest.py`) and the modules which
+    haven't changed are all reused. Only the changed modules and those which
+    depend on them are unloaded, as determined by a `ModuleWatcher`, and only
+    the test files among those are run again.
+    """
+    global _watching
+    tracker = _WatchPlugin()
+    watcher = ModuleWatcher(roots)
+    _watching = True
+    exit_code = pytest.ExitCode.INTERRUPTED
+    try:
+        exit_code = pytest.main(list(args), plugins=[tracker] + list(plugins))
+        while exit_code != pytest.ExitCode.INTERRUPTED:
+            for path in tracker.test_files:
+                watcher.add(path)
+            changed = watcher.wait(interval)
+            names = {watcher.files[path] for path in changed} - {None}
+            affected = watcher.dependents(names)
+            paths = {path for path, name in watcher.files.items() if name in affected}
+            tracker.selected = (paths | set(changed)) & tracker.test_files
+            tracker.write_line(
+                "\nwatch: {} changed; re-running {} test file(s)".format(
+                    ", ".join(sorted(os.path.relpath(path) for path in changed)),
+                    len(tracker.selected),
+                )
+            )
+            watcher.unload(affected)
+            if tracker.selected:
+                exit_code = pytest.main(list(args), plugins=[tracker] + list(plugins))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _watching = False
+    return exit_code
+
+
+_forked_child = False
+# Most specific first, since XFailed is a subclass of Failed.
+_OUTCOMES = {
+    "xfail": pytest.xfail.Exception,
+    "fail": pytest.fail.Exception,
+    "skip": pytest.skip.Exception,
+}
+
+
+def _send(fp, kind, data):
+    import pickle
+
+    pickle.dump((kind, data), fp, pickle.HIGHEST_PROTOCOL)
+    fp.flush()
+
+
+def _send_warning(fp, message):
+    import pickle
+
+    category = message.category
+    try:
+        pickle.dumps(category)
+    except Exception:
+        category = UserWarning
+    _send(
+        fp,
+        "warning",
+        (category, str(message.message), message.filename, message.lineno),
+    )
+
+
+def _call_child(item, fp):
+    # Calls the test function, as pytest would have, and sends back how it
+    # went, along with any warnings, and the import trace.
+    global _forked_child
+    _forked_child = True
+    with warnings.catch_warnings(record=True) as caught:
+        try:
+            item.ihook.pytest_pyfunc_call(pyfuncitem=item)
+        except (pytest.skip.Exception, pytest.fail.Exception) as e:
+            # These can't be pickled, since they claim to be builtins.
+            name = [name for name in _OUTCOMES if isinstance(e, _OUTCOMES[name])][0]
+            outcome = ("outcome", (name, e.msg, e.pytrace))
+        except pytest.exit.Exception as e:
+            outcome = ("exit", (e.msg, e.returncode))
+        except BaseException:
+            excinfo = pytest.ExceptionInfo.from_current()
+            outcome = ("failed", str(item.repr_failure(excinfo)))
+        else:
+            outcome = ("passed", None)
+    for message in caught:
+        _send_warning(fp, message)
+    if import_trace.enabled:
+        _send(
+            fp,
+            "import_trace",
+            (
+                import_trace.records,
+                import_trace.contexts,
+                import_trace.find_spec_calls,
+                import_trace.cache_hits,
+            ),
+        )
+    _send(fp, *outcome)
+
+
+def _run_forked(item):
+    # Runs the test function in a child process forked from this one, once
+    # its fixtures have been set up, so that nothing it changes can leak into
+    # later tests. Returns the outcome sent back over a pipe.
+    import pickle
+
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if not pid:
+        status = 1
+        try:
+            os.close(read_fd)
+            with os.fdopen(write_fd, "wb") as fp:
+                _call_child(item, fp)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    outcome = None
+    with os.fdopen(read_fd, "rb") as fp:
+        while True:
+            try:
+                kind, data = pickle.load(fp)
+            except EOFError:
+                break
+            if kind == "warning":
+                category, message, filename, lineno = data
+                warnings.warn_explicit(message, category, filename, lineno)
+            elif kind == "import_trace":
+                (
+                    import_trace.records,
+                    import_trace.contexts,
+                    import_trace.find_spec_calls,
+                    import_trace.cache_hits,
+                ) = data
+            else:
+                outcome = kind, data
+    _, status = os.waitpid(pid, 0)
+    if outcome is None:
+        if os.WIFSIGNALED(status):
+            reason = "killed by signal {}".format(os.WTERMSIG(status))
+        else:
+            reason = "exited with status {}".format(os.WEXITSTATUS(status))
+        outcome = "failed", "The forked test process {}".format(reason)
+    return outcome
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if _forked_child or not pyfuncitem.config.getoption("fork_tests"):
+        return None
+    kind, data = _run_forked(pyfuncitem)
+    if kind == "outcome":
+        name, msg, pytrace = data
+        exc = _OUTCOMES[name](msg, pytrace=pytrace)
+        # Skips are reported at the test, rather than where this raises them.
+        exc._use_item_location = True
+        raise exc
+    if kind == "exit":
+        pytest.exit(*data)
+    if kind == "failed":
+        pytest.fail(data, pytrace=False)
+    return True
+
+
+def _xdist_worker(config):
+    workerinput = getattr(config, "workerinput", None)
+    return workerinput["workerid"] if workerinput else None
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("charms.unit_test")
+    group.addoption(
+        "--import-trace",
+        action="store_true",
+        help="Report how imports were resolved by the import mocking.",
+    )
+    group.addoption(
+        "--import-trace-json",
+        metavar="PATH",
+        help="Write the import resolution trace to PATH as JSON. Under "
+        "pytest-xdist, each worker writes its own trace, to PATH.<workerid>.",
+    )
+    group.addoption(
+        "--layer-index",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="Add a charm or layer source directory to the layer_index, which "
+        "decides which charms.layer libraries are real (may be repeated).",
+    )
+    group.addoption(
+        "--patched-state",
+        choices=("isolate", "warn"),
+        help="Either restore the patched state (flags, unitdata, environment, "
+        "and patched modules) after each test, or warn about tests which leave "
+        "it changed.",
+    )
+    group.addoption(
+        "--mock-memory",
+        choices=("warn", "fail"),
+        help="Sample the memory held by patched modules, flags, and unitdata "
+        "around each test, and warn about or fail tests which grow it by more "
+        "than --mock-memory-limit.",
+    )
+    group.addoption(
+        "--mock-memory-limit",
+        type=_parse_size,
+        default="1M",
+        metavar="SIZE",
+        help="The growth allowed per test by --mock-memory, in bytes, or with a "
+        "k, M, or G suffix (default: 1M).",
+    )
+    group.addoption(
+        "--watch",
+        action="store_true",
+        help="After running the tests, keep watching the loaded modules under "
+        "the rootdir (and --layer-index dirs), and re-run only the tests "
+        "affected by each change, in the same process.",
+    )
+    group.addoption(
+        "--fork-tests",
+        action="store_true",
+        help="Call each test function in a child process forked from the pytest "
+        "process, once it has run patch_reactive() and imported the tests and "
+        "charm, and the test's fixtures are set up, so that each test starts from "
+        "that state and can't change it for others.",
+    )
+    group.addoption(
+        "--patch-groups",
+        action="store_true",
+        help="Mark tests with xdist_group by test module, or by their "
+        "patch_group mark, so that --dist=loadgroup keeps tests sharing "
+        "patched modules on the same worker.",
+    )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config):
+    if _watching or not config.getoption("watch"):
+        return None
+    roots = [config.rootpath] + config.getoption("layer_index")
+    return watch(
+        config.invocation_params.args,
+        roots,
+        plugins=config.invocation_params.plugins or (),
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "patch_group(name): group tests sharing patch setups under --patch-groups",
+    )
+    if config.getoption("import_trace") or config.getoption("import_trace_json"):
+        import_trace.enabled = True
+    for root in config.getoption("layer_index"):
+        layer_index.add(root)
+    if config.getoption("fork_tests") and not hasattr(os, "fork"):
+        raise pytest.UsageError("--fork-tests requires os.fork()")
+    if config.getoption("mock_memory"):
+        mock_memory.enabled = True
+        mock_memory.limit = config.getoption("mock_memory_limit")
+
+
+def pytest_collectstart(collector):
+    if import_trace.enabled:
+        import_trace.context = collector.nodeid.split("::")[0] or None
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    # This needs to run before pytest-xdist looks for the xdist_group marks.
+    if not config.getoption("patch_groups"):
+        return
+    for item in items:
+        if item.get_closest_marker("xdist_group"):
+            continue
+        mark = item.get_closest_marker("patch_group")
+        group = mark.args[0] if mark else item.nodeid.split("::")[0]
+        item.add_marker(pytest.mark.xdist_group(group))
+
+
+def pytest_runtest_setup(item):
+    if import_trace.enabled:
+        import_trace.context = item.nodeid.split("::")[0]
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    if config.getoption("import_trace"):
+        terminalreporter.write_sep("=", "import mocking trace")
+        for line in import_trace.report_lines():
+            terminalreporter.write_line(line)
+    if mock_memory.enabled:
+        terminalreporter.write_sep("=", "mock memory growth")
+        for line in mock_memory.report_lines():
+            terminalreporter.write_line(line)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    path = config.getoption("import_trace_json")
+    if not path:
+        return
+    worker = _xdist_worker(config)
+    if worker:
+        path = "{}.{}".format(path, worker)
+    elif getattr(config.option, "dist", "no") != "no":
+        # The tests all ran on the workers, which wrote their own traces.
+        return
+    import_trace.dump(path)
 
 
-sys.meta_path.append(MockFinder())
+# The module can end up imported twice, e.g. as a plugin and by a test
+# collecting it, but there should only ever be one finder.
+if not any(hasattr(finder, "find_real") for finder in sys.meta_path):
+    sys.meta_path.append(MockFinder())
@@ -13,6 +13,11 @@ SETUP = {
     'install_requires': [
         "pytest",
     ],
+    'extras_require': {
+        'yaml': [
+            "pyyaml",
+        ],
+    },
     'license': "Apache License 2.0",
     'long_description_content_type': 'text/markdown',
     'long_description': open('README.md').read(),
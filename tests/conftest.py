@@ -11,3 +11,6 @@ def pytest_addoption(parser):
 def cmdopt(request):
     if request.config.getoption("--debug-tests"):
         unit_test._debug = unit_test._debug_pront
+
+
+pytest_plugins = ["pytester"]
@@ -1,18 +1,23 @@
+import concurrent.futures
+import copy
+import importlib
+import json
+import os
 import sys
+import threading
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 
 import pytest
 
 from charms import unit_test
+from charms.unit_test import isolate_patched_state  # noqa: F401
 
 
 @pytest.fixture(autouse=True)
 def clean_imports():
-    sys_modules = sys.modules.copy()
-    yield
-    sys.modules.clear()
-    sys.modules.update(sys_modules)
+    with unit_test.PatchedStateSnapshot():
+        yield
 
 
 def test_patch():
@@ -186,8 +191,9 @@ def test_mock_kv():
     assert kv == {"foo": "bar"}
 
 
-def test_patch_reactive():
-    unit_test.patch_reactive()
+@pytest.mark.parametrize("compact", [False, True])
+def test_patch_reactive(compact):
+    unit_test.patch_reactive(compact=compact)
     import charms
     import charms.templating  # noqa
     import charms.layer.foo  # noqa
@@ -246,3 +252,1467 @@ def test_patch_reactive():
     assert get_unset_flags("foo", "bar") == ["bar"]
 
     assert charms.layer.import_layer_libs
+
+
+def test_find_real_cache():
+    lib = str(Path(__file__).parent / "lib")
+    unit_test.MockFinder.cache_clear()
+    assert unit_test.MockFinder.find_real("dummy.test") is None
+    assert unit_test.MockFinder.find_real("dummy.test") is None
+    assert unit_test.MockFinder.cache_info() == (1, 1, 1)
+
+    # changing sys.path invalidates the (negative) cached result
+    with patch("sys.path", [lib] + sys.path):
+        assert unit_test.MockFinder.find_real("patched.module.import_over_patch")
+        assert unit_test.MockFinder.find_real("patched.module.import_over_patch")
+        assert unit_test.MockFinder.cache_info() == (2, 2, 1)
+
+    # as does replacing the finder for a sys.path entry, even though the size
+    # of sys.path_importer_cache stays the same
+    entry = sys.path[-1]
+    assert entry in sys.path_importer_cache
+    misses = unit_test.MockFinder.cache_info().misses
+    with patch.dict(sys.path_importer_cache, {entry: None}):
+        unit_test.MockFinder.find_real("dummy.test")
+        unit_test.MockFinder.find_real("dummy.test")
+    assert unit_test.MockFinder.cache_info().misses == misses + 1
+    unit_test.MockFinder.find_real("dummy.test")
+    assert unit_test.MockFinder.cache_info().misses == misses + 2
+
+    # as does changing the set of patched modules
+    misses = unit_test.MockFinder.cache_info().misses
+    unit_test.patch_module("dummy")
+    assert unit_test.MockFinder.find_real("dummy.test") is None
+    assert unit_test.MockFinder.cache_info().misses == misses + 1
+
+    importlib.invalidate_caches()
+    assert unit_test.MockFinder.cache_info().currsize == 0
+
+
+@patch("sys.path", [str(Path(__file__).parent / "lib")] + sys.path)
+def test_find_real_leaves_sys_modules_alone():
+    unit_test.patch_module("patched.module")
+    assert dict(unit_test._iter_patched_modules()) == {
+        "patched": sys.modules["patched"],
+        "patched.module": sys.modules["patched.module"],
+    }
+    before = sys.modules.copy()
+    spec = unit_test.MockFinder.find_real("patched.module.import_over_patch")
+    assert spec.name == "patched.module.import_over_patch"
+    assert sys.modules == before
+
+
+def test_mock_module():
+    with unit_test.patch_module("dummy.test.foo", compact=True) as _foo:
+        import dummy
+        from dummy.test import foo
+        import dummy.other.module as dummy_other_module
+
+        assert foo is _foo
+        assert isinstance(dummy, unit_test.MockModule)
+        assert isinstance(dummy_other_module, unit_test.MockModule)
+        assert dummy.other.module is dummy_other_module
+
+        foo.func.return_value = "ok"
+        assert foo.func(1, key="val") == "ok"
+        foo.func.assert_called_once_with(1, key="val")
+        foo.other.side_effect = [1, ValueError]
+        assert foo.other() == 1
+        with pytest.raises(ValueError):
+            foo.other()
+        assert isinstance(foo.unset(), unit_test.MockModule)
+        foo.reset_mock()
+        foo.func.assert_not_called()
+    with pytest.raises(ImportError):
+        from dummy.test import foo  # noqa
+
+
+def test_mock_module_record_calls():
+    counted = unit_test.MockModule("counted", record_calls="count")
+    counted.func()
+    counted.func()
+    assert counted.func.call_count == 2
+    assert counted.func.call_args_list == []
+    with pytest.raises(RuntimeError):
+        counted.func.assert_called_with()
+
+    silent = unit_test.MockModule("silent", record_calls="none")
+    silent.func()
+    assert silent.func.call_count == 0
+    with pytest.raises(RuntimeError):
+        silent.func.assert_called()
+
+    with pytest.raises(ValueError):
+        unit_test.MockModule("invalid", record_calls="some")
+    with pytest.raises(ValueError):
+        unit_test.MockModule("invalid", record_calls=0)
+
+
+def test_mock_module_ring_buffer():
+    with pytest.raises(ValueError):
+        unit_test.patch_reactive(record_calls=3)
+    reactive = unit_test.patch_reactive(compact=True, record_calls=3)
+    from charmhelpers.core import hookenv
+
+    assert isinstance(hookenv, unit_test.MockModule)
+    for num in range(5):
+        hookenv.log("message {}".format(num), level="INFO")
+    assert hookenv.log.call_count == 5
+    assert len(hookenv.log.call_args_list) == 3
+    hookenv.log.assert_called_with("message 4", level="INFO")
+    assert hookenv.log.called_with("message 2", level="INFO")
+    # Only the last 3 calls are kept, and the index drops the others.
+    assert not hookenv.log.called_with("message 1", level="INFO")
+    hookenv.log("message 5", level="INFO")
+    assert not hookenv.log.called_with("message 2", level="INFO")
+    assert hookenv.log.called_with("message 5", level="INFO")
+    hookenv.log.assert_any_call("message 5", level=ANY)
+
+    reactive.endpoint_from_name(["unhashable"])
+    assert reactive.endpoint_from_name.called_with(["unhashable"])
+    hookenv.log.reset_mock()
+    assert not hookenv.log.called_with("message 5", level="INFO")
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_patched_state_snapshot(compact):
+    reactive = unit_test.patch_reactive(compact=compact)
+    from charmhelpers.core import unitdata
+
+    kv = unitdata.kv()
+    kv.set("existing", 1)
+    reactive.set_flag("existing")
+    os.environ["JUJU_UNIT_NAME"] = "test/0"
+
+    with unit_test.PatchedStateSnapshot() as snapshot:
+        reactive.set_flag("new")
+        reactive.clear_flag("existing")
+        kv.set("existing", 2)
+        kv.update({"new": 3})
+        kv.unsetrange(prefix="ex")
+        os.environ["JUJU_UNIT_NAME"] = "other/1"
+        os.environ["NEW_VAR"] = "value"
+        unit_test.patch_module("dummy")
+        import dummy  # noqa
+        import charms.layer.foo  # noqa
+
+    assert unit_test.flags == {"existing"}
+    assert kv == {"existing": 1}
+    assert os.environ["JUJU_UNIT_NAME"] == "test/0"
+    assert "NEW_VAR" not in os.environ
+    assert "dummy" not in sys.modules
+    assert "charms.layer.foo" not in sys.modules
+    assert "charms.reactive" in sys.modules
+    assert reactive.set_flag.call_count == 0
+    assert reactive.is_flag_set("existing")
+    snapshot.restore()  # only restores once
+    assert unit_test.flags == {"existing"}
+
+
+@pytest.mark.filterwarnings("error")
+def test_patched_state_snapshot_reimport():
+    import csv
+    import json
+
+    # Something other than csv is last in sys.modules, as the anchor.
+    sys.modules["reimport_anchor"] = unit_test.ModuleType("reimport_anchor")
+    with unit_test.PatchedStateSnapshot():
+        del sys.modules["csv"]
+        import csv as reimported
+
+        assert reimported is not csv
+        del sys.modules["json"]
+    assert sys.modules["csv"] is csv
+    assert sys.modules["json"] is json
+
+
+def test_patched_state_snapshot_with_hook_scope():
+    unit_test.patch_reactive()
+    from charmhelpers.core import unitdata
+
+    kv = unitdata.kv()
+    kv.set("x", 1)
+    with unit_test.PatchedStateSnapshot():
+        # Both journals record just "x", so they compare equal.
+        with kv.hook_scope():
+            kv.set("x", 2)
+        kv.set("y", 2)
+    assert kv == {"x": 1}
+    assert kv._journals == []
+
+
+def test_isolate_patched_state_fixture(isolate_patched_state):  # noqa: F811
+    assert isinstance(isolate_patched_state, unit_test.PatchedStateSnapshot)
+
+
+def test_mock_kv_storage_api():
+    kv = unit_test.MockKV({"b.2": 2, "a.1": 1})
+    assert kv.get("missing", "default") == "default"
+    kv.set("record", {"a": 1})
+    assert kv.get("record", record=True).a == 1
+    assert kv.get("missing", record=True) is None
+    kv.unset("record")
+    kv.update({"1": 1, "2": 2}, prefix="c.")
+    kv.update({"3": 3}, "c.")
+    assert kv.getrange("c.", strip=True) == {"1": 1, "2": 2, "3": 3}
+    assert kv.getrange("a") == {"a.1": 1}
+    assert kv.getrange("z") == {}
+
+    assert kv.delta({"1": 1, "2": "two", "4": 4}, "c.") == {
+        "2": unit_test.Delta(2, "two"),
+        "3": unit_test.Delta(3, None),
+        "4": unit_test.Delta(None, 4),
+    }
+
+    copy = kv.copy()
+    kv.unsetrange(prefix="c.")
+    assert kv == {"a.1": 1, "b.2": 2}
+    assert kv.getrange("c.") == {}
+    assert copy["c.1"] == 1
+
+    with kv.hook_scope("install") as revision:
+        assert revision == kv.revision == 1
+        kv.set("a.2", 2)
+    assert kv.revision is None
+    with pytest.raises(ValueError):
+        with kv.hook_scope("config-changed"):
+            kv.set("a.3", 3)
+            kv.unset("b.2")
+            raise ValueError()
+    assert kv.getrange("a") == {"a.1": 1, "a.2": 2}
+    assert kv == {"a.1": 1, "a.2": 2, "b.2": 2}
+    with kv.hook_scope():
+        kv.set("a.1", "one")
+        kv.flush()
+        kv.set("a.2", "two")
+        kv.flush(save=False)
+    assert kv.getrange("a.", strip=True) == {"1": "one", "2": 2}
+
+    kv.popitem()
+    kv.setdefault("d", 4)
+    kv.clear()
+    assert kv == {} and kv.getrange("") == {}
+
+
+def test_sqlite_kv():
+    unit_test.patch_reactive(unitdata="sqlite")
+    from charmhelpers.core import unitdata
+
+    kv = unitdata.kv()
+    assert isinstance(kv, unit_test.SQLiteKV)
+    kv.set("docker.net_mtu", 1)
+    kv.update({"net_nack": True, "net_type": "vxlan"}, prefix="docker.")
+    assert kv.get("docker.net_mtu") == 1
+    assert kv.get("missing", "default") == "default"
+    kv.set("record", {"a": 1})
+    assert kv.get("record", record=True).a == 1
+    kv.unset("record")
+    assert kv.getrange("docker.", strip=True) == {
+        "net_mtu": 1,
+        "net_type": "vxlan",
+        "net_nack": True,
+    }
+    assert kv.delta({"net_mtu": 2}, "docker.") == {
+        "net_mtu": unit_test.Delta(1, 2),
+        "net_nack": unit_test.Delta(True, None),
+        "net_type": unit_test.Delta("vxlan", None),
+    }
+    kv.unsetrange(["net_mtu"], "docker.")
+    assert kv.getrange("docker.", strip=True) == {"net_type": "vxlan", "net_nack": True}
+
+    with kv.hook_scope("install") as revision:
+        kv.set("foo", "bar")
+        kv.unsetrange(prefix="docker.")
+    assert kv.getrange("") == {"foo": "bar"}
+    assert [row[:3] for row in kv.gethistory("foo", deserialize=True)] == [
+        (revision, "foo", "bar")
+    ]
+    with pytest.raises(ValueError):
+        with kv.hook_scope("config-changed"):
+            kv.set("foo", "baz")
+            raise ValueError()
+    assert kv.get("foo") == "bar"
+
+    kv.reset_stats()
+    kv.set("foo", "bar")  # unchanged, so no write
+    kv.set("large", ["x" * 100] * 10)
+    assert kv.stats.queries == 3
+    assert kv.stats.bytes_serialized == len('"bar"') + 10 * 104
+    assert kv.stats.bytes_deserialized == 0
+
+    with unit_test.PatchedStateSnapshot():
+        kv.set("foo", "changed")
+        kv.unset("large")
+        kv.set("new", 1)
+        kv.flush()
+    assert kv.getrange("") == {"foo": "bar", "large": ["x" * 100] * 10}
+    kv.close()
+
+    with pytest.raises(ValueError):
+        unit_test.patch_reactive(unitdata="invalid")
+
+
+def test_sqlite_kv_nested_snapshots():
+    unit_test.patch_reactive(unitdata="sqlite")
+    from charmhelpers.core import unitdata
+
+    kv = unitdata.kv()
+    kv.set("x", 1)
+    with unit_test.PatchedStateSnapshot():
+        with unit_test.PatchedStateSnapshot():
+            # Both journals record just "x", so they compare equal.
+            kv.set("x", 2)
+        kv.set("y", 2)
+    assert kv.getrange("") == {"x": 1}
+    assert kv._journals == []
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_dispatch(compact):
+    unit_test.patch_reactive(compact=compact, dispatch=True)
+    from charms.reactive import hook, when, when_any, when_not, set_flag, clear_flag
+
+    dispatcher = unit_test.dispatcher
+    dispatcher.reset()
+    calls = []
+
+    @hook("install")
+    def install():
+        calls.append("install")
+        set_flag("installed")
+
+    @when("installed")
+    @when_not("configured")
+    def configure():
+        calls.append("configure")
+        set_flag("configured")
+
+    @when_any("configured", "unrelated")
+    def start():
+        calls.append("start")
+        set_flag("started")
+        clear_flag("installed")
+
+    @when("started")
+    def running():
+        calls.append("running")
+
+    @when("never")
+    def never():
+        calls.append("never")
+
+    # decorated functions can still be called directly
+    assert configure() is None
+    assert calls == ["configure"]
+    unit_test.flags.clear()
+    calls.clear()
+
+    stats = dispatcher.dispatch("install")
+    assert calls == ["install", "configure", "start", "running"]
+    assert stats.invoked == [install, configure, start, running]
+    assert stats.iterations == 2
+    assert unit_test.flags == {"configured", "started"}
+
+    # nothing depends on changed flags, so nothing runs again
+    calls.clear()
+    stats = dispatcher.dispatch()
+    assert calls == ["start", "running"]
+    assert stats.iterations == 1
+
+
+def test_flag_set():
+    flags = unit_test.FlagSet(["b", "a"])
+    flags.set_many(["d", "c", "a"])
+    assert flags == {"a", "b", "c", "d"}
+    assert flags.sorted() == ["a", "b", "c", "d"]
+    flags.clear_many(["b", "x"])
+    flags -= {"d"}
+    flags |= {"aa"}
+    assert flags.sorted() == ["a", "aa", "c"]
+    assert flags.all_set(["a", "c"]) and not flags.all_set(["a", "b"])
+    assert flags.any_set(["b", "c"]) and not flags.any_set(["b", "d"])
+    assert flags.unset("c", "z", "b") == ["b", "z"]
+    assert flags.pop() == "c"
+    with flags.journaled() as journal:
+        flags.add("a")
+        flags.cause = "test"
+        flags ^= {"a"}
+        flags.add("e")
+        flags.clear()
+    assert journal == [
+        ("a", False, "test"),
+        ("e", True, "test"),
+        ("aa", False, "test"),
+        ("e", False, "test"),
+    ]
+    assert flags.sorted() == [] and not flags
+    flags.add("new")
+    assert len(journal) == 4
+    assert not flags.threadsafe
+    flags.threadsafe = True
+    assert copy.copy(flags).threadsafe
+
+
+def test_dispatch_flag_journal():
+    unit_test.patch_reactive(dispatch=True)
+    from charms.reactive import when, when_not, set_flag, clear_flag, get_flags
+
+    unit_test.dispatcher.reset()
+
+    @when_not("installed")
+    def install():
+        set_flag("installed")
+        set_flag("temporary")
+        clear_flag("temporary")
+
+    @when("installed")
+    def configure():
+        set_flag("configured")
+
+    unit_test.flags.clear()
+    with unit_test.flags.journaled() as journal:
+        unit_test.dispatcher.dispatch()
+    assert [(t.flag, t.set, t.cause.func) for t in journal] == [
+        ("installed", True, install),
+        ("temporary", True, install),
+        ("temporary", False, install),
+        ("configured", True, configure),
+    ]
+    assert get_flags() == ["configured", "installed"]
+
+
+def test_scan_handlers(tmp_path, monkeypatch):
+    monkeypatch.setattr(unit_test, "_scan_memo", {})
+    charm = tmp_path / "charm"
+    (charm / "reactive").mkdir(parents=True)
+    (charm / "reactive" / "app.py").write_text("""
+from charms import reactive
+from charms.reactive import hook, when, when_any, when_not, set_flag, clear_flag
+
+
+@hook("install")
+def install():
+    set_flag("app.installed")
+
+
+@when("app.installed", "config.changed")
+@when_not("app.configured")
+def configure():
+    _configured()
+
+
+def _configured():
+    reactive.set_flag("app.configured")
+    clear_flag("app.restarted")
+
+
+@when_any("app.configured", "app.forced")
+def restart():
+    set_flag("app.restarted")
+
+
+@when("app.never")
+def never():
+    pass
+""")
+    (charm / "lib" / "charms" / "layer" / "mylib").mkdir(parents=True)
+    (charm / "lib" / "charms" / "layer" / "mylib" / "__init__.py").write_text("""
+from charms.reactive import when, set_flag
+
+
+@when("endpoint.{endpoint_name}.joined")
+def joined(self):
+    set_flag(self.expand_name("{endpoint_name}.ready"))
+""")
+    cache_dir = tmp_path / "cache"
+    graph = unit_test.scan_handlers([charm], cache_dir=cache_dir)
+    by_name = {handler.name: handler for handler in graph.handlers}
+    assert sorted(by_name) == ["configure", "install", "joined", "never", "restart"]
+    configure = by_name["configure"]
+    assert configure.module == "reactive.app"
+    assert configure.line == 13
+    assert configure.predicates == (
+        ("when", ("app.installed", "config.changed")),
+        ("when_not", ("app.configured",)),
+    )
+    assert configure.sets == ("app.configured",)
+    assert configure.clears == ("app.restarted",)
+    assert by_name["install"].hooks == ("install",)
+    assert by_name["joined"].module == "charms.layer.mylib"
+    assert by_name["joined"].sets == ("{endpoint_name}.ready",)
+    assert (by_name["install"], "app.installed", configure) in graph.edges()
+    assert graph.unset_flags() == ["app.forced", "app.never"]
+    assert graph.dead_handlers() == [by_name["never"]]
+    assert (
+        "  reactive.app:never ({}:28)".format(charm / "reactive" / "app.py")
+        in graph.report_lines()
+    )
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # Cached by content, in memory and then on disk.
+    with patch.object(unit_test, "_scan_source") as scan_source:
+        assert unit_test.scan_handlers([charm], cache_dir=cache_dir).handlers == (
+            graph.handlers
+        )
+        unit_test._scan_memo.clear()
+        assert unit_test.scan_handlers([charm], cache_dir=cache_dir).handlers == (
+            graph.handlers
+        )
+    scan_source.assert_not_called()
+
+
+def test_dispatcher_stress():
+    unit_test.patch_reactive(dispatch=True, unitdata="threadsafe")
+    from charms.reactive import when, set_flag, clear_flag
+    from charmhelpers.core import unitdata
+
+    unit_test.dispatcher.reset()
+    unit_test.flags.clear()
+    kv = unitdata.kv()
+    assert isinstance(kv, unit_test.ThreadSafeKV)
+    assert unit_test.flags.threadsafe
+    both_read = threading.Barrier(2)
+
+    @when("counting")
+    def count():
+        # Both threads read before either writes, so one update is lost.
+        value = kv.get("count", 0)
+        both_read.wait()
+        kv.set("count", value + 1)
+
+    @when("flagging")
+    def flag():
+        name = "flag.{}".format(threading.get_ident())
+        set_flag(name)
+        clear_flag(name)
+        set_flag("shared")
+        kv.set(name, True)
+
+    def fail():
+        raise ValueError("failed")
+
+    report = unit_test.dispatcher.stress([count, flag, fail], iterations=1, workers=2)
+    assert report.runs == 6 and report.workers == 2
+    assert report.throughput > 0
+    assert [func for func, _ in report.errors] == [fail, fail]
+    assert report.races == [
+        "ThreadSafeKV write of 'count' based on a stale read (1 times)"
+    ]
+    assert kv["count"] == 1
+    assert unit_test.flags == {"shared"}
+    assert kv.getrange("flag.") == {key: True for key in kv if key.startswith("flag.")}
+
+    # The log itself doesn't lose writes made to the same key by every worker.
+    log = unit_test._StressLog()
+
+    def write(num):
+        log.begin()
+        for _ in range(1000):
+            log.write("shared", num)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(write, range(8)))
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert log.versions["shared"] == len(log.writes) == 8000
+
+    # Otherwise, flags are only threadsafe during the stress test.
+    unit_test.flags.threadsafe = False
+    seen = []
+    unit_test.dispatcher.stress(
+        [lambda: seen.append(unit_test.flags.threadsafe)], iterations=1, workers=1
+    )
+    assert seen == [True] and not unit_test.flags.threadsafe
+
+    unit_test.flags.clear()
+    transitions = [unit_test.FlagTransition("a", True, None)]
+    assert unit_test._flag_races(set(), transitions) == [
+        "lost flag update: a was last set but is not set"
+    ]
+
+
+def test_thread_safe_kv():
+    kv = unit_test.ThreadSafeKV()
+
+    def fill(num):
+        for key in range(200):
+            kv.set("{:03}.{}".format(key, num), num)
+        kv.unsetrange(prefix="1")
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(fill, range(8)))
+    assert len(kv) == 8 * 100
+    assert kv._sorted_keys() == sorted(kv)
+    assert kv.getrange("050.", strip=True) == {str(num): num for num in range(8)}
+
+
+def test_dispatch_does_not_settle():
+    unit_test.patch_reactive(dispatch=True)
+    from charms.reactive import when, when_not, set_flag, clear_flag
+
+    unit_test.dispatcher.reset()
+
+    @when("a")
+    def flip_off():
+        clear_flag("a")
+
+    @when_not("a")
+    def flip_on():
+        set_flag("a")
+
+    with pytest.raises(RuntimeError):
+        unit_test.dispatcher.dispatch()
+
+
+def test_dispatcher_handler_order():
+    dispatcher = unit_test.Dispatcher()
+
+    def make_handler(name):
+        # Each call gives a new function with the same qualname, as reloading
+        # its module would.
+        def handler():
+            pass
+
+        handler.__qualname__ = name
+        return handler
+
+    for name in ("first", "second"):
+        dispatcher.register(make_handler(name), "when", ("a",))
+    reloaded = make_handler("first")
+    dispatcher.register(reloaded, "when", ("a",))
+    dispatcher.register(make_handler("third"), "when", ("a",))
+    orders = {key[1]: h.order for key, h in dispatcher.handlers.items()}
+    assert orders == {"first": 0, "second": 1, "third": 2}
+    assert dispatcher.handlers[(__name__, "first")].func is reloaded
+
+
+def test_mock_endpoint_from_relations():
+    endpoint = unit_test.MockEndpoint.from_relations(
+        "test",
+        {"test:1": 2, "test:2": 0, "test:3": 3},
+        received=lambda rel_id, unit: {"unit": unit},
+    )
+    assert len(endpoint.relations) == 3
+    assert endpoint.relations[0].relation_id == "test:1"
+    assert endpoint.relations[0].to_publish == {}
+    assert len(endpoint.all_joined_units) == 5
+    assert endpoint.relations[2]._units is None  # not built yet
+    assert endpoint.all_joined_units[-1].unit_name == "remote-3/2"
+    assert endpoint.all_joined_units[2].unit_name == "remote-3/0"
+    assert [u.received["unit"] for u in endpoint.all_joined_units] == [
+        "remote-1/0",
+        "remote-1/1",
+        "remote-3/0",
+        "remote-3/1",
+        "remote-3/2",
+    ]
+    assert (
+        endpoint.all_joined_units.received
+        is endpoint.relations[0].joined_units.received
+        is endpoint.relations[0].joined_units[0].received
+    )
+    assert endpoint.all_joined_units[1].relation is endpoint.relations[0]
+    with pytest.raises(IndexError):
+        endpoint.all_joined_units[5]
+
+    endpoint = unit_test.MockEndpoint.from_relations("test", [1, 2])
+    assert len(endpoint.all_joined_units) == 2
+    assert endpoint.all_joined_units.received == {}
+    assert endpoint.expand_name("{endpoint_name}.foo") == "test.foo"
+
+
+def test_mock_endpoint_json_data():
+    endpoint = unit_test.MockEndpoint.from_relations(
+        "test",
+        {"test:1": 2},
+        received=lambda rel_id, unit: {"unit": unit, "ports": [80]},
+        json_data=True,
+    )
+    relation = endpoint.relations[0]
+    stats = relation.data_stats
+    unit = endpoint.all_joined_units[1]
+    assert unit.received_raw == {"unit": '"remote-1/1"', "ports": "[80]"}
+    assert unit.received["ports"] == [80]
+    assert unit.received["ports"] is unit.received["ports"]  # cached
+    assert (stats.decodes, stats.bytes_decoded) == (1, 4)
+    unit.received_raw["ports"] = "[443]"
+    assert unit.received["ports"] == [443]
+    assert stats.decodes == 2
+    unit.received_raw["plain"] = "not json"
+    assert unit.received["plain"] == "not json"
+    unit.received_raw["empty"] = ""
+    assert unit.received["empty"] is None
+    with pytest.raises(ValueError):
+        unit.received["ports"] = [8080]
+
+    relation.to_publish["config"] = {"b": 1, "a": [1, 2]}
+    assert relation.to_publish_raw == {"config": '{"a": [1, 2], "b": 1}'}
+    relation.to_publish["config"] = {"a": [1, 2], "b": 1}
+    assert relation.to_publish["config"] == {"a": [1, 2], "b": 1}
+    assert (stats.encodes, stats.bytes_encoded) == (2, 42)
+    assert (stats.unchanged, stats.bytes_unchanged) == (1, 21)
+    del relation.to_publish["config"]
+    assert relation.to_publish_raw == {} and dict(relation.to_publish) == {}
+
+
+@pytest.fixture
+def import_trace():
+    trace = unit_test.import_trace
+    trace.clear()
+    trace.enabled = True
+    trace.context = "test"
+    yield trace
+    trace.enabled = False
+    trace.context = None
+    trace.clear()
+
+
+@patch("sys.path", [str(Path(__file__).parent / "lib")] + sys.path)
+def test_import_trace(import_trace):
+    unit_test.patch_module("dummy")
+    unit_test.patch_module("unused")
+    mock_package = unit_test.AutoImportMockPackage(name="patched.module")
+    unit_test.patch_module("patched.module", mock_package)
+    import dummy.test  # noqa
+    import patched.module
+
+    patched.module.import_over_patch
+    patched.module.not_real
+    with pytest.raises(ImportError):
+        import charms.dummy  # noqa
+
+    records = {r["name"]: r for r in import_trace.as_dict()["modules"]}
+    assert records["dummy.test"]["outcome"] == "mocked"
+    assert records["dummy.test"]["decided_by"] == "patched_ancestor"
+    assert records["dummy.test"]["find_spec_calls"] > 0
+    assert records["patched.module.import_over_patch"]["outcome"] == "real"
+    assert records["patched.module.not_real"]["outcome"] == "mocked"
+    assert records["patched.module.not_real"]["decided_by"] == "auto_import"
+    assert records["charms.dummy"]["outcome"] == "missing"
+    assert records["charms.dummy"]["decided_by"] == "real_ancestor"
+    assert records["charms.dummy"]["contexts"] == ["test"]
+    assert import_trace.contexts["test"][0] == 4
+    assert "unused" in import_trace.unused_mocks()
+    assert "dummy" not in import_trace.unused_mocks()
+    assert any("Unused mocks:" in line for line in import_trace.report_lines())
+
+
+def test_import_trace_plugin(pytester, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(test_charm="""
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+
+        def test_imports():
+            import charms.layer.foo  # noqa
+        """)
+    result = pytester.runpytest_subprocess(
+        "-p", "charms.unit_test", "--import-trace", "--import-trace-json=trace.json"
+    )
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*import mocking trace*", "*test_charm.py*"])
+    trace = json.loads((pytester.path / "trace.json").read_text())
+    assert "charms.layer.foo" in [r["name"] for r in trace["modules"]]
+
+
+@pytest.mark.parametrize("mode", ["isolate", "warn"])
+def test_patched_state_plugin(pytester, monkeypatch, mode):
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(test_charm="""
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+
+        from charms.reactive import set_flag  # noqa: E402
+        from charmhelpers.core import unitdata  # noqa: E402
+
+        def test_leak():
+            set_flag("leaked")
+            unitdata.kv().set("key", "value")
+            unit_test.patch_module("charms.leadership")
+
+        def test_check():
+            assert ("leaked" in unit_test.flags) == {mode!r}
+        """.format(mode=(mode == "warn")))
+    result = pytester.runpytest_subprocess(
+        "-p", "charms.unit_test", "--patched-state", mode
+    )
+    result.assert_outcomes(passed=2)
+    if mode == "warn":
+        result.stdout.fnmatch_lines(
+            [
+                "*PatchedStateLeakWarning: test_charm.py::test_leak leaked "
+                "patched state: flags set: leaked; unitdata changed: key; "
+                "patched modules changed: charms.leadership"
+            ]
+        )
+    else:
+        assert "PatchedStateLeakWarning" not in result.stdout.str()
+
+
+@pytest.mark.parametrize("mode", ["warn", "fail"])
+def test_mock_memory_plugin(pytester, monkeypatch, mode):
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(test_charm="""
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+
+        from charmhelpers.core import hookenv  # noqa: E402
+
+        def test_leak():
+            for i in range(1000):
+                hookenv.log("message", i)
+
+        def test_ok():
+            hookenv.log("message")
+        """)
+    result = pytester.runpytest_subprocess(
+        "-p", "charms.unit_test", "--mock-memory", mode, "--mock-memory-limit=64k"
+    )
+    message = "*test_charm.py::test_leak grew the memory held by mocks by *(charm*"
+    if mode == "warn":
+        result.assert_outcomes(passed=2, warnings=1)
+        result.stdout.fnmatch_lines(["*MockMemoryWarning: " + message])
+    else:
+        result.assert_outcomes(passed=2, errors=1)
+        result.stdout.fnmatch_lines(["*ERROR at teardown of test_leak*", message])
+    result.stdout.fnmatch_lines(
+        [
+            "*mock memory growth*",
+            "Largest growth by name:",
+            "*charmhelpers.core",
+            "Largest growth by test:",
+            "*test_charm.py::test_leak (charmhelpers.core, *",
+        ]
+    )
+
+
+def test_sample_mock_memory():
+    unit_test.patch_reactive(compact=True)
+    before = unit_test.sample_mock_memory()
+    assert set(before) >= {"charms.reactive", "charmhelpers", "<flags>", "<MockKV>"}
+    monitor = unit_test.MockMemoryMonitor(limit=None)
+    monitor.start()
+    sys.modules["charmhelpers"].core.hookenv.log("message")
+    unit_test.flags.add("grown")
+    assert monitor.stop("test") is None
+    (growth,) = monitor.growth
+    assert growth.context == "test"
+    assert {name for name, _ in growth.names} == {"charmhelpers", "<flags>"}
+    monitor.limit = 0
+    monitor.start()
+    unit_test.flags.add("grown.again")
+    assert monitor.stop("again").names[0][0] == "<flags>"
+    assert "Largest growth by test:" in monitor.report_lines()
+
+
+def test_module_watcher(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "watched_lib.py").write_text("VALUE = 1\n")
+    (tmp_path / "watched_user.py").write_text("from watched_lib import VALUE\n")
+    (tmp_path / "watched_other.py").write_text("import os\n")
+    import watched_user
+    import watched_other  # noqa: F401
+
+    watcher = unit_test.ModuleWatcher([tmp_path])
+    assert watcher.scan() == []
+    assert sorted(watcher.modules().values()) == [
+        "watched_lib",
+        "watched_other",
+        "watched_user",
+    ]
+    lib_path = str(tmp_path / "watched_lib.py")
+    (tmp_path / "watched_lib.py").write_text("VALUE = 2\n")
+    os.utime(lib_path, ns=(0, 0))
+    assert watcher.scan() == [lib_path]
+    # Function and class references count as dependencies, but plain values
+    # such as VALUE can't be traced back to their module.
+    (tmp_path / "watched_user.py").write_text("import watched_lib\n")
+    importlib.reload(watched_user)
+    affected = watcher.dependents({"watched_lib"})
+    assert affected == {"watched_lib", "watched_user"}
+    watcher.unload(affected)
+    assert "watched_user" not in sys.modules
+    assert "watched_other" in sys.modules
+    import watched_user
+
+    assert watched_user.watched_lib.VALUE == 2
+
+
+def test_watch_plugin(pytester, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(
+        charm_lib="VALUE = 1\n",
+        conftest="""
+            from charms import unit_test
+
+            unit_test.patch_reactive()
+            """,
+        test_charm="""
+            import charm_lib
+            from pathlib import Path
+
+            def test_value():
+                runs = Path("runs.txt")
+                runs.write_text((runs.read_text() if runs.exists() else "") + "charm ")
+                if charm_lib.VALUE == 1:
+                    Path("charm_lib.py").write_text("VALUE = 2\\n")
+                else:
+                    raise KeyboardInterrupt
+            """,
+        test_other="""
+            from pathlib import Path
+
+            def test_other():
+                runs = Path("runs.txt")
+                runs.write_text((runs.read_text() if runs.exists() else "") + "other ")
+            """,
+    )
+    result = pytester.runpytest_subprocess(
+        "-p", "charms.unit_test", "--watch", "-p", "no:cacheprovider", timeout=60
+    )
+    result.stdout.fnmatch_lines(
+        ["*2 passed*", "watch: charm_lib.py changed; re-running 1 test file(s)"]
+    )
+    assert (pytester.path / "runs.txt").read_text().split() == [
+        "charm",
+        "other",
+        "charm",
+    ]
+
+
+def test_fork_tests_plugin(pytester, monkeypatch):
+    if not hasattr(os, "fork"):
+        pytest.skip("requires os.fork()")
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(test_charm="""
+        import os
+        from pathlib import Path
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+        Path("imports.txt").open("a").write("imported ")
+
+        from charms.reactive import set_flag  # noqa: E402
+
+        def test_leak():
+            set_flag("leaked")
+            unit_test.patch_module("charms.leadership")
+
+        def test_isolated():
+            assert not unit_test.flags
+            assert "charms.leadership" not in unit_test.sys.modules
+
+        def test_fails():
+            assert "leaked" in unit_test.flags
+
+        def test_crashes():
+            os._exit(3)
+        """)
+    result = pytester.runpytest_subprocess("-p", "charms.unit_test", "--fork-tests")
+    result.assert_outcomes(passed=2, failed=2)
+    result.stdout.fnmatch_lines(
+        [
+            "*assert 'leaked' in *",
+            "*The forked test process exited with status 3",
+        ]
+    )
+    assert (pytester.path / "imports.txt").read_text() == "imported "
+
+
+def test_fork_tests_fixtures_and_warnings(pytester, monkeypatch):
+    if not hasattr(os, "fork"):
+        pytest.skip("requires os.fork()")
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    pytester.makepyfile(test_charm="""
+        import warnings
+        from pathlib import Path
+        import pytest
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+
+        @pytest.fixture(scope="session")
+        def resource():
+            Path("setups.txt").open("a").write("setup ")
+            yield
+            Path("setups.txt").open("a").write("teardown ")
+
+        @pytest.fixture(scope="module")
+        def broken():
+            raise RuntimeError("broken fixture")
+
+        def test_first(resource):
+            warnings.warn("from the child")
+
+        def test_second(resource):
+            pytest.skip("from the child")
+
+        def test_xfail():
+            pytest.xfail("expected")
+
+        @pytest.mark.skip
+        def test_skipped(broken):
+            pass
+
+        def test_broken(broken):
+            pass
+        """)
+    result = pytester.runpytest_subprocess(
+        "-p", "charms.unit_test", "--fork-tests", "-rs"
+    )
+    result.assert_outcomes(passed=1, skipped=2, xfailed=1, errors=1, warnings=1)
+    result.stdout.fnmatch_lines(
+        [
+            "*RuntimeError: broken fixture",
+            "*UserWarning: from the child",
+            "SKIPPED [[]1[]] test_charm.py:*: from the child",
+        ]
+    )
+    assert (pytester.path / "setups.txt").read_text() == "setup teardown "
+
+
+def test_patch_groups_plugin(pytester, monkeypatch):
+    pytest.importorskip("xdist")
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parent.parent))
+    test_module = """
+        import os
+        import pytest
+        from charms import unit_test
+
+        unit_test.patch_reactive()
+
+        def test_one():
+            pass
+
+        @pytest.mark.patch_group("shared")
+        def test_two():
+            pass
+        """
+    pytester.makepyfile(test_a=test_module, test_b=test_module)
+    result = pytester.runpytest_subprocess(
+        "-p",
+        "charms.unit_test",
+        "-n",
+        "2",
+        "--dist",
+        "loadgroup",
+        "--patch-groups",
+        "--import-trace-json=trace.json",
+        "-v",
+    )
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(["*@shared*", "*test_a.py::test_one@test_a.py*"])
+    assert not (pytester.path / "trace.json").exists()
+    assert list(pytester.path.glob("trace.json.gw*"))
+
+
+@pytest.mark.parametrize("suffix", [".json", ".yaml"])
+def test_patch_manifest(tmp_path, monkeypatch, suffix):
+    manifest = {
+        "charms.leadership": {
+            "leader_get": {"return_value": {"password": "secret"}},
+            "leader_set": {"side_effect": "charms.unit_test:flags.add"},
+            "LEADER_KEY": {"value": "leader"},
+        },
+        "charmhelpers.core.hookenv": {
+            "config": {"side_effect": [{"a": 1}, {"a": 2}]},
+            "Config.save": {"side_effect": "builtins:OSError"},
+        },
+    }
+    if suffix == ".yaml":
+        yaml = pytest.importorskip("yaml")
+        dumped = yaml.safe_dump(manifest)
+    else:
+        dumped = json.dumps(manifest)
+    path = tmp_path / ("manifest" + suffix)
+    path.write_text(dumped)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    compile_manifest = unit_test._compile_manifest
+    with patch.object(unit_test, "_compile_manifest", wraps=compile_manifest) as _c:
+        unit_test.patch_reactive(manifest=str(path))
+        # The second time, the compiled manifest comes from the cache.
+        unit_test.patch_manifest(path)
+        assert _c.call_count == 1
+    assert len(list((tmp_path / "cache" / "charms.unit_test").iterdir())) == 1
+
+    from charms import leadership
+    from charmhelpers.core import hookenv
+
+    assert isinstance(leadership, unit_test.MockModule)
+    assert leadership.leader_get() == {"password": "secret"}
+    leadership.leader_set("leadership.set")
+    assert "leadership.set" in unit_test.flags
+    assert leadership.LEADER_KEY == "leader"
+    assert hookenv.config() == {"a": 1}
+    assert hookenv.config() == {"a": 2}
+    with pytest.raises(OSError):
+        hookenv.Config.save()
+
+    with pytest.raises(ValueError):
+        unit_test.patch_manifest({"charms.leadership": {"leader_get": {"foo": 1}}})
+
+
+def test_layer_index(tmp_path):
+    pytest.importorskip("yaml")
+    charm = tmp_path / "charm"
+    (charm / "lib" / "charms" / "layer").mkdir(parents=True)
+    (charm / "lib" / "charms" / "layer" / "mycharm.py").write_text("VALUE = 1\n")
+    (charm / "layer.yaml").write_text(
+        "includes: ['layer:basic', 'interface:http', 'layer:options']\n"
+    )
+    layers = tmp_path / "layers"
+    basic = layers / "layer-basic" / "lib" / "charms" / "layer"
+    basic.mkdir(parents=True)
+    (basic / "basic.py").write_text("VALUE = 'basic'\n")
+    (basic / "mycharm.py").write_text("VALUE = 'overridden'\n")
+    options = layers / "options" / "lib" / "charms" / "layer" / "options"
+    options.mkdir(parents=True)
+    (options / "__init__.py").write_text("from .sub import VALUE  # noqa\n")
+    (options / "sub.py").write_text("VALUE = 'options'\n")
+
+    index = unit_test.LayerIndex(search_path=[str(layers)])
+    with patch.object(unit_test, "layer_index", index):
+        index.add(charm)
+        unit_test.patch_reactive()
+        import charms.layer
+        import charms.layer.options
+
+        assert charms.layer.mycharm.VALUE == 1
+        assert charms.layer.basic.VALUE == "basic"
+        assert charms.layer.options.VALUE == "options"
+        assert isinstance(charms.layer.missing, MagicMock)
+        assert {"basic", "mycharm", "options"} <= set(index.names())
+
+        scans = index.scans
+        (basic / "new_lib.py").write_text("VALUE = 'new'\n")
+        importlib.invalidate_caches()
+        assert charms.layer.new_lib.VALUE == "new"
+        # Only the modified directory was scanned again.
+        assert index.scans == scans + 1
+
+
+def test_layer_index_without_yaml(tmp_path, monkeypatch):
+    charm = tmp_path / "charm"
+    (charm / "lib" / "charms" / "layer").mkdir(parents=True)
+    (charm / "lib" / "charms" / "layer" / "mycharm.py").write_text("VALUE = 1\n")
+    (charm / "layer.yaml").write_text("includes: ['layer:basic']\n")
+    monkeypatch.setitem(sys.modules, "yaml", None)
+
+    index = unit_test.LayerIndex(search_path=[str(tmp_path)])
+    index.add(charm)
+    with pytest.warns(UserWarning, match="requires PyYAML"):
+        assert "mycharm" in index.names()
+    # The warning is only given once for each layer.yaml.
+    assert "mycharm" in index.names()
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_dispatcher_explore(workers):
+    unit_test.patch_reactive(dispatch=True)
+    from charms.reactive import when, when_any, when_not, set_flag, clear_flag
+
+    dispatcher = unit_test.dispatcher
+    dispatcher.reset()
+
+    @when("db.joined")
+    @when_not("db.configured")
+    def configure_db():
+        set_flag("db.configured")
+
+    @when_any("db.configured", "cache.configured")
+    @when_not("started")
+    def start():
+        if "cache.configured" in unit_test.flags:
+            raise ValueError("cache not supported")
+        set_flag("started")
+        set_flag("unrelated")
+
+    @when("started")
+    @when_not("db.joined")
+    def stop():
+        clear_flag("started")
+
+    def never_started_without_db(state):
+        return "started" not in state or "db.configured" in state
+
+    unit_test.flags.add("existing")
+    report = dispatcher.explore(
+        initial=[{"db.joined"}, {"cache.configured"}, {"db.configured"}],
+        invariants=[never_started_without_db],
+        workers=workers,
+    )
+    assert unit_test.flags == {"existing"}
+    assert set(report.states) == {
+        frozenset({"db.joined"}),
+        frozenset({"cache.configured"}),
+        frozenset({"db.configured"}),
+        frozenset({"db.joined", "db.configured"}),
+        frozenset({"db.configured", "started", "unrelated"}),
+        frozenset({"db.joined", "db.configured", "started", "unrelated"}),
+    }
+    # Stopping leads to {"db.configured", "unrelated"}, but no handler depends
+    # on "unrelated", so that's equivalent to {"db.configured"}.
+    assert report.transitions == 5
+    assert not report.truncated
+    [crash] = report.crashes
+    assert crash.flags == {"cache.configured"}
+    assert crash.handler.func is start
+    assert "ValueError: cache not supported" in crash.error
+    assert report.violations == []
+
+    report = dispatcher.explore(
+        initial=[{"db.joined"}],
+        invariants=[lambda state: False],
+        max_states=2,
+        workers=0,
+    )
+    assert report.truncated
+    assert len(report.states) == 2
+    assert report.violations[0].message == "returned False"
+
+    # Other state changed by handlers doesn't carry over between steps.
+    from charmhelpers.core import unitdata
+
+    kv = unitdata.kv()
+    dispatcher.reset()
+
+    @when("a")
+    @when_not("done")
+    def count():
+        count = kv.get("count", 0) + 1
+        kv.set("count", count)
+        set_flag("done")
+        set_flag("count.{}".format(count))
+
+    @when("b")
+    @when_not("b.seen")
+    def see_b():
+        set_flag("b.seen")
+
+    report = dispatcher.explore(initial=[{"a"}, {"a", "b"}], workers=workers)
+    assert {flag for state in report.states for flag in state} == {
+        "a",
+        "b",
+        "b.seen",
+        "done",
+        "count.1",
+    }
+    assert kv.get("count") is None
+
+
+@pytest.mark.parametrize("json_data", [False, True])
+def test_hook_replay(tmp_path, json_data):
+    unit_test.patch_reactive(dispatch=True)
+    from charms.reactive import when, when_not, set_flag, clear_flag
+    from charmhelpers.core import hookenv, unitdata
+
+    unit_test.dispatcher.reset()
+    seen = []
+
+    @when("config.changed.port")
+    def port_changed():
+        seen.append(("port", hookenv.config("port")))
+
+    @when("endpoint.db.joined", "endpoint.db.changed.host")
+    def db_changed():
+        host = db.all_joined_units.received["host"]
+        seen.append(("host", host))
+        unitdata.kv().set("host", host)
+        clear_flag("endpoint.db.changed.host")
+        if host == "bad":
+            raise ValueError("bad host")
+
+    @when("leadership.is_leader")
+    @when_not("leadership.set.password", "password.generated")
+    def set_password():
+        seen.append(("leader", hookenv.leader_get()))
+        set_flag("password.generated")
+
+    db = unit_test.MockEndpoint.from_relations("db", {}, json_data=json_data)
+    events = [
+        {"hook": "install", "leader": True},
+        {"hook": "config-changed", "config": {"port": 80}},
+        {
+            "hook": "db-relation-changed",
+            "relations": {
+                "db": {"db:1": {"app": "pg", "units": {"pg/0": {"host": "a"}}}}
+            },
+        },
+        {
+            "hook": "db-relation-changed",
+            "relations": {"db": {"db:1": {"units": {"pg/0": {"host": "bad"}}}}},
+        },
+        {
+            "hook": "db-relation-changed",
+            "relations": {"db": {"db:1": {"units": {"pg/0": {"host": "b"}}}}},
+            "leadership": {"password": "x"},
+        },
+        {"hook": "db-relation-broken", "relations": {"db": {"db:1": None}}},
+    ]
+    path = tmp_path / "hooks.jsonl"
+    path.write_text("\n".join(json.dumps(event) for event in events) + "\n")
+
+    replay = unit_test.HookReplay(path, endpoints={"db": db})
+    results = []
+    for result in replay:
+        results.append(result)
+        if result.index == 3:
+            # The failed hook's changes were rolled back.
+            assert unitdata.kv().get("host") == "a"
+            assert "endpoint.db.changed.host" in unit_test.flags
+    assert [r.hook for r in results] == [e["hook"] for e in events]
+    assert results[0].invoked == [set_password]
+    assert results[1].invoked == [port_changed]
+    assert results[2].invoked == [db_changed]
+    assert results[3].error and "ValueError: bad host" in results[3].error
+    assert [r.error for r in results if r.index != 3] == [None] * 5
+    assert seen == [
+        ("leader", {}),
+        ("port", 80),
+        ("host", "a"),
+        ("host", "bad"),
+        ("host", "b"),
+    ]
+    assert unitdata.kv().get("host") == "b"
+    assert "endpoint.db.changed.host" not in unit_test.flags
+    assert "config.changed" not in unit_test.flags
+    assert "leadership.set.password" in unit_test.flags
+    assert db.relations == []
+    assert not db.is_joined
+    assert "endpoint.db.departed" in unit_test.flags
+    assert "endpoint.db.joined" not in unit_test.flags
+    assert replay.hook_timings["db-relation-changed"][0] == 3
+    assert replay.handler_timings[db_changed][0] == 3
+    lines = replay.report_lines()
+    assert lines[0] == "slowest hooks:"
+    assert any("db_changed" in line for line in lines)
+
+
+def test_hookenv_data():
+    unit_test.patch_reactive(hookenv="memory")
+    from charmhelpers.core import hookenv
+
+    config = hookenv.config()
+    assert isinstance(config, unit_test.MockConfig)
+    config.update({"port": 80, "host": "a"})
+    assert config.changed("port")
+    config.save()
+    config["port"] = 8080
+    assert hookenv.config("port") == 8080
+    assert config.changed("port")
+    assert not config.changed("host")
+    assert config.previous("port") == 80
+
+    assert not hookenv.is_leader()
+    unit_test.hookenv_data.is_leader = True
+    assert hookenv.is_leader()
+    hookenv.leader_set({"password": "secret"}, count=1)
+    assert hookenv.leader_get() == {"password": "secret", "count": "1"}
+    hookenv.leader_set(count=None)
+    assert hookenv.leader_get("count") is None
+
+    db = unit_test.MockEndpoint.from_relations(
+        "db", {"db:1": 2}, received_raw=lambda rid, unit: {"host": unit}
+    )
+    unit_test.hookenv_data.add_endpoint(db)
+    assert hookenv.relation_ids("db") == ["db:1"]
+    assert hookenv.related_units("db:1") == ["remote-1/0", "remote-1/1"]
+    assert hookenv.relation_get("host", "remote-1/1", "db:1") == "remote-1/1"
+    os.environ.update(JUJU_RELATION_ID="db:1", JUJU_REMOTE_UNIT="remote-1/0")
+    assert hookenv.relation_get() == {"host": "remote-1/0"}
+    hookenv.relation_set(relation_settings={"port": 5432}, user="charm")
+    assert db.relations[0].to_publish_raw == {"port": "5432", "user": "charm"}
+    assert db.relations[0].to_publish == {"port": 5432, "user": "charm"}
+    assert hookenv.relation_get("port", "test/0") == "5432"
+    assert hookenv.relation_get(rid="db:2") is None
+    hookenv.relation_set(relation_settings={"url": "db"}, app=True)
+    assert db.relations[0].to_publish_app_raw == {"url": "db"}
+    assert db.relations[0].to_publish_app == {"url": "db"}
+    hookenv.relation_set(user=None)
+    assert "user" not in db.relations[0].to_publish
+    # Writes made directly to to_publish aren't seen by relation_get(), unless
+    # the endpoint uses json_data.
+    db.relations[0].to_publish["user"] = "handler"
+    assert hookenv.relation_get("user", "test/0") is None
+    json_db = unit_test.MockEndpoint.from_relations(
+        "json-db", ["json-db:1"], json_data=True
+    )
+    unit_test.hookenv_data.add_endpoint(json_db)
+    json_db.relations[0].to_publish["user"] = "handler"
+    assert hookenv.relation_get("user", "test/0", "json-db:1") == '"handler"'
+    hookenv.relation_set("json-db:1", port=5432)
+    assert json_db.relations[0].to_publish["port"] == 5432
+    assert hookenv.relation_get("url", app="test") == "db"
+    db.relations[0].received_app_raw["url"] = "remote"
+    assert hookenv.relation_get(app="remote-1") == {"url": "remote"}
+
+    # Relations added directly to the endpoint are picked up, too.
+    db.relations.append(unit_test.MockRelation("db:2"))
+    assert hookenv.relation_ids("db") == ["db:1", "db:2"]
+    assert hookenv.relation_get(unit="remote-2/0", rid="db:2") == {}
+
+
+def test_module_ancestors_cached():
+    assert unit_test.module_ancestors("a.b.c") == ["a", "a.b"]
+    assert unit_test.module_ancestors("a") == []
+    assert unit_test._ancestors("a.b.c") is unit_test._ancestors("a.b.c")
+    assert unit_test._ancestors("a.b.d")[1] is unit_test._ancestors("a.b.c")[1]
+
+
+def test_modules_snapshot():
+    with unit_test.ModulesSnapshot() as snapshot:
+        unit_test.patch_module("dummy.sub")
+        import dummy.sub
+
+        spec = dummy.sub.__spec__
+        import json.tool  # noqa: F401
+
+        assert set(snapshot.added()) >= {"dummy", "dummy.sub", "json.tool"}
+        assert sorted(snapshot.patched()) == ["dummy", "dummy.sub"]
+    assert "dummy" not in sys.modules
+    assert "json.tool" not in sys.modules
+
+    with unit_test.ModulesSnapshot():
+        unit_test.patch_module("dummy")
+        import dummy.sub  # noqa: F811
+
+        # Specs for mocked modules are reused rather than rebuilt.
+        assert dummy.sub.__spec__ is spec
+
+
+@pytest.mark.filterwarnings("error")
+def test_modules_snapshot_anchor_removed():
+    sys.modules.pop("xml.dom.minidom", None)
+    with unit_test.ModulesSnapshot() as snapshot:
+        anchor = next(reversed(list(sys.modules)))
+        module = sys.modules.pop(anchor)
+        import xml.dom.minidom  # noqa: F401
+
+        assert "xml.dom.minidom" in snapshot.added()
+        importlib.import_module(anchor)
+    assert "xml.dom.minidom" not in sys.modules
+    assert sys.modules[anchor] is module
+
+
+@pytest.mark.filterwarnings("error")
+def test_modules_snapshot_reimport():
+    import csv
+
+    sys.modules.pop("xml.dom.minidom", None)
+    sys.modules["reimport_anchor"] = unit_test.ModuleType("reimport_anchor")
+    with unit_test.ModulesSnapshot() as snapshot:
+        del sys.modules["csv"]
+        import csv as reimported  # noqa: F401
+        import xml.dom.minidom  # noqa: F401
+
+        assert "csv" not in snapshot.added()
+        assert "xml.dom.minidom" in snapshot.added()
+    assert sys.modules["csv"] is csv
+    assert "xml.dom.minidom" not in sys.modules